@@ -1,4 +1,5 @@
 import streamlit as st
+from pages.utils.data_store import preload
 
 
 
@@ -6,6 +7,8 @@ st.set_page_config(page_title="Accessibility web app",
                    page_icon="🌍", 
                    layout="wide", 
                    initial_sidebar_state="auto")
+# Import the libraries and load the datasets of the pages in the background while this page renders
+preload()
 st.markdown('<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/5.15.4/css/all.min.css">', unsafe_allow_html=True)
 st.markdown("""
 <style>
@@ -1,10 +1,16 @@
 import streamlit as st
-import geopandas as gpd
 import numpy as np
 import plotly.express as px
 import folium
-from streamlit_folium import folium_static
-from pages.utils import DATA_FOLDER
+import branca.colormap as cm
+from pages.utils.compute_cache import cached
+from pages.utils.data_store import preload
+from pages.utils.layers import CompactGeoJson
+from pages.utils.metrics import map_html, show_map, span
+from pages.utils.opportunity_bins import HEX_RADIUS, density, use_density
+from pages.utils.opportunity_cube import PER_RESIDENTS, per_capita, type_counts
+from pages.utils.query import initial_params, option_defaults, option_index, share
+from pages.utils.shared_data import read_dataset
 
 def set_page():
     """
@@ -27,8 +33,9 @@ def read_data():
     Returns:
         data: the read data
     """
-    data = gpd.read_parquet(DATA_FOLDER / 'opportunities.parquet')
-    data = data.to_crs('EPSG:4326')
+    with span(1, 'read_data') as current:
+        data = read_dataset('opportunities')
+        current.rows = len(data)
     return data
 
 def filter_and_create_charts(data):
@@ -39,14 +46,18 @@ def filter_and_create_charts(data):
         data: containing point geometries of different opportunities (Grocery stores, Healthcare, Library, Pharmacy, Public sports facilities, Schhools) types across Finland.
 
     Returns:
-        m: A Folium map object containing the selected and filtered opportunities
+        html: the rendered Folium map containing the selected and filtered opportunities
         fig: A plotly bar chart about the number of opportunities.
+        per_capita_fig: small multiples of the opportunities per capita in all municipalities, None for a municipality
     """
     opportunity_types = data['opprtnt'].unique()
+    # The selection can be given in the query parameters of the URL
+    params = initial_params(1)
     # User selection for different opportunity types
-    selected_types = st.multiselect('Select opportunity types:', opportunity_types)
+    selected_types = st.multiselect('Select opportunity types:', opportunity_types, default=option_defaults(params, 'type', opportunity_types))
 
     if not selected_types:
+        share()
         return None
     
     else:
@@ -54,21 +65,29 @@ def filter_and_create_charts(data):
         # Add an "Finland" option to the municipalities list so that data can be looked at nationally
         municipalities = np.insert(municipalities, 0, 'Finland')
         # user selection for different municipalities
-        selected_municipality = st.selectbox('Select a municipality', municipalities)
-        if selected_municipality == 'Finland':
-            filtered_data = data
-            zoom_level = 5
-        else:
-            filtered_data = data[data['mncplty'] == selected_municipality]
-            zoom_level = 9
-        # Filter data by selected opportunity types
-        filtered_data = filtered_data[filtered_data['opprtnt'].isin(selected_types)]
-        m, fig = create_charts(selected_municipality, filtered_data,zoom_level,opportunity_types)
+        selected_municipality = st.selectbox('Select a municipality', municipalities, index=option_index(params, 'area', municipalities))
+        share(type=selected_types, area=selected_municipality)
 
-        return m, fig
+        def build():
+            with span(1, 'filter', rows=len(data)):
+                if selected_municipality == 'Finland':
+                    filtered_data = data
+                    zoom_level = 5
+                else:
+                    filtered_data = data[data['mncplty'] == selected_municipality]
+                    zoom_level = 9
+                # Filter data by selected opportunity types
+                filtered_data = filtered_data[filtered_data['opprtnt'].isin(selected_types)]
+            m, fig = create_charts(selected_municipality, filtered_data,zoom_level,opportunity_types, selected_types)
+            per_capita_fig = create_per_capita_chart(selected_types) if selected_municipality == 'Finland' else None
+            return map_html(m, 1), fig, per_capita_fig
+
+        # The map and figures of a selection are built once and shared by all sessions
+        return cached((1, 'charts', selected_municipality, tuple(sorted(selected_types))), build,
+                      datasets=('opportunities', 'municipality_polygons', 'grid'))
 
 
-def create_charts(selected_municipality, filtered_data, zoom_level, opportunity_types):
+def create_charts(selected_municipality, filtered_data, zoom_level, opportunity_types, selected_types=None):
     """
     Creates plotly figure and a Folium map object
 
@@ -77,6 +96,8 @@ def create_charts(selected_municipality, filtered_data, zoom_level, opportunity_
         filtered_data: data filtered based on the selected_municipality
         zoom_level: level of zoom applied for the folium map object when app starts
         opportunity_types: types of opportunities the user has selected to look at
+        selected_types: the opportunity types in filtered_data, used to sum the precomputed hexagon counts of the
+            national map. All opportunity_types by default
 
     Returns:
         m: A Folium map object containing the selected and filtered opportunities
@@ -84,11 +105,13 @@ def create_charts(selected_municipality, filtered_data, zoom_level, opportunity_
 
     """
     # Read municipal polygons to display boundaries
-    municipality_polygons = gpd.read_parquet(DATA_FOLDER / 'kunnat2023.parquet')
-    municipality_polygons = municipality_polygons.to_crs('EPSG:4326')
+    with span(1, 'read_polygons') as current:
+        municipality_polygons = read_dataset('municipality_polygons')
+        current.rows = len(municipality_polygons)
     
-    # Summarize the number of each opportunity type for the selected municipality or all
-    opportunity_sums = filtered_data.groupby(['opprtnt', 'color']).size().reset_index(name='count')
+    # Look up the number of each opportunity type for the selected municipality or all from the precomputed counts
+    with span(1, 'counts'):
+        opportunity_sums = type_counts(selected_municipality, opportunity_types if selected_types is None else selected_types)
     # Rename the opportunity column
     opportunity_sums = opportunity_sums.rename(columns={'opprtnt': 'Opportunity type'})
 
@@ -114,15 +137,17 @@ def create_charts(selected_municipality, filtered_data, zoom_level, opportunity_
     with st.spinner(text="Loading map..."):
         #----- CREATING A MAP ALONGSIDE CHART -----
         # Calculate the centroid of the selected municipality's geometry so that map gets to the location of the points
-        centroid = filtered_data.geometry.unary_union.centroid
+        with span(1, 'unary_union', rows=len(filtered_data)):
+            centroid = filtered_data.geometry.unary_union.centroid
         m = folium.Map(location=[centroid.y, centroid.x], zoom_start=zoom_level, tiles="cartodbpositron")
         
         if selected_municipality != 'Finland':
             # Filter municipality polygons based on selected municipality
             filtered_polygons = municipality_polygons[municipality_polygons['nimi'] == selected_municipality]
             # Add polygon layer to map to display municipal boundaries
-            folium.GeoJson(
+            CompactGeoJson(
                 filtered_polygons,
+                1,
                 style_function=lambda feature: {
                     'fillColor': 'transparent',
                     'color': 'black',
@@ -131,16 +156,59 @@ def create_charts(selected_municipality, filtered_data, zoom_level, opportunity_
                 }
             ).add_to(m)
     
-        # Loops through the opportunity data to create a point layer to the map for each opportunity type
-        for type in opportunity_types:
-            data = filtered_data[filtered_data['opprtnt'] == type]
-            if not data.empty:
-                color = data.iloc[0]['color']
-                add_point_layer(data, color, m)
+        if selected_municipality == 'Finland' and use_density(zoom_level, len(filtered_data)):
+            # The points cannot be told apart at the national zoom level, so the number of opportunities per hexagon is shown
+            with span(1, 'density_layer', rows=len(filtered_data)):
+                add_density_layer(density(opportunity_types if selected_types is None else selected_types), m)
+        else:
+            # Loops through the opportunity data to create a point layer to the map for each opportunity type
+            with span(1, 'folium_layers', rows=len(filtered_data)):
+                for type in opportunity_types:
+                    data = filtered_data[filtered_data['opprtnt'] == type]
+                    if not data.empty:
+                        color = data.iloc[0]['color']
+                        add_point_layer(data, color, m)
 
         return m, fig
 
 
+def create_per_capita_chart(selected_types):
+    """
+    Creates small multiples of the number of opportunities per capita in every municipality, one chart per opportunity type
+
+    Args:
+        selected_types: opportunity types the user has selected to look at
+
+    Returns:
+        fig: A plotly figure with a bar chart per opportunity type, municipalities sorted from the most to the fewest opportunities per capita
+    """
+    with span(1, 'per_capita'):
+        rates = per_capita(selected_types)
+    rates = rates.rename(columns={'opprtnt': 'Opportunity type', 'mncplty': 'Municipality'})
+
+    fig = px.bar(
+        rates,
+        x='Municipality',
+        y='per_capita',
+        color='Opportunity type',
+        facet_col='Opportunity type',
+        facet_col_wrap=3,
+        color_discrete_sequence=rates.drop_duplicates('Opportunity type')['color'].tolist(),
+        labels={'per_capita': f'Per {PER_RESIDENTS:,} residents'.replace(',', ' ')}
+    )
+    # Each chart sorts the municipalities by its own opportunity type
+    fig.update_xaxes(matches=None, showticklabels=False, categoryorder='total descending', title=None)
+    fig.update_yaxes(matches=None, showticklabels=True)
+    fig.for_each_annotation(lambda annotation: annotation.update(text=annotation.text.split('=')[-1]))
+    fig.update_layout(
+        dragmode=False,
+        title=f'Opportunities per {PER_RESIDENTS:,} residents in the municipalities of Finland'.replace(',', ' '),
+        title_font_size=24,
+        showlegend=False,
+        height=300 * ((rates['Opportunity type'].nunique() + 2) // 3) + 100
+    )
+    return fig
+
 def add_point_layer(data, clr, m):
     """
     A function that adds customized points to Folium map object as a layer. color parameter assigns the same color as is in the plotly figure
@@ -161,6 +229,33 @@ def add_point_layer(data, clr, m):
             fill_opacity=1
         ).add_child(folium.Tooltip(row['name'])).add_to(m)
 
+def add_density_layer(data, m):
+    """
+    Adds the number of opportunities per hexagon to Folium map object as a layer
+
+    Args:
+        data: GeoDataFrame of hexagons with the number of selected opportunities in 'count' (see opportunity_bins.density)
+        m: Folium map object where the layer is added
+    """
+    fill_color = cm.LinearColormap(
+        ["#F3E79A", "#F9B282", "#ED7C97", "#D868A3", "#704D9E", "#573980"],
+        vmin=1, vmax=max(int(data['count'].max()), 2)
+    )
+    layer = CompactGeoJson(
+        data,
+        1,
+        properties=['count'],
+        style_function=lambda feature: {
+            'fillColor': fill_color(feature['properties']['count']),
+            'fillOpacity': 0.7,
+            'weight': 0,
+        }
+    ).add_to(m)
+    layer.add_child(folium.features.GeoJsonTooltip(fields=['count'], aliases=['Opportunities'], localize=True))
+
+    fill_color.caption = f'Number of opportunities within {HEX_RADIUS // 1000} km hexagons'
+    m.add_child(fill_color)
+
 def responsive_to_window_width():
     """
     A function that sets the map object width according to window size
@@ -181,7 +276,7 @@ def add_description():
     ### **Methodology**
 
     <span style="font-size: 18px;">The data of the different opportunities has been collected from different sources, either from readily available open databases or webscraped
-    and then geocoded by using python scripts. The data used here is from year 2021.</span>
+    and then geocoded by using python scripts. The data used here is from year 2021. On the map of Finland, the opportunities are counted in hexagons with a side of 10 km when there are too many of them to be told apart; select a municipality to see the individual opportunities. The number of opportunities per 10 000 residents is calculated from the population of the municipalities in the population grid.</span>
 
     ''', unsafe_allow_html=True)
     
@@ -212,10 +307,11 @@ def add_description():
 
 def main():
     set_page()
+    preload()
     data = read_data()
     result = filter_and_create_charts(data)
     if result is not None:
-        m, fig = result
+        html, fig, per_capita_fig = result
         col1, col2 = st.columns([1, 1])
         col1.plotly_chart(fig, use_container_width=True)
 
@@ -223,7 +319,9 @@ def main():
         # Display the map in Streamlit
         with col2:
             with st.spinner(text="Loading map..."):
-                folium_static(m)
+                show_map(html)
+        if per_capita_fig is not None:
+            st.plotly_chart(per_capita_fig, use_container_width=True)
     else:
         # Handle the case where filter_and_create_charts returns None
         st.warning('Please select at least one opportunity type.')
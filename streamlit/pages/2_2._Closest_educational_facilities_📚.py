@@ -1,10 +1,18 @@
 import streamlit as st
 import pandas as pd
-import geopandas as gpd
 import plotly.express as px
 import folium
-from streamlit_folium import folium_static
-from pages.utils import DATA_FOLDER
+from pages.utils.compute_cache import cached
+from pages.utils.data_store import preload
+from pages.utils.layers import CompactGeoJson
+from pages.utils.metrics import map_html, show_map, span
+from pages.utils.query import flag_value, initial_params, option_defaults, share
+from pages.utils.shared_data import read_dataset
+from pages.utils.static_assets import selection_map
+from pages.utils.sessions import track
+
+# Datasets the figures of the page are computed from
+EDUCATION_DATASETS = ('access_ttm_pt', 'access_ttm_cycling', 'grid_csv')
 
 # Bootstrap approach for mobile.
 
@@ -34,9 +42,11 @@ def read_data():
         municipality: 
 
     """    
-    pt_data = pd.read_csv(DATA_FOLDER / 'access_ttm_pt.csv')
-    cycling_data = pd.read_csv(DATA_FOLDER / 'access_ttm_cycling.csv')
-    grid = pd.read_csv(DATA_FOLDER / 'grid.csv')
+    with span(2, 'read_data') as current:
+        pt_data = read_dataset('access_ttm_pt')
+        cycling_data = read_dataset('access_ttm_cycling')
+        grid = read_dataset('grid_csv')
+        current.rows = len(pt_data) + len(cycling_data) + len(grid)
     # Extract unique values for municipality column
     municipality = cycling_data['nimi'].unique()
     # Store municipality variable in st.session_state
@@ -66,16 +76,23 @@ def filter_data(pt_data, cycling_data, grid):
 
     with col1:
         options = st.multiselect(
-            'Select municipalities:', st.session_state.municipality, key='selected_municipalities'
+            'Select municipalities:', st.session_state.municipality, key='selected_municipalities',
+            default=option_defaults(initial_params(2), 'area', st.session_state.municipality)
         )
+    share(area=options)
 
-    # Filter data based on selected municipalities
-    if options:
-        pt_data = pt_data[pt_data['nimi'].isin(options)].copy()
-        cycling_data = cycling_data[cycling_data['nimi'].isin(options)].copy()
-        grid = grid[grid['nimi'].isin(options)].copy()
-    data_long = create_df(pt_data, cycling_data, grid, options)
-    fig = create_fig(data_long)
+    def build(pt_data, cycling_data, grid):
+        # Filter data based on selected municipalities
+        if options:
+            with span(2, 'filter', rows=len(pt_data) + len(cycling_data) + len(grid)):
+                pt_data = pt_data[pt_data['nimi'].isin(options)].copy()
+                cycling_data = cycling_data[cycling_data['nimi'].isin(options)].copy()
+                grid = grid[grid['nimi'].isin(options)].copy()
+        data_long = create_df(pt_data, cycling_data, grid, options)
+        return create_fig(data_long)
+
+    # The figure of a selection is built once and shared by all sessions
+    fig = cached((2, 'figure', tuple(options)), lambda: build(pt_data, cycling_data, grid), datasets=EDUCATION_DATASETS)
 
     return fig
 
@@ -97,40 +114,48 @@ def filter_comparison_data(pt_data, cycling_data, grid):
 
     with col1:
         options1 = st.multiselect(
-            'Select municipalities (selection 1):', st.session_state.municipality, key='selected_municipalities1'
+            'Select municipalities (selection 1):', st.session_state.municipality, key='selected_municipalities1',
+            default=option_defaults(initial_params(2), 'area1', st.session_state.municipality)
         )
     with col2:
         options2 = st.multiselect(
-            'Select municipalities (selection 2):', st.session_state.municipality, key='selected_municipalities2'
+            'Select municipalities (selection 2):', st.session_state.municipality, key='selected_municipalities2',
+            default=option_defaults(initial_params(2), 'area2', st.session_state.municipality)
         )
+    share(compare=True, area1=options1, area2=options2)
 
     if not options1 or not options2:
         st.warning("Please select at least one municipality for each selection.")
         return
 
 
-    # Filter data based on selected municipalities
-    if options1:
-        pt_data1 = pt_data[pt_data['nimi'].isin(options1)].copy()
-        cycling_data1 = cycling_data[cycling_data['nimi'].isin(options1)].copy()
-        grid1 = grid[grid['nimi'].isin(options1)].copy()
-    else:
-        pt_data1 = pt_data.copy()
-        cycling_data1 = cycling_data.copy()
-        grid1 = grid.copy()
-    if options2:
-        pt_data2 = pt_data[pt_data['nimi'].isin(options2)].copy()
-        cycling_data2 = cycling_data[cycling_data['nimi'].isin(options2)].copy()
-        grid2 = grid[grid['nimi'].isin(options2)].copy()
-    else:
-        pt_data2 = pt_data.copy()
-        cycling_data2 = cycling_data.copy()
-        grid2 = grid.copy()
-
-    data_long1 = create_df(pt_data1, cycling_data1, grid1, options1)
-    data_long2 = create_df(pt_data2, cycling_data2, grid2, options2)
-    fig = create_comparison_fig(data_long1, data_long2, options1, options2)
-    return fig
+    def build():
+        # Filter data based on selected municipalities
+        with span(2, 'filter', rows=2 * (len(pt_data) + len(cycling_data) + len(grid))):
+            if options1:
+                pt_data1 = pt_data[pt_data['nimi'].isin(options1)].copy()
+                cycling_data1 = cycling_data[cycling_data['nimi'].isin(options1)].copy()
+                grid1 = grid[grid['nimi'].isin(options1)].copy()
+            else:
+                pt_data1 = pt_data.copy()
+                cycling_data1 = cycling_data.copy()
+                grid1 = grid.copy()
+            if options2:
+                pt_data2 = pt_data[pt_data['nimi'].isin(options2)].copy()
+                cycling_data2 = cycling_data[cycling_data['nimi'].isin(options2)].copy()
+                grid2 = grid[grid['nimi'].isin(options2)].copy()
+            else:
+                pt_data2 = pt_data.copy()
+                cycling_data2 = cycling_data.copy()
+                grid2 = grid.copy()
+
+        data_long1 = create_df(pt_data1, cycling_data1, grid1, options1)
+        data_long2 = create_df(pt_data2, cycling_data2, grid2, options2)
+        fig = create_comparison_fig(data_long1, data_long2, options1, options2)
+        return fig
+
+    # The figure of a pair of selections is built once and shared by all sessions
+    return cached((2, 'comparison figure', tuple(options1), tuple(options2)), build, datasets=EDUCATION_DATASETS)
 
 
 def create_df(pt_data, cycling_data, grid, options):
@@ -148,20 +173,21 @@ def create_df(pt_data, cycling_data, grid, options):
         A DataFrame with cumulative share data for public transportation and cycling.
     """
     max_travel_time = 60
-    cumulative_share_pt = [sum(pt_data.loc[pt_data['trv__50'] <= x, ['he_7_12', 'h_13_15', 'h_16_17']].sum(axis=1)) /
-                            grid[['he_7_12', 'he_13_15', 'he_16_17']].sum().sum() for x in range(0, max_travel_time + 1)]
-    cumulative_share_cycling = [sum(cycling_data.loc[cycling_data['trv__50'] <= x, ['he_7_12', 'h_13_15', 'h_16_17']].sum(axis=1)) /
+    with span(2, 'create_df', rows=len(pt_data) + len(cycling_data)):
+        cumulative_share_pt = [sum(pt_data.loc[pt_data['trv__50'] <= x, ['he_7_12', 'h_13_15', 'h_16_17']].sum(axis=1)) /
                                 grid[['he_7_12', 'he_13_15', 'he_16_17']].sum().sum() for x in range(0, max_travel_time + 1)]
+        cumulative_share_cycling = [sum(cycling_data.loc[cycling_data['trv__50'] <= x, ['he_7_12', 'h_13_15', 'h_16_17']].sum(axis=1)) /
+                                    grid[['he_7_12', 'he_13_15', 'he_16_17']].sum().sum() for x in range(0, max_travel_time + 1)]
 
-    mode_pt = ['Public transport + 1 000 m walk'] * (max_travel_time + 1)
-    mode_cycling = ['Cycling'] * (max_travel_time + 1)
+        mode_pt = ['Public transport + 1 000 m walk'] * (max_travel_time + 1)
+        mode_cycling = ['Cycling'] * (max_travel_time + 1)
 
-    data_long = pd.DataFrame({
-        'travel_time': list(range(0, max_travel_time + 1)) * 2,
-        'access': cumulative_share_pt + cumulative_share_cycling,
-        'mode': mode_pt + mode_cycling,
-        'kunta': [', '.join(options)] * (max_travel_time + 1) * 2
-    })
+        data_long = pd.DataFrame({
+            'travel_time': list(range(0, max_travel_time + 1)) * 2,
+            'access': cumulative_share_pt + cumulative_share_cycling,
+            'mode': mode_pt + mode_cycling,
+            'kunta': [', '.join(options)] * (max_travel_time + 1) * 2
+        })
 
     return data_long
 
@@ -291,25 +317,29 @@ def create_map(selected_municipalities):
         selected_municipalities: A list of selected municipalities.
 
     """
-    # Select municipalities where the field in 'nimi' is same in municipality and municipality polygons and insert it to filtered_polygons
-    if selected_municipalities:
-        municipality_polygons = gpd.read_parquet(DATA_FOLDER / 'kunnat2023.parquet')
-        municipality_polygons = municipality_polygons.to_crs('EPSG:4326')
-        filtered_polygons = municipality_polygons[municipality_polygons['nimi'].isin(selected_municipalities)]
-    else:
-        finland_polygons = gpd.read_file(DATA_FOLDER / 'suomi.gpkg')
-        finland_polygons = finland_polygons.to_crs('EPSG:4326')
-        filtered_polygons = finland_polygons
+    def build():
+        # Select municipalities where the field in 'nimi' is same in municipality and municipality polygons and insert it to filtered_polygons
+        with span(2, 'read_polygons') as current:
+            if selected_municipalities:
+                municipality_polygons = read_dataset('municipality_polygons')
+                filtered_polygons = municipality_polygons[municipality_polygons['nimi'].isin(selected_municipalities)]
+            else:
+                filtered_polygons = read_dataset('finland_polygon')
+            current.rows = len(filtered_polygons)
     
-    bounds = filtered_polygons.geometry.unary_union.bounds
-    centroid = filtered_polygons.geometry.unary_union.centroid
-    m = folium.Map(location=[centroid.y, centroid.x], tiles="cartodbpositron")
-    m.fit_bounds([(bounds[1], bounds[0]), (bounds[3], bounds[2])])
+        with span(2, 'unary_union', rows=len(filtered_polygons)):
+            bounds = filtered_polygons.geometry.unary_union.bounds
+            centroid = filtered_polygons.geometry.unary_union.centroid
+        m = folium.Map(location=[centroid.y, centroid.x], tiles="cartodbpositron")
+        m.fit_bounds([(bounds[1], bounds[0]), (bounds[3], bounds[2])])
+
+        with span(2, 'folium_geojson', rows=len(filtered_polygons)):
+            geojson = CompactGeoJson(filtered_polygons, 2, properties=['nimi'], style_function=style_polygon, highlight_function=highlight_polygon).add_to(m)
+            geojson.add_child(folium.features.GeoJsonTooltip(fields=['nimi'], aliases=['']))
+        return map_html(m, 2)
 
-    geojson = folium.GeoJson(filtered_polygons, style_function=style_polygon, highlight_function=highlight_polygon).add_to(m)
-    geojson.add_child(folium.features.GeoJsonTooltip(fields=['nimi'], aliases=['']))
     responsive_to_window_width()
-    folium_static(m, height=500)
+    show_map(selection_map(2, (2, 'map', tuple(sorted(selected_municipalities))), build, datasets=('municipality_polygons', 'finland_polygon')), height=500)
 
 def style_polygon(_):
     return {
@@ -331,19 +361,28 @@ def create_comparison_map():
 
     This function allows the user to select two sets of municipalities using Streamlit's `multiselect` widget. It then creates a map using the Folium library. The map displays the two sets of selected municipalities as polygons in different colors.
     """    
-    municipality_polygons = gpd.read_parquet(DATA_FOLDER / 'kunnat2023.parquet')
-    municipality_polygons = municipality_polygons.to_crs('EPSG:4326')
-
-    filtered_polygons = municipality_polygons[municipality_polygons['nimi'].isin(st.session_state.selected_municipalities1 + st.session_state.selected_municipalities2)]
-    bounds = filtered_polygons.geometry.unary_union.bounds
-    centroid = filtered_polygons.geometry.unary_union.centroid
-    m = folium.Map(location=[centroid.y, centroid.x], tiles="cartodbpositron")
-    m.fit_bounds([(bounds[1], bounds[0]), (bounds[3], bounds[2])])
+    selected1 = st.session_state.selected_municipalities1
+    selected2 = st.session_state.selected_municipalities2
+
+    def build():
+        with span(2, 'read_polygons') as current:
+            municipality_polygons = read_dataset('municipality_polygons')
+            current.rows = len(municipality_polygons)
+
+        filtered_polygons = municipality_polygons[municipality_polygons['nimi'].isin(selected1 + selected2)]
+        with span(2, 'unary_union', rows=len(filtered_polygons)):
+            bounds = filtered_polygons.geometry.unary_union.bounds
+            centroid = filtered_polygons.geometry.unary_union.centroid
+        m = folium.Map(location=[centroid.y, centroid.x], tiles="cartodbpositron")
+        m.fit_bounds([(bounds[1], bounds[0]), (bounds[3], bounds[2])])
+
+        with span(2, 'folium_geojson', rows=len(filtered_polygons)):
+            geojson = CompactGeoJson(filtered_polygons, 2, properties=['nimi'], style_function=style_comparison_polygon, highlight_function=highlight_comparison_polygon).add_to(m)
+            geojson.add_child(folium.features.GeoJsonTooltip(fields=['nimi'], aliases=['Municipality:']))
+        return map_html(m, 2)
 
-    geojson = folium.GeoJson(filtered_polygons, style_function=style_comparison_polygon, highlight_function=highlight_comparison_polygon).add_to(m)
-    geojson.add_child(folium.features.GeoJsonTooltip(fields=['nimi'], aliases=['Municipality:']))
     responsive_to_window_width()
-    folium_static(m, height=500)
+    show_map(selection_map(2, (2, 'comparison map', tuple(sorted(selected1)), tuple(sorted(selected2))), build, datasets=('municipality_polygons',)), height=500)
 
 def highlight_comparison_polygon(feature):
     return {
@@ -419,6 +458,7 @@ def add_description():
     
 def main():
     set_page()
+    preload()
     if 'municipality' not in st.session_state:
         pt_data, cycling_data, grid, municipality = read_data()
     else:
@@ -426,11 +466,12 @@ def main():
             pt_data, cycling_data, grid, municipality
         except NameError:
             pt_data, cycling_data, grid, municipality = read_data()
+    track('municipality')
     
 
     col1, _ = st.columns([2, 6])
     with col1:
-        compare = st.checkbox('Compare municipalities')
+        compare = st.checkbox('Compare municipalities', flag_value(initial_params(2), 'compare'))
     if compare:
         fig = filter_comparison_data(pt_data, cycling_data, grid)
         col1, col3 = st.columns([3,1])
@@ -1,12 +1,52 @@
 import streamlit as st
 from streamlit.components.v1 import html
-import geopandas as gpd
 import pandas as pd 
 import numpy as np
 import folium
 import branca.colormap as cm
-from streamlit_folium import folium_static
-from pages.utils import DATA_FOLDER
+from pages.utils import POPULATION_COLUMN
+from pages.utils.fca import OPPORTUNITY_TYPES, TTM_DATASETS, e2sfca_indicator
+from pages.utils.compute_cache import cached
+from pages.utils.data_store import preload
+from pages.utils.expressions import evaluate, numeric_columns, parse
+from pages.utils.grid_pyramid import coarsen, level_for_zoom
+from pages.utils.grid_stats import THRESHOLDS, class_breaks, population_shares, statistics
+from pages.utils.layers import CompactGeoJson
+from pages.utils.metrics import map_html, show_map, span
+from pages.utils.nearest import distance_indicator, nearest, nearest_table, projected_location
+from pages.utils.reachability import nearest_cell, reachable_opportunities, reaching_cells
+from pages.utils.scenarios import scenario_delta, scenario_editor
+from pages.utils.query import flag_value, initial_params, option_index, share, text_value
+from pages.utils.sessions import track
+from pages.utils.shared_data import read_dataset
+from pages.utils.static_assets import selection_map
+
+CUMULATIVE_INDICATOR = 'Number of accessible opportunities'
+E2SFCA_INDICATOR = 'Competition-adjusted access (E2SFCA)'
+DISTANCE_INDICATOR = 'Distance to the nearest opportunity'
+REACHABILITY_INDICATOR = 'Reachability from a location'
+
+# Directions of the reachability queries
+DIRECTIONS = ('Opportunities reachable from the location', 'Cells that can reach the nearest opportunity')
+EXPRESSION_INDICATOR = 'Derived indicator'
+
+# Opportunity types and their abbreviations in the names of the access fields, in the order of the selectbox
+OPPORTUNITY_ABBREVIATIONS = {
+    'Pharmacy': 'aptk',
+    'Grocery store': 'ruok',
+    'Library': 'kirja',
+    'Public sports facility': 'lahi',
+    'School': 'koul',
+    'Healthcare': 'sair',
+    'Jobs': 'tyo'
+}
+
+# Classification methods of the cumulative access maps (see grid_stats.class_breaks)
+CLASSIFICATIONS = {
+    'Equal intervals': 'equal',
+    'Quantiles': 'quantile',
+    'Natural breaks (Jenks)': 'jenks'
+}
 
 def set_page():
     """
@@ -30,14 +70,16 @@ def read_data():
     Returns:
         municipalities: the list of unique municipalitites used for selections
     """
-    # Check if data for Finland has already been loaded to session state
-    if 'data_Finland' not in st.session_state:
-        with st.spinner(text="Loading data..."):
-            grid = gpd.read_parquet(DATA_FOLDER / 'grid.parquet')
-            grid = grid.to_crs('EPSG:4326')
-            st.session_state['data_Finland'] = grid
+    # Check if data for Finland has already been loaded to session state, and that it is the current version
+    with st.spinner(text="Loading data..."), span(3, 'read_data') as current:
+        grid = read_dataset('grid')
+        current.rows = len(grid)
+    if st.session_state.get('data_Finland') is not grid:
+        st.session_state['data_Finland'] = grid
+    # Mark the grid used, so that it is evicted from the session state only after it has been left idle
+    track('data_Finland')
 
-    municipalities = pd.read_csv(DATA_FOLDER / 'unique_mncplty.csv')
+    municipalities = read_dataset('municipality_names')
 
     municipalities = municipalities['mncplty'].unique()
 
@@ -59,81 +101,294 @@ def filter_and_create_charts(municipalities):
         municipalities: a list containing names of Finnish municipalities, used for user selection
 
     Returns:
-        m: returns a Folium map object containing the filtered data of the selected area
-        None: In case area is not selected, nothing is returned, assuring right functionality in main()
+        html: returns the rendered Folium map containing the filtered data of the selected area, None in case area is not selected
+        summary: the distribution statistics of the selected field in the selected area (see grid_stats.build_statistics), None for the other indicators
     """
     
     col1, col2 = st.columns([1, 1])
+    # The selection can be given in the query parameters of the URL
+    params = initial_params(3)
+    modes = ('','Public transport + 1 000 m walk', 'Bicycle')
+    indicators = (CUMULATIVE_INDICATOR, E2SFCA_INDICATOR, DISTANCE_INDICATOR, REACHABILITY_INDICATOR, EXPRESSION_INDICATOR)
+    opportunity_types = ("", *OPPORTUNITY_ABBREVIATIONS)
+    travel_times = ("30 min", "45 min", "60 min")
 
     with col1:
-        selected_municipality = st.selectbox('Select area of interest:', municipalities,)
-        selected_mode = st.selectbox('Select mode:', ('','Public transport + 1 000 m walk', 'Bicycle'))
+        selected_municipality = st.selectbox('Select area of interest:', municipalities, index=option_index(params, 'area', municipalities))
+        selected_mode = st.selectbox('Select mode:', modes, index=option_index(params, 'mode', modes))
+        indicator = st.radio('Select indicator:', indicators, index=option_index(params, 'indicator', indicators), horizontal = True,
+                             help='Competition-adjusted access (enhanced two-step floating catchment area) divides each facility between the residents within its catchment and shows the number of facilities per 1 000 residents. The distance to the nearest opportunity is measured in a straight line from the center of each cell, for comparison with the travel time based indicators, and does not depend on the mode. Reachability shows the opportunities that can be reached from a location within the cut-off, or the cells from which the opportunity nearest to it can be reached. A derived indicator is calculated from the access fields with a formula.')
 
     with col2:
-        opportunity_type = st.selectbox("Select opportunity type:", ("","Pharmacy", "Grocery store", "Library", "Public sports facility", "School", "Healthcare", "Jobs"))
-        travel_time = st.radio("Select travel time cut-off:", ("30 min", "45 min", "60 min"), horizontal = True)
-        use_same_intervals = st.checkbox('Use the 60 minute class intervals for all cut-offs', True)
+        opportunity_type = st.selectbox("Select opportunity type:", opportunity_types, index=option_index(params, 'type', opportunity_types))
+        travel_time = st.radio("Select travel time cut-off:", travel_times, index=option_index(params, 'time', travel_times), horizontal = True)
+        use_same_intervals = st.checkbox('Use the 60 minute class intervals for all cut-offs', flag_value(params, 'same_intervals', True))
+        classification_label = st.radio('Classification:', tuple(CLASSIFICATIONS), index=option_index(params, 'classification', CLASSIFICATIONS), horizontal = True, disabled = indicator != CUMULATIVE_INDICATOR,
+                                        help='Equal intervals divide the range from 0 to the largest value into six equally wide classes. Quantiles put an equal number of cells with access into each class, and natural breaks group similar values together. The other indicators use equal intervals.')
+        classification = CLASSIFICATIONS[classification_label]
+        what_if = st.checkbox('What-if scenario', disabled = indicator != CUMULATIVE_INDICATOR,
+                              help='Open or close facilities and see how the number of accessible opportunities changes. The scenario is kept when moving to page 4.')
+
+    if indicator == EXPRESSION_INDICATOR:
+        expression = st.text_input('Formula of the derived indicator:', text_value(params, 'formula', 'JL_tyo60 - PP_tyo60'),
+                                   help='Access fields are named by mode (JL = public transport, PP = bicycle), opportunity type (aptk = pharmacy, ruok = grocery store, kirja = library, lahi = public sports facility, koul = school, sair = healthcare, tyo = jobs) and travel time cut-off, e.g. JL_ruok30. Fields can be combined with numbers, + - * / and parentheses, and the functions abs, min and max, e.g. JL_tyo60 - PP_tyo60 (public transport minus bicycle access) or JL_ruok30 / JL_ruok60 (share of the grocery stores reachable in 60 minutes that are reachable in 30 minutes).')
+        share(area=selected_municipality, indicator=indicator, formula=expression)
+        if selected_municipality and expression and 'data_Finland' in st.session_state:
+            return create_expression_map(st.session_state['data_Finland'], selected_municipality, expression), None
+        return None, None
+
+    share(area=selected_municipality, mode=selected_mode, indicator=indicator, type=opportunity_type, time=travel_time,
+          same_intervals=use_same_intervals, classification=classification_label)
 
     # Check if all required values have been selected by the user and the grid data has been loaded into session state
-    if selected_municipality and selected_mode and opportunity_type and 'data_Finland' in st.session_state:
+    # The straight-line distance does not depend on the mode
+    if selected_municipality and (selected_mode or indicator == DISTANCE_INDICATOR) and opportunity_type and 'data_Finland' in st.session_state:
         # Splits the value from 'min' in the user selection
         travel_time_value = travel_time.split()[0]
         # Based on selection, map the selected mode to the corresponding abbreviation in the access data field name
         mode_abbreviation = 'JL' if selected_mode == 'Public transport + 1 000 m walk' else 'PP'
         # Map the selected opportunity type to the corresponding abbreviation in the access data field name
-        opportunity_type_abbreviation = {
-            'Pharmacy': 'aptk',
-            'Grocery store': 'ruok',
-            'Library': 'kirja',
-            'Public sports facility': 'lahi',
-            'School': 'koul',
-            'Healthcare': 'sair',
-            'Jobs': 'tyo'
-        }[opportunity_type]
+        opportunity_type_abbreviation = OPPORTUNITY_ABBREVIATIONS[opportunity_type]
+
+        if indicator == E2SFCA_INDICATOR and opportunity_type_abbreviation not in OPPORTUNITY_TYPES:
+            st.warning(f"Competition-adjusted access is not available for {opportunity_type.lower()}.")
+            return None, None
+        if indicator in (DISTANCE_INDICATOR, REACHABILITY_INDICATOR) and opportunity_type_abbreviation not in OPPORTUNITY_TYPES:
+            st.warning(f"The {indicator.lower()} is not available for {opportunity_type.lower()}.")
+            return None, None
+
+        # Retrieve the loaded data from session state
+        grid = st.session_state['data_Finland']
+        if indicator == REACHABILITY_INDICATOR:
+            direction = st.radio('Show:', DIRECTIONS, horizontal = True)
+            latitude, longitude = location_inputs(grid, selected_municipality)
+            return create_reachability_map(grid, mode_abbreviation, opportunity_type, opportunity_type_abbreviation, travel_time_value, direction, longitude, latitude), None
+        if indicator != CUMULATIVE_INDICATOR:
+            classification = 'equal'
+        scenario = ()
+        if what_if and indicator == CUMULATIVE_INDICATOR:
+            area = grid if selected_municipality == 'Finland' else grid[grid['mncplty'] == selected_municipality]
+            x0, y0, x1, y1 = area.total_bounds
+            scenario = scenario_editor(3, (y0 + y1) / 2, (x0 + x1) / 2)
+
+        def build():
+            return render_map(grid, selected_municipality, mode_abbreviation, opportunity_type, opportunity_type_abbreviation, travel_time_value, use_same_intervals, indicator, classification, scenario)
+
+        # The map of a selection is built once and shared by all sessions
+        key = (3, 'map', selected_municipality, mode_abbreviation, opportunity_type_abbreviation, travel_time_value, use_same_intervals, indicator, classification, scenario)
+        if indicator == DISTANCE_INDICATOR:
+            key = (3, 'map', selected_municipality, opportunity_type_abbreviation, indicator)
+            html = selection_map(3, key, build, datasets=('grid', 'opportunities'))
+        else:
+            html = selection_map(3, key, build, datasets=('grid', 'opportunities', TTM_DATASETS[mode_abbreviation]))
+        if html is None:
+            st.warning(f"No data available for {selected_municipality}.")
+            return None, None
+        if indicator == DISTANCE_INDICATOR:
+            show_nearest(grid, selected_municipality, opportunity_type, opportunity_type_abbreviation)
+        summary = None
+        if scenario:
+            # The precomputed statistics describe the current facilities, so the change of the scenario is described instead
+            delta = scenario_delta(scenario, mode_abbreviation, opportunity_type_abbreviation, travel_time_value, len(grid))
+            changed = delta != 0
+            population = grid[POPULATION_COLUMN].to_numpy()[changed].sum() if POPULATION_COLUMN in grid.columns else 0
+            if changed.any():
+                st.markdown(f'The scenario changes the number of accessible {opportunity_type.lower()}(s) of **{changed.sum()}** cells with {population:,.0f} residents, by {delta[changed].min():+d} to {delta[changed].max():+d}.')
+            else:
+                st.markdown(f'The scenario does not change the number of accessible {opportunity_type.lower()}(s) within {travel_time_value} minutes.')
+        elif indicator == CUMULATIVE_INDICATOR:
+            summary = statistics(selected_municipality, f'{mode_abbreviation}_{opportunity_type_abbreviation}{travel_time_value}')
+        return html, summary
+    else:
+        return None, None
 
-        zoom_level, bins, mode_column, filtered_grid = select_columns(travel_time_value, mode_abbreviation, opportunity_type_abbreviation, selected_municipality, use_same_intervals)
 
-        # Filter the grid data based on the selected mode, opportunity type, and travel time cut-off
-        filtered_grid = filtered_grid[filtered_grid[mode_column] > 0]
+    
 
-        # Select only the necessary columns
-        filtered_grid = filtered_grid[[mode_column, 'mncplty', 'geometry']]
+def render_map(grid, selected_municipality, mode_abbreviation, opportunity_type, opportunity_type_abbreviation, travel_time_value, use_same_intervals, indicator, classification='equal', scenario=()):
+    """
+    Builds and renders the map of a selection of the cumulative or competition-adjusted access, used by the page and the static export
 
-        if filtered_grid.empty:
-            st.warning(f"No data available for {selected_municipality}.")
-            return None
+    Args:
+        grid: the national access data
+        selected_municipality: the selected area of interest (municipality or Finland)
+        mode_abbreviation: abbreviation of the mode in the access fields (JL or PP)
+        opportunity_type: name of the opportunity type, used in the caption
+        opportunity_type_abbreviation: abbreviation of the opportunity type in the access fields
+        travel_time_value: travel time cut-off (30, 45 or 60)
+        use_same_intervals: Boolean value, if True uses 60 minute class intervals no matter the travel time selected
+        indicator: CUMULATIVE_INDICATOR, E2SFCA_INDICATOR or DISTANCE_INDICATOR
+        classification: 'equal', 'quantile' or 'jenks' (see grid_stats.class_breaks)
+        scenario: changes of the what-if scenario applied to the cumulative access (see scenarios.current_scenario)
+
+    Returns:
+        html: the rendered Folium map (see metrics.map_html), None if no cell of the area has access
+    """
+    with span(3, 'filter', rows=len(grid)):
+        zoom_level, bins, mode_column, filtered_grid = select_columns(grid, travel_time_value, mode_abbreviation, opportunity_type_abbreviation, selected_municipality, use_same_intervals, classification)
+    caption = f'Number of accessible {opportunity_type.lower()}(s)'
+
+    if scenario:
+        with span(3, 'scenario', rows=len(scenario)):
+            delta = pd.Series(scenario_delta(scenario, mode_abbreviation, opportunity_type_abbreviation, travel_time_value, len(grid)), index=grid.index)
+            filtered_grid = filtered_grid.assign(**{mode_column: (filtered_grid[mode_column].fillna(0) + delta.loc[filtered_grid.index]).clip(lower=0).to_numpy()})
+        caption = f'{caption} (scenario)'
+
+    if indicator == E2SFCA_INDICATOR:
+        with st.spinner(text="Calculating competition-adjusted access..."), span(3, 'e2sfca', rows=len(filtered_grid)):
+            bins, mode_column, filtered_grid = add_e2sfca_column(grid, travel_time_value, mode_abbreviation, opportunity_type_abbreviation, filtered_grid, use_same_intervals)
+        caption = f'{opportunity_type}(s) per 1 000 residents (E2SFCA)'
+
+    if indicator == DISTANCE_INDICATOR:
+        with span(3, 'nearest', rows=len(filtered_grid)):
+            bins, mode_column, filtered_grid = add_distance_column(grid, opportunity_type_abbreviation, filtered_grid)
+        caption = f'Distance to the nearest {opportunity_type.lower()} (km)'
+
+    # The 1 km cells are too small to be seen at the national zoom level, so means of larger cells are drawn
+    filtered_grid, caption = coarsen_national(filtered_grid, mode_column, selected_municipality, zoom_level, caption, stored=not scenario)
+
+    # Filter the grid data based on the selected mode, opportunity type, and travel time cut-off
+    filtered_grid = filtered_grid[filtered_grid[mode_column] > 0]
 
+    # Select only the necessary columns
+    filtered_grid = filtered_grid[[column for column in (mode_column, 'mncplty', 'geometry') if column in filtered_grid.columns]]
 
-        # Calculate the centroid of the selected municipality's geometry so that map gets to the location of the points
+    if filtered_grid.empty:
+        return None
+
+
+    # Calculate the centroid of the selected municipality's geometry so that map gets to the location of the points
+    with span(3, 'unary_union', rows=len(filtered_grid)):
         centroid = filtered_grid.geometry.unary_union.centroid
 
-        # Create a new Folium map centered on the centroid of the selected municipality's geometry
+    # Create a new Folium map centered on the centroid of the selected municipality's geometry
+    m = folium.Map(location=[centroid.y, centroid.x], zoom_start=zoom_level, tiles="cartodbpositron")
+
+    # Reset the index of the filtered_grid DataFrame
+    filtered_grid = filtered_grid.reset_index()
+
+    with span(3, 'folium_geojson', rows=len(filtered_grid)):
+        m = create_map(m, bins, filtered_grid, caption, mode_column, classification)
+    # The maps of scenarios are kept out of the static folder, like the other maps of open-ended inputs
+    return map_html(m, 3, publish=not scenario)
+
+
+def create_expression_map(grid, selected_municipality, expression):
+    """
+    Creates a map of a derived indicator calculated from the access fields with a formula
+
+    Args:
+        grid: the national access data stored in session_state
+        selected_municipality: the selected area of interest (municipality or Finland)
+        expression: the formula typed by the user, e.g. JL_tyo60 - PP_tyo60
+
+    Returns:
+        html: the rendered Folium map, None if the formula is not valid or gives no values in the area
+    """
+    try:
+        _, expression = parse(expression, numeric_columns(grid))
+    except ValueError as error:
+        st.error(str(error))
+        return None
+
+    def build():
+        with span(3, 'expression', rows=len(grid)):
+            zoom_level, bins, mode_column, filtered_grid = select_expression(grid, expression, selected_municipality)
+        filtered_grid, caption = coarsen_national(filtered_grid, mode_column, selected_municipality, zoom_level, expression)
+        # Cells without a value or with a value of 0 are not drawn, like the cells without access
+        filtered_grid = filtered_grid[filtered_grid[mode_column].notna() & (filtered_grid[mode_column] != 0)]
+        filtered_grid = filtered_grid[[column for column in (mode_column, 'mncplty', 'geometry') if column in filtered_grid.columns]]
+        if filtered_grid.empty:
+            return None
+
+        with span(3, 'unary_union', rows=len(filtered_grid)):
+            centroid = filtered_grid.geometry.unary_union.centroid
         m = folium.Map(location=[centroid.y, centroid.x], zoom_start=zoom_level, tiles="cartodbpositron")
+        with span(3, 'folium_geojson', rows=len(filtered_grid)):
+            m = create_map(m, bins, filtered_grid.reset_index(), caption, mode_column)
+        return map_html(m, 3, publish=False)
+
+    html = cached((3, 'expression map', selected_municipality, expression), build, datasets=('grid',))
+    if html is None:
+        st.warning(f"The formula has no values in {selected_municipality}.")
+    return html
+
+
+def coarsen_national(filtered_grid, mode_column, selected_municipality, zoom_level, caption, stored=True):
+    """
+    Replaces the 1 km cells of the national view with the population-weighted means of the coarsest aggregated grid
+    that still looks detailed at the zoom level of the map. The municipal views keep the 1 km cells.
+
+    Args:
+        filtered_grid: the access data of the selected area with the displayed field, in the row order of the grid
+        mode_column: the displayed field
+        selected_municipality: the selected area of interest (municipality or Finland)
+        zoom_level: zoom level of the map
+        caption: the name of the displayed indicator
+        stored: Boolean value, False if the displayed field has been changed from the stored one (see grid_pyramid.coarsen)
 
-        # Reset the index of the filtered_grid DataFrame
-        filtered_grid = filtered_grid.reset_index()
+    Returns:
+        filtered_grid: the aggregated cells with the displayed field, or the given data for the municipal views
+        caption: the name of the indicator, with the cell size of the aggregated grid
+    """
+    size = level_for_zoom(zoom_level) if selected_municipality == 'Finland' else None
+    if size is None:
+        return filtered_grid, caption
+    with span(3, 'coarsen', rows=len(filtered_grid)):
+        return coarsen(filtered_grid, mode_column, size, stored), f'{caption} (mean of {size // 1000} km cells)'
+
+
+def select_expression(grid, expression, selected_municipality):
+    """
+    Adds the values of a derived indicator as a new field to the access data of the selected area. The values of
+    the whole grid are calculated once per formula and shared by all sessions.
+
+    Args:
+        grid: the national access data stored in session_state
+        expression: the normalized formula (see expressions.parse)
+        selected_municipality: the selected area of interest (municipality or Finland)
 
-        m = create_map(m, bins, filtered_grid, opportunity_type, mode_column)
-        return m
+    Returns:
+        zoom_level: zoom level of the map
+        bins: class limits from the smallest to the largest value in the area (from 0 if there are no negative values)
+        mode_column: name of the added field
+        filtered_grid: a copy of the access data of the area with the added field
+    """
+    values = cached(('expression', expression), lambda: evaluate(expression, grid), datasets=('grid',))
+
+    if selected_municipality != 'Finland':
+        filtered_grid = grid[grid['mncplty'] == selected_municipality]
+        zoom_level = 10
     else:
-        return None
+        filtered_grid = grid
+        zoom_level = 7
 
+    mode_column = 'derived'
+    filtered_grid = filtered_grid.assign(**{mode_column: pd.Series(values, index=grid.index).loc[filtered_grid.index].to_numpy()})
+
+    min_value = np.nanmin(filtered_grid[mode_column], initial=0)
+    max_value = np.nanmax(filtered_grid[mode_column], initial=0)
+    bins = list(np.linspace(min_value, max_value, 7))
+
+    return zoom_level, bins, mode_column, filtered_grid
 
-    
 
-def select_columns(travel_time_value, mode_abbreviation, opportunity_type_abbreviation, selected_municipality, use_same_intervals):
+def select_columns(grid, travel_time_value, mode_abbreviation, opportunity_type_abbreviation, selected_municipality, use_same_intervals, classification='equal', statistics_table=None):
     """
     Uses the combination of the mapped abbreviations (selected mode and opportunity type) and travel time to construct the right field name from the access data stored in session_state.
 
     Args:
+        grid: the national access data stored in session_state
         travel_time_value: contains the travel time value (mins) the user has selected (30, 45 or 60). Used to construct the field name that is used from access data
         mode_abbreviation: contains the abbreviation (in Finnish)  of transport mode the user has selected to view (JL or PP).
         opportunity_type_abbreviation: contains the abbreviation (in Finnish) of opportunity type the user has selected (aptk, ruok, kirja, lahi, koul, sair or tyo)  
         use_same_intervals: Boolean value, if True uses 60 minute class intervals no matter the travel time selected. Makes more consistent comparisons across travel times.
+        classification: 'equal', 'quantile' or 'jenks' (see grid_stats.class_breaks)
+        statistics_table: statistics table of the grid (see grid_stats.build_statistics), the one of the shared grid by default
 
     Returns:
         zoom_level: returns appropriate zoom level, based on if the user has selected 'Finland' or a particular municipality
-        bins: contains the bin levels that are calculated based on the max_value of the selected field or in case the user has selected use_same_intervals, selects the 60 minute bin alternative
+        bins: contains the class limits of the selected field or in case the user has selected use_same_intervals, of the 60 minute field, read from the precomputed statistics of the area
         mode_column: is the field name that is selected from the access data, constructed with abbreviations mapped from user selections + selected travel time
         filtered_grid: contains the access data for the selected municipality/area
 
@@ -141,9 +396,7 @@ def select_columns(travel_time_value, mode_abbreviation, opportunity_type_abbrev
     
     # Construct the field name based on the selected values
     mode_column = f'{mode_abbreviation}_{opportunity_type_abbreviation}{travel_time_value}'
-    
-    # Retrieve the loaded data from session state
-    grid = st.session_state['data_Finland']
+
     # Filter the grid data based on the selected municipality
     if selected_municipality != 'Finland':
         filtered_grid = grid[grid['mncplty'] == selected_municipality]
@@ -152,24 +405,178 @@ def select_columns(travel_time_value, mode_abbreviation, opportunity_type_abbrev
         filtered_grid = grid
         zoom_level = 7
 
-    if use_same_intervals:
-        # Calculate the maximum value of the 60-minute column for appropriate class bins
-        max_value = filtered_grid[f'{mode_abbreviation}_{opportunity_type_abbreviation}60'].max()
+    # The class limits of the 60-minute column or the selected column are looked up instead of scanning the cells
+    bins_column = f'{mode_abbreviation}_{opportunity_type_abbreviation}60' if use_same_intervals else mode_column
+    bins = class_breaks(selected_municipality, bins_column, classification, statistics_table)
+
+    return zoom_level, bins, mode_column, filtered_grid
+
+
+def add_e2sfca_column(grid, travel_time_value, mode_abbreviation, opportunity_type_abbreviation, filtered_grid, use_same_intervals):
+    """
+    Adds the competition-adjusted (E2SFCA) accessibility of the selected combination as a new field to the filtered access data.
+
+    Args:
+        grid: the national access data stored in session_state
+        travel_time_value: contains the travel time value (mins) the user has selected (30, 45 or 60)
+        mode_abbreviation: contains the abbreviation (in Finnish) of transport mode the user has selected to view (JL or PP)
+        opportunity_type_abbreviation: contains the abbreviation (in Finnish) of opportunity type the user has selected
+        filtered_grid: contains the access data for the selected municipality/area
+        use_same_intervals: Boolean value, if True uses 60 minute class intervals no matter the travel time selected
+
+    Returns:
+        bins: contains the bin levels that are calculated based on the max_value of the E2SFCA field
+        mode_column: is the name of the added E2SFCA field
+        filtered_grid: a copy of the access data with the added E2SFCA field
+    """
+    grid_index = grid.index
 
-        # Define the bins based on the maximum value
-        bins = [0, max_value / 6, max_value / 3, max_value / 2, 2 * max_value / 3, 5 * max_value / 6, max_value]
+    mode_column = f'{mode_abbreviation}_{opportunity_type_abbreviation}{travel_time_value}_e2sfca'
+    access = pd.Series(e2sfca_indicator(mode_abbreviation, opportunity_type_abbreviation, travel_time_value), index=grid_index)
+    filtered_grid = filtered_grid.assign(**{mode_column: access.loc[filtered_grid.index].to_numpy()})
+
+    if use_same_intervals:
+        # Calculate the maximum value of the 60-minute E2SFCA for appropriate class bins
+        max_value = pd.Series(e2sfca_indicator(mode_abbreviation, opportunity_type_abbreviation, '60'), index=grid_index).loc[filtered_grid.index].max()
     else:
-        # Calculate the maximum value of the selected travel time cut-off column for appropriate class bins
         max_value = filtered_grid[mode_column].max()
 
-        # Define the bins based on the maximum value
-        bins = [0, max_value / 6, max_value / 3, max_value / 2, 2 * max_value / 3, 5 * max_value / 6, max_value]
+    # Define the bins based on the maximum value
+    bins = [0, max_value / 6, max_value / 3, max_value / 2, 2 * max_value / 3, 5 * max_value / 6, max_value]
+
+    return bins, mode_column, filtered_grid
 
-    return zoom_level, bins, mode_column, filtered_grid
 
+def add_distance_column(grid, opportunity_type_abbreviation, filtered_grid):
+    """
+    Adds the straight-line distance to the nearest opportunity of the selected type as a new field to the filtered access data.
+
+    Args:
+        grid: the national access data stored in session_state
+        opportunity_type_abbreviation: contains the abbreviation (in Finnish) of opportunity type the user has selected
+        filtered_grid: contains the access data for the selected municipality/area
+
+    Returns:
+        bins: equal intervals from 0 to the largest distance in the area
+        mode_column: is the name of the added distance field
+        filtered_grid: a copy of the access data with the added distance field
+    """
+    mode_column = f'{opportunity_type_abbreviation}_distance'
+    distance = pd.Series(distance_indicator(opportunity_type_abbreviation), index=grid.index)
+    filtered_grid = filtered_grid.assign(**{mode_column: distance.loc[filtered_grid.index].to_numpy()})
+
+    max_value = filtered_grid[mode_column].replace(np.inf, np.nan).max()
+    bins = list(np.linspace(0, max_value, 7))
 
+    return bins, mode_column, filtered_grid
 
-def create_map(m, bins, filtered_grid, opportunity_type, mode_column):
+
+def location_inputs(grid, selected_municipality, columns=2):
+    """
+    Asks for the coordinates of a location, which is the center of the selected area by default
+
+    Args:
+        grid: the national access data stored in session_state
+        selected_municipality: the selected area of interest (municipality or Finland)
+        columns: number of columns of the row of inputs, the ones after the coordinates are returned for other inputs
+
+    Returns:
+        latitude: latitude of the location
+        longitude: longitude of the location
+        other_columns: the remaining columns of the row, only returned when there are more than 2 columns
+    """
+    area = grid if selected_municipality == 'Finland' else grid[grid['mncplty'] == selected_municipality]
+    x0, y0, x1, y1 = area.total_bounds
+    row = st.columns([1] * columns)
+    with row[0]:
+        latitude = st.number_input('Latitude of the location:', -90.0, 90.0, round((y0 + y1) / 2, 4), format='%.4f', key=f'latitude {selected_municipality}')
+    with row[1]:
+        longitude = st.number_input('Longitude of the location:', -180.0, 180.0, round((x0 + x1) / 2, 4), format='%.4f', key=f'longitude {selected_municipality}')
+    if columns > 2:
+        return latitude, longitude, row[2:]
+    return latitude, longitude
+
+
+def show_nearest(grid, selected_municipality, opportunity_type, opportunity_type_abbreviation):
+    """
+    Lists the nearest opportunities of the selected type to a location, which is the center of the selected area by default
+
+    Args:
+        grid: the national access data stored in session_state
+        selected_municipality: the selected area of interest (municipality or Finland)
+        opportunity_type: name of the selected opportunity type
+        opportunity_type_abbreviation: abbreviation of the opportunity type in the access fields
+    """
+    latitude, longitude, (col3,) = location_inputs(grid, selected_municipality, columns=3)
+    with col3:
+        radius = st.number_input('Radius (km):', 0.5, 100.0, 5.0, step=0.5)
+    with span(3, 'nearest_query'):
+        table, count = nearest_table(longitude, latitude, opportunity_type_abbreviation, radius=radius * 1000)
+    st.markdown(f'**{count}** {opportunity_type.lower()}(s) within {radius:g} km of the location, the nearest in a straight line:')
+    st.dataframe(table, hide_index=True)
+
+
+def create_reachability_map(grid, mode_abbreviation, opportunity_type, opportunity_type_abbreviation, travel_time_value, direction, longitude, latitude):
+    """
+    Creates a map of the opportunities that can be reached from the grid cell of a location within the travel time cut-off,
+    or of the grid cells from which the opportunity nearest to the location can be reached. Both are looked up from the
+    travel time matrix stored by origin and by destination (see reachability.travel_time_store).
+
+    Args:
+        grid: the national access data stored in session_state
+        mode_abbreviation: abbreviation of the mode in the access fields (JL or PP)
+        opportunity_type: name of the selected opportunity type
+        opportunity_type_abbreviation: abbreviation of the opportunity type in the access fields
+        travel_time_value: travel time cut-off (30, 45 or 60)
+        direction: one of DIRECTIONS
+        longitude: longitude of the location
+        latitude: latitude of the location
+
+    Returns:
+        html: the rendered Folium map (see metrics.map_html)
+    """
+    cutoff = int(travel_time_value)
+    opportunities = read_dataset('opportunities')
+    selected = (opportunities['opprtnt'] == OPPORTUNITY_TYPES[opportunity_type_abbreviation]).to_numpy()
+    fill_color = cm.LinearColormap(["#573980", "#704D9E", "#D868A3", "#ED7C97", "#F9B282", "#F3E79A"], vmin=0, vmax=cutoff)
+    fill_color.caption = 'Travel time (min)'
+    m = folium.Map(location=[latitude, longitude], zoom_start=10, tiles="cartodbpositron")
+
+    if direction == DIRECTIONS[0]:
+        cell = nearest_cell(longitude, latitude)
+        with span(3, 'reachability', rows=1):
+            rows, times = reachable_opportunities(mode_abbreviation, cell, cutoff)
+        keep = selected[rows]
+        rows, times = rows[keep], times[keep]
+        CompactGeoJson(grid.iloc[[cell]], 3, style_function=lambda feature: {'color': '#000000', 'weight': 2, 'fillOpacity': 0}).add_to(m)
+        for row, time in zip(rows, times):
+            point = opportunities.geometry.iloc[row]
+            folium.CircleMarker([point.y, point.x], radius=6, color=fill_color(time), fill=True, fill_opacity=0.9,
+                                tooltip=f"{opportunities['name'].iloc[row]}: {time} min").add_to(m)
+        st.markdown(f'**{len(rows)}** {opportunity_type.lower()}(s) can be reached from the cell of the location within {cutoff} minutes.')
+    else:
+        distances, found = nearest([projected_location(longitude, latitude)], opportunity_type_abbreviation)
+        opportunity = found[0, 0]
+        if opportunity < 0:
+            return None
+        with span(3, 'reachability', rows=1):
+            rows, times = reaching_cells(mode_abbreviation, opportunity, cutoff)
+        cells = grid.iloc[rows][['geometry']].assign(minutes=times)
+        if not cells.empty:
+            CompactGeoJson(cells, 3, properties=['minutes'], style_function=lambda feature: {
+                'fillColor': fill_color(feature['properties']['minutes']), 'fillOpacity': 0.7, 'weight': 0
+            }).add_child(folium.features.GeoJsonTooltip(fields=['minutes'], aliases=['Travel time (min)'])).add_to(m)
+        point = opportunities.geometry.iloc[opportunity]
+        folium.Marker([point.y, point.x], tooltip=opportunities['name'].iloc[opportunity]).add_to(m)
+        population = grid[POPULATION_COLUMN].iloc[rows].sum() if POPULATION_COLUMN in grid.columns else None
+        reached = f' ({population:,.0f} residents)' if population is not None else ''
+        st.markdown(f"{opportunities['name'].iloc[opportunity]} ({distances[0, 0] / 1000:.1f} km from the location) can be reached from **{len(rows)}** cells{reached} within {cutoff} minutes.")
+
+    m.add_child(fill_color)
+    return map_html(m, 3, publish=False)
+
+
+def create_map(m, bins, filtered_grid, caption, mode_column, classification='equal'):
     """
     Adds choropleth layer to the initialized Folium map and adds tooltips
 
@@ -177,19 +584,29 @@ def create_map(m, bins, filtered_grid, opportunity_type, mode_column):
         m: Folium map base centered on Finland's or municipalities geometry
         bins: contains the bin levels that are calculated based on the max_value of the selected field or in case the user has selected use_same_intervals, selects the 60 minute bin alternative
         filtered_grid: contains the access data for the selected municipality/area and only for the selected mode/time/opportunity combination
+        caption: the name of the displayed indicator, used in tooltips and the legend
         mode_column: is the field name that is selected from the access data, constructed with abbreviations mapped from user selections + selected travel time
+        classification: 'equal' for a continuous color ramp, 'quantile' or 'jenks' for one color per class
 
     Returns:
         m: A folium map object with choropleth layer and tooltips
     """    
-    fill_color = cm.LinearColormap(
-    ["#F3E79A", "#F9B282", "#ED7C97", "#D868A3", "#704D9E", "#573980"],  
-    vmin=0, vmax=max(bins), 
-    index=[0, max(bins) / 5, 2 * max(bins) / 5, 3 * max(bins) / 5, 4 * max(bins) / 5, max(bins)] 
-    )
+    colors = ["#F3E79A", "#F9B282", "#ED7C97", "#D868A3", "#704D9E", "#573980"]
+    if classification == 'equal':
+        # The bins of derived indicators can start below 0
+        fill_color = cm.LinearColormap(
+        colors,
+        vmin=min(bins), vmax=max(bins), 
+        index=list(np.linspace(min(bins), max(bins), 6))
+        )
+    else:
+        # Quantile and natural break classes are not equally wide, so each class gets its own color
+        fill_color = cm.StepColormap(colors, index=bins, vmin=bins[0], vmax=bins[-1])
     
-    choropleth = folium.GeoJson(
+    choropleth = CompactGeoJson(
         filtered_grid,
+        3,
+        properties=[mode_column],
         style_function=lambda feature: {
             'fillColor': fill_color(feature['properties'][mode_column]),
             'fillOpacity': 0.7,
@@ -201,17 +618,45 @@ def create_map(m, bins, filtered_grid, opportunity_type, mode_column):
     choropleth.add_child(
         folium.features.GeoJsonTooltip(
             fields=[mode_column],
-            aliases=[f'Number of accessible {opportunity_type.lower()}(s)'],
+            aliases=[caption],
             localize=True
         )
     )
 
     # Add a color scale legend to the map
-    fill_color.caption = f'Number of accessible {opportunity_type.lower()}(s)'
+    fill_color.caption = caption
     m.add_child(fill_color)
 
     return m
 
+def show_summary(summary):
+    """
+    Shows the distribution statistics of the selected field in the selected area next to the map, the shares of the
+    population groups that can access at least a selected number of opportunities, and the rank of the municipality
+    among municipalities of the same size. All numbers are looked up from tables precomputed over the shared grid.
+
+    Args:
+        summary: a row of the precomputed statistics table (see grid_stats.build_statistics)
+    """
+    area, column = summary.name
+    st.markdown('##### Summary')
+    st.metric('Population-weighted mean', f"{summary['weighted_mean']:,.1f}",
+              help='Mean number of accessible opportunities of the residents of the area')
+    if not np.isnan(summary['q50']):
+        st.metric('Median of the cells with access', f"{summary['q50']:,.0f}")
+        st.metric('Range of the cells with access', f"{summary['q10']:,.0f} - {summary['q90']:,.0f}",
+                  help='10th to 90th percentile of the cells that can access at least one opportunity')
+    st.metric('Population without access', f"{summary['zero_population_share']:.1%}",
+              help=f"Share of the residents living in cells that cannot access any opportunity ({summary['zero_share']:.1%} of the cells)")
+    if not np.isnan(summary['rank']):
+        st.metric('Rank among comparable municipalities', f"{summary['rank']:.0f} / {summary['comparable']:.0f}",
+                  help=f"Rank by the population-weighted mean among the municipalities with {summary['size_class']} residents (1 = best access)")
+
+    threshold = st.selectbox('Population with at least (opportunities):', THRESHOLDS, format_func='{:,}'.format)
+    shares = population_shares(area, column, threshold)
+    if shares is not None and not shares.empty:
+        st.dataframe(shares.map('{:.1%}'.format).rename_axis('Population group').rename('Share').to_frame(), use_container_width=True)
+
 def responsive_to_window_width():
     """
     A function that sets the map object width according to window size
@@ -233,6 +678,18 @@ def add_description():
     <span style="font-size: 18px;"> The data on this page has been created by using the accessibility function of [R5R](https://github.com/ipeaGIT/r5r) to generate cumulative accessibility metrics between the central coordinates of the
     [Finnish population grid](https://www.stat.fi/tup/ruututietokanta/index_en.html) and coordinates of different opportunity types. 
     Cumulative metrics have been calculated for three different travel time thresholds (30, 45 and 60 minutes). For more info about the distribution of opportunities, see page <b>1. Spatial distribution of opportunities</b> 🌍.
+    <br><br>
+    The competition-adjusted access is calculated with the enhanced two-step floating catchment area method (E2SFCA, Luo & Qi 2009) from the R5R travel time matrix between the grid cells and the facilities. First, each facility is divided between the population living within its catchment, and then the facility-to-population ratios of all facilities within the catchment of a grid cell are summed. Travel times within the first, second and last third of the cut-off are weighted with 1, 0.68 and 0.22, respectively.
+    <br><br>
+    The distance to the nearest opportunity is the straight-line distance from the center of each grid cell to the closest facility of the selected type, found with a KD-tree of the facilities. Comparing it with the travel time based indicators shows where the transport network makes facilities harder to reach than their distance suggests. With this indicator, the nearest facilities to any location and their number within a radius are also listed.
+    <br><br>
+    In a what-if scenario, facilities can be opened or closed. The number of accessible opportunities of the grid cells is updated by the travel times of the changed facilities only. A new facility is reached like the existing facility nearest to it, as travel times are only available for the existing facilities. The same scenario shows the change of the Palma ratios on page <b>4. Measuring equity of access</b> 📏.
+    <br><br>
+    The reachability view looks up the facilities that can be reached from the grid cell of a location within the selected cut-off, or the grid cells from which the facility nearest to the location can be reached, from the R5R travel time matrix stored both by grid cell and by facility.
+    <br><br>
+    Derived indicators combine the cumulative access fields with a formula, e.g. the difference between public transport and bicycle access or the share of the opportunities reachable within 60 minutes that are reachable within 30 minutes. Cells where the formula gives 0 or has no value (division by 0) are not shown.
+    <br><br>
+    The maps of the cumulative access can be classified with equal intervals, quantiles or natural breaks (Jenks). The quantiles and natural breaks are calculated from the cells that can access at least one opportunity, and the natural breaks from 64 quantiles of each distribution. The summary next to the map shows the population-weighted mean of the selected area, the median and the 10th to 90th percentile range of the cells with access, the share of the residents who cannot access any opportunity within the travel time cut-off, and the shares of the total population and of its age groups who can access at least the selected number of opportunities. On the map of Finland, the 1 km cells are aggregated to 10 km cells that show the population-weighted mean of the 1 km cells, while the maps of municipalities show the 1 km cells. Municipalities are ranked by the population-weighted mean against the municipalities of the same population size class (under 5 000, 5 000-10 000, 10 000-20 000, 20 000-50 000, 50 000-100 000 and over 100 000 residents).
     </span>
     <br><br>
     <b style="font-size: 18px;">For cycling the following parameters were used:</b><br>
@@ -267,12 +724,20 @@ def add_description():
 
 def main():
     set_page()
+    preload()
     municipalities = read_data()
     responsive_to_window_width()
-    m = filter_and_create_charts(municipalities)
-    if m is not None:
+    html, summary = filter_and_create_charts(municipalities)
+    if html is not None and summary is not None:
+        # Show the summary of the distribution next to the map
+        map_column, summary_column = st.columns([3, 1])
+        with map_column, st.spinner(text="Loading map..."):
+            show_map(html, height=800)
+        with summary_column:
+            show_summary(summary)
+    elif html is not None:
         with st.spinner(text="Loading map..."):
-            folium_static(m, height=800)
+            show_map(html, height=800)
     else:
         st.warning('Please select area of interest, mode of transportation, and opportunity type')
     add_description()
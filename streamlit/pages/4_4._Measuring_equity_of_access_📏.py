@@ -1,11 +1,40 @@
 import streamlit as st
 from streamlit.components.v1 import html
-import geopandas as gpd
 import folium
 import numpy as np
-from streamlit_folium import folium_static
 import branca.colormap as cm
-from pages.utils import DATA_FOLDER, IMG_FOLDER
+from pages.utils import IMG_FOLDER
+from pages.utils.inequality import inequality
+from pages.utils.fca import OPPORTUNITY_TYPES, TTM_DATASETS, municipal_e2sfca
+from pages.utils.compute_cache import cached
+from pages.utils.data_store import preload
+from pages.utils.layers import CompactGeoJson
+from pages.utils.metrics import map_html, show_map, span
+from pages.utils.query import flag_value, initial_params, option_index, share
+from pages.utils.scenarios import scenario_editor, scenario_palma
+from pages.utils.shared_data import read_dataset
+from pages.utils.static_assets import selection_map
+
+# Opportunity types of the Palma ratios and their abbreviations in the field names, in the order of the selectbox
+OPPORTUNITY_ABBREVIATIONS = {
+    'School': 'koul',
+    'Pharmacy': 'aptk',
+    'Grocery store': 'ruok',
+    'Library': 'kirja',
+    'Healthcare': 'sair',
+    'Jobs': 'tyo',
+    'Outdoor sports facilities': 'lahi'
+}
+
+# Inequality measures of the map and the ranking: the Palma ratios of the dataset and the measures calculated from the
+# grid (see inequality.MEASURES)
+MEASURES = {
+    'Palma ratio': None,
+    'Gini index': 'gini',
+    'Theil index': 'theil',
+    'Concentration index': 'concentration',
+    '20/20 ratio': 'ratio_20_20'
+}
 
 def set_page():
     """
@@ -35,45 +64,46 @@ def read_data():
     """
     Reads and reprojects palma data
     """
-    data = gpd.read_file(DATA_FOLDER / 'palma_null.gpkg')
-    palma = data.to_crs('EPSG:4326')
+    with span(4, 'read_data') as current:
+        palma = read_dataset('palma')
+        current.rows = len(palma)
     return palma
 
 def filter_and_create_charts(palma):
     """
-    Filters palma data and creates a folium map object.
+    Filters palma data and creates a folium map and a ranking table.
 
     Args:
         palma: palma ratio data created by the accessibility function of the accessibility R-package
 
     Returns:
-        m: A folium map object
-        filtered_palma: a subset where 0, inf and NAN occurances have been removed
-        mode_column: contains the user selection, which mode to look at
+        html: the rendered folium map
+        df: the ranking table of municipalities, with competition-adjusted access (E2SFCA) if selected
     """
     col1, col2 = st.columns([1, 1])
+    # The selection can be given in the query parameters of the URL
+    params = initial_params(4)
+    modes = ('Bicycle','Public transport + 1 000 m walk')
+    travel_times = ("30 min", "45 min", "60 min")
+    opportunity_types = tuple(OPPORTUNITY_ABBREVIATIONS)
 
     with col1:
-        selected_mode = st.selectbox('Select mode', ('Bicycle','Public transport + 1 000 m walk'))
-        travel_time = st.radio("Select travel time cut-off:", ("30 min", "45 min", "60 min"), horizontal = True)
+        selected_mode = st.selectbox('Select mode', modes, index=option_index(params, 'mode', modes))
+        travel_time = st.radio("Select travel time cut-off:", travel_times, index=option_index(params, 'time', travel_times), horizontal = True)
+        measure = st.radio('Select inequality measure:', tuple(MEASURES), index=option_index(params, 'measure', MEASURES), horizontal = True,
+                           help='The Gini and Theil indices measure the inequality of access between all residents of a municipality, whatever their income. The concentration index measures how much better (positive) or worse (negative) access the residents with higher income have, and the 20/20 ratio divides the mean access of the 20 % with the highest income by that of the 20 % with the lowest.')
     with col2:
-        opportunity_type = st.selectbox("Select opportunity type:", ("School", "Pharmacy", "Grocery store", "Library", "Healthcare", "Jobs", "Outdoor sports facilities"))
-        
+        opportunity_type = st.selectbox("Select opportunity type:", opportunity_types, index=option_index(params, 'type', opportunity_types))
+        show_e2sfca = st.checkbox('Show competition-adjusted access (E2SFCA) in the ranking', flag_value(params, 'e2sfca'), help='Population weighted mean of the number of facilities per 1 000 residents, when each facility is divided between the residents within its catchment. Not available for jobs.')
+        what_if = st.checkbox('What-if scenario', help='Open or close facilities and see how the Palma ratios of the affected municipalities change. The scenario is shared with page 3.')
+    share(mode=selected_mode, time=travel_time, type=opportunity_type, e2sfca=show_e2sfca, measure=measure)
 
     # Map the selected mode to the corresponding abbreviation in the field name
     mode_abbreviation = 'jl' if selected_mode == 'Public transport + 1 000 m walk' else 'pp'
 
     if selected_mode and opportunity_type:
         # Map the selected opportunity type to the corresponding abbreviation in the field name
-        opportunity_type_abbreviation = {
-            'Pharmacy': 'aptk',
-            'Grocery store': 'ruok',
-            'Library': 'kirja',
-            'School': 'koul',
-            'Healthcare': 'sair',
-            'Jobs': "tyo",
-            'Outdoor sports facilities': 'lahi'
-        }[opportunity_type]
+        opportunity_type_abbreviation = OPPORTUNITY_ABBREVIATIONS[opportunity_type]
 
         # Map the selected travel time cut-off to the corresponding value in the field name
         travel_time_value = travel_time.split()[0]
@@ -82,20 +112,121 @@ def filter_and_create_charts(palma):
         # Count the total number of missing values in the palma DataFrame
 
  
-        # Select the mode_column, kunta, vuosi, nimi, namn, name, and geometry columns from the palma DataFrame
+        responsive_to_window_width()
+
+        if what_if:
+            x0, y0, x1, y1 = palma.total_bounds
+            scenario = scenario_editor(4, (y0 + y1) / 2, (x0 + x1) / 2)
+            if scenario:
+                show_scenario(scenario, mode_abbreviation, opportunity_type, opportunity_type_abbreviation, travel_time_value)
+
+        def build_map():
+            return render_measure_map(palma, mode_abbreviation, opportunity_type, opportunity_type_abbreviation, travel_time_value, measure)
+
+        def build_ranking():
+            return ranking(palma, mode_abbreviation, opportunity_type_abbreviation, travel_time_value, show_e2sfca, measure)
+
+        # The map and table of a selection are built once and shared by all sessions, and the map file of a selection
+        # is looked up before the map is built
+        html = selection_map(4, (4, 'map', mode_column, measure), build_map, datasets=('palma', 'grid'))
+        df = cached((4, 'ranking', mode_column, show_e2sfca and opportunity_type_abbreviation in OPPORTUNITY_TYPES, measure), build_ranking,
+                    datasets=('palma', 'grid', 'opportunities', TTM_DATASETS[mode_abbreviation.upper()]))
+        return html, df
+    else:
+        return None
+    
+def render_map_and_ranking(palma, mode_abbreviation, opportunity_type, opportunity_type_abbreviation, travel_time_value, show_e2sfca=False, measure='Palma ratio'):
+    """
+    Builds and renders the Palma ratio map and the ranking table of a selection, used by the page and the static export
+
+    Args:
+        palma: palma ratio data
+        mode_abbreviation: abbreviation of the mode in the field names (jl or pp)
+        opportunity_type: name of the opportunity type, used in the tooltips
+        opportunity_type_abbreviation: abbreviation of the opportunity type in the field names
+        travel_time_value: travel time cut-off (30, 45 or 60)
+        show_e2sfca: Boolean value, if True adds the competition-adjusted access (E2SFCA) to the ranking
+        measure: one of MEASURES, the measures other than the Palma ratio are looked up from the inequality table of the grid
+
+    Returns:
+        html: the rendered folium map (see metrics.map_html)
+        df: the ranking table of municipalities
+    """
+    return (render_measure_map(palma, mode_abbreviation, opportunity_type, opportunity_type_abbreviation, travel_time_value, measure),
+            ranking(palma, mode_abbreviation, opportunity_type_abbreviation, travel_time_value, show_e2sfca, measure))
+
+
+def select_measure(palma, mode_abbreviation, opportunity_type_abbreviation, travel_time_value, measure):
+    """
+    Selects the values of an inequality measure of the municipalities for the map and the ranking
+
+    Returns:
+        mode_column: the field of the values
+        filtered_palma: the municipalities with a value
+    """
+    mode_column = f'{mode_abbreviation}_{opportunity_type_abbreviation}_{travel_time_value}'
+    # Select the mode_column, kunta, vuosi, nimi, namn, name, and geometry columns from the palma DataFrame
+    with span(4, 'filter', rows=len(palma)):
         filtered_palma = palma[[mode_column, 'kunta', 'vuosi', 'nimi', 'namn', 'name', 'geometry']]
+        if MEASURES[measure] is not None:
+            values = inequality(f'{mode_abbreviation.upper()}_{opportunity_type_abbreviation}{travel_time_value}', MEASURES[measure])
+            filtered_palma = filtered_palma.assign(**{mode_column: filtered_palma['nimi'].map(values)})
 
         # Filter out rows where the value in the mode_column is either np.nan or None
         filtered_palma = filtered_palma[~filtered_palma[mode_column].isin([np.nan, None])]
+    return mode_column, filtered_palma
+
 
+def render_measure_map(palma, mode_abbreviation, opportunity_type, opportunity_type_abbreviation, travel_time_value, measure='Palma ratio'):
+    """
+    Builds and renders the map of an inequality measure (see render_map_and_ranking for the arguments)
+    """
+    mode_column, filtered_palma = select_measure(palma, mode_abbreviation, opportunity_type_abbreviation, travel_time_value, measure)
+    with span(4, 'unary_union', rows=len(filtered_palma)):
         centroid = filtered_palma.geometry.unary_union.centroid
-        m = folium.Map(location=[centroid.y, centroid.x], zoom_start=5, tiles="cartodbpositron")
-        responsive_to_window_width()
-        m = create_map(m, filtered_palma, opportunity_type, mode_column)
-        return m, filtered_palma, mode_column
-    else:
-        return None
-    
+    m = folium.Map(location=[centroid.y, centroid.x], zoom_start=5, tiles="cartodbpositron")
+    with span(4, 'folium_geojson', rows=len(filtered_palma)):
+        m = create_map(m, filtered_palma, opportunity_type, mode_column, measure)
+    return map_html(m, 4)
+
+
+def ranking(palma, mode_abbreviation, opportunity_type_abbreviation, travel_time_value, show_e2sfca=False, measure='Palma ratio'):
+    """
+    Builds the ranking table of an inequality measure (see render_map_and_ranking for the arguments)
+    """
+    mode_column, filtered_palma = select_measure(palma, mode_abbreviation, opportunity_type_abbreviation, travel_time_value, measure)
+    e2sfca = None
+    if show_e2sfca and opportunity_type_abbreviation in OPPORTUNITY_TYPES:
+        with st.spinner(text="Calculating competition-adjusted access..."), span(4, 'e2sfca'):
+            e2sfca = municipal_e2sfca(mode_abbreviation.upper(), opportunity_type_abbreviation, travel_time_value)
+    with span(4, 'rank_list', rows=len(filtered_palma)):
+        df = rank_list(filtered_palma, mode_column, e2sfca, measure)
+    return df
+
+def show_scenario(scenario, mode_abbreviation, opportunity_type, opportunity_type_abbreviation, travel_time_value):
+    """
+    Shows the Palma ratios of the municipalities whose access the what-if scenario changes, before and after the changes
+
+    Args:
+        scenario: changes of the scenario (see scenarios.current_scenario)
+        mode_abbreviation: abbreviation of the mode in the field names (jl or pp)
+        opportunity_type: name of the selected opportunity type
+        opportunity_type_abbreviation: abbreviation of the opportunity type in the field names
+        travel_time_value: travel time cut-off (30, 45 or 60)
+    """
+    if opportunity_type_abbreviation not in OPPORTUNITY_TYPES:
+        st.warning(f"Scenarios are not available for {opportunity_type.lower()}.")
+        return
+    with span(4, 'scenario', rows=len(scenario)):
+        df = scenario_palma(scenario, mode_abbreviation.upper(), opportunity_type_abbreviation, travel_time_value)
+    if df.empty:
+        st.info(f"The scenario does not change the access to {opportunity_type.lower()}(s) within {travel_time_value} minutes.")
+        return
+    df['Change'] = df['Scenario'] - df['Palma ratio']
+    st.markdown('The Palma ratios below are calculated from the grid cells, so they can differ slightly from the ones of the map.')
+    st.dataframe(df.round(4), width=750)
+
+
 def responsive_to_window_width():
     """
     A function that sets the map object width according to window size
@@ -107,7 +238,30 @@ def responsive_to_window_width():
     """
     st.markdown(making_map_responsive, unsafe_allow_html=True)
 
-def create_map(m, filtered_palma, opportunity_type, mode_column):
+def measure_colormap(measure, values):
+    """
+    Returns the color map of an inequality measure: diverging around equal access for the ratios and the concentration
+    index, and sequential from 0 for the Gini and Theil indices
+
+    Args:
+        measure: one of MEASURES
+        values: values of the measure on the map
+    """
+    colors = ["#4A6FE3", "#788CE1", "#9DA8E2", "#C0C5E3", "#a6a6a6", "#E6BCC3", "#E495A5", "#DD6D87", "#D33F6A"]
+    if measure == 'Concentration index':
+        return cm.LinearColormap(colors, vmin=-0.5, vmax=0.5, index=list(np.linspace(-0.5, 0.5, 9)))
+    if measure in ('Gini index', 'Theil index'):
+        vmax = 1 if measure == 'Gini index' else max(float(np.nanmax(values.replace(np.inf, np.nan), initial=0)), 0.1)
+        return cm.LinearColormap(colors[4:], vmin=0, vmax=vmax, index=list(np.linspace(0, vmax, 5)))
+    # Create a custom color map using a built-in color map from the branca library
+    return cm.LinearColormap(
+        colors,  # Colors
+        vmin=0, vmax=2,  # Range of values
+        index=[0, 0.25, 0.5, 0.75, 1, 1.25, 1.5, 1.75, 2]  # Class intervals
+    )
+
+
+def create_map(m, filtered_palma, opportunity_type, mode_column, measure='Palma ratio'):
     """
     Adds choropleth layer to the initialized Folium map and adds tooltips
 
@@ -115,20 +269,18 @@ def create_map(m, filtered_palma, opportunity_type, mode_column):
         m: Folium map base centered on Finland's geometry
         filtered_palma: a subset where 0, inf and NAN occurances have been removed
         mode_column: contains the user selection, which mode to look at
+        measure: the inequality measure in mode_column, one of MEASURES
 
     Returns:
         m: A folium map object with choropleth layer and tooltips
     """
-    # Create a custom color map using a built-in color map from the branca library
-    fill_color = cm.LinearColormap(
-        ["#4A6FE3", "#788CE1", "#9DA8E2", "#C0C5E3", "#a6a6a6", "#E6BCC3", "#E495A5", "#DD6D87", "#D33F6A"],  # Colors
-        vmin=0, vmax=2,  # Range of values
-        index=[0, 0.25, 0.5, 0.75, 1, 1.25, 1.5, 1.75, 2]  # Class intervals
-    )
+    fill_color = measure_colormap(measure, filtered_palma[mode_column])
 
 
-    choropleth = folium.GeoJson(
+    choropleth = CompactGeoJson(
         filtered_palma,
+        4,
+        properties=['nimi', mode_column],
         style_function=lambda feature: {
             'fillColor': fill_color(feature['properties'][mode_column]),
             'fillOpacity': 0.8,
@@ -142,16 +294,16 @@ def create_map(m, filtered_palma, opportunity_type, mode_column):
         }
     ).add_to(m)
 
-    # Add a tooltip to the choropleth layer to display the Palma ratio
+    # Add a tooltip to the choropleth layer to display the measure
     choropleth.add_child(
         folium.features.GeoJsonTooltip(
             fields=['nimi', mode_column],
-            aliases=['Municipality''', f'Palma ratio ({opportunity_type.lower()})'],
+            aliases=['Municipality''', f'{measure} ({opportunity_type.lower()})'],
             localize=True
         )
     )
     # Add a color scale legend to the map
-    fill_color.caption = 'Palma ratio'
+    fill_color.caption = measure
     m.add_child(fill_color)
 
     return m
@@ -178,23 +330,27 @@ def highlight_polygon(_):
         'color': '#845EB8'
     }
 
-def rank_list(filtered_palma, mode_column):
+def rank_list(filtered_palma, mode_column, e2sfca=None, measure='Palma ratio'):
     """
-    Creating a dataframe table to rank different municipalities based on Palma ratio.
+    Creating a dataframe table to rank different municipalities based on Palma ratio or another inequality measure.
         
     Args:
         filtered_palma: a subset where NA and NAN occurances have been removed
         mode_column: contains the user selection, which mode to look at
+        e2sfca: optional Series of competition-adjusted access (E2SFCA) indexed by municipality name, added as a column to the table
+        measure: the inequality measure in mode_column, one of MEASURES
 
     Returns:
         m: A folium map object with choropleth layer and tooltips
     """
     # Selects the right Palma ratio field based on selection
     df = filtered_palma[['nimi', mode_column]].copy()
-    df.columns = ['Kunta', 'Palma ratio']
-    df = df.sort_values(by='Palma ratio', ascending=False)
-    df = df.round({'Palma ratio': 4})
-    df['Palma ratio'] = df['Palma ratio'].astype(str).replace('inf', "inf")
+    df.columns = ['Kunta', measure]
+    df = df.sort_values(by=measure, ascending=False)
+    df = df.round({measure: 4})
+    df[measure] = df[measure].astype(str).replace('inf', "inf")
+    if e2sfca is not None:
+        df['E2SFCA (per 1 000 residents)'] = df['Kunta'].map(e2sfca).round(4)
     df = df.reset_index(drop=True)
     df.index += 1
     return df
@@ -209,6 +365,8 @@ def add_description():
 
     <span style="font-size: 18px;">Palma ratio is calculated by using the palma_ratio() function of the [accessibility package](https://ipeagit.github.io/accessibility/#accessibility). The function uses the cumulative access dataset (found on page <b>3. Cumulative access of opportunities </b>🚌) and the mean income of population within each grid cell found in the [Finnish population grid](https://www.stat.fi/tup/ruututietokanta/index_en.html).  Results are grouped and calculated for each municipality.</span>
     <br><br>
+    <span style="font-size: 18px;">The other inequality measures are calculated from the same grid cells for every municipality and every mode, opportunity type and cut-off at once, and kept until the grid data changes, so switching the measure does not recalculate anything. Each cell is weighted by its population. The Gini and Theil indices measure how unequally access is distributed between all residents (0 means equal access), the concentration index how much more access the residents with higher income have (negative values mean the residents with lower income have more access), and the 20/20 ratio divides the mean access of the 20 % of residents with the highest income by that of the 20 % with the lowest.</span>
+    <br><br>
     <div style="text-align: center;"">
     <i>Service hosted by GIST Lab, Aalto University. Licensed under CC-BY.</i>
     <br><br>
@@ -220,15 +378,15 @@ def add_description():
 
 def main():
     set_page()
+    preload()
     palma = read_data()
-    m,filtered_palma, mode_column = filter_and_create_charts(palma)
+    html, df = filter_and_create_charts(palma)
     col1, col2 = st.columns([1,1])
-    if m is not None:
+    if html is not None:
         with col1:
-            df = rank_list(filtered_palma, mode_column)
             st.dataframe(df, width=750, height=600)
         with col2:
-            folium_static(m, height=600)
+            show_map(html, height=600)
     else:
         st.warning('Please select mode of transportation and opportunity type')
     add_description()
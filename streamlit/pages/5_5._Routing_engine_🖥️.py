@@ -1,11 +1,15 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+import plotly.express as px
+from pages.utils.benchmark import read_history
+from pages.utils.data_store import preload, status
 
 
 st.set_page_config(page_title="Routing engine", 
                    layout="wide", 
                    initial_sidebar_state="expanded")
+preload()
 
 st.markdown("""
  ### **Routing engine** 🖥️
@@ -135,6 +139,41 @@ with col2:
     </div>
     ''', unsafe_allow_html=True)
     st.table(df1)
+
+st.markdown('''
+<div style="padding-left: 35px;">
+    <h4>Run times of this app on this server</h4>
+</div>
+
+The table below shows how long the most demanding steps of the pages of this app take on the server the app is running on, and the figure shows how the run times have changed between benchmark runs, e.g. after data or library updates. The benchmarks are run with `python -m pages.utils.benchmark` in the `streamlit` folder.
+''', unsafe_allow_html=True)
+
+history = read_history()
+if history.empty:
+    st.info('No benchmark results have been saved on this server yet.')
+else:
+    history['Step'] = 'Page ' + history['page'].astype(str) + ': ' + history['kernel'] + history['view'].map(lambda view: f' ({view})' if view else '')
+    history['Run time (ms)'] = (1000 * history['median_s']).round(1)
+    latest = history[history['timestamp'] == history['timestamp'].max()]
+
+    col1, col2 = st.columns([3, 4])
+    with col1:
+        st.caption(f"Latest run on {latest['host'].iloc[0]} at {latest['timestamp'].iloc[0]:%Y-%m-%d %H:%M} UTC, municipal views for {latest['municipality'].iloc[0]}")
+        st.dataframe(latest[['Step', 'rows', 'Run time (ms)']].rename(columns={'rows': 'Rows'}).set_index('Step'), use_container_width=True, height=600)
+    with col2:
+        fig = px.line(history, x='timestamp', y='Run time (ms)', color='Step', markers=True, log_y=True)
+        fig.update_layout(dragmode=False, xaxis_title=None, height=650, legend=dict(orientation="h", yanchor="top", y=-0.15, font=dict(size=10)))
+        st.plotly_chart(fig, use_container_width=True)
+
+startup = pd.DataFrame(status())
+if not startup.empty:
+    st.markdown('''
+The libraries and datasets of the pages are loaded in the background when the app process starts. The table below shows how long loading each of them took in this process.
+''')
+    startup['Load time (ms)'] = (1000 * startup['seconds']).round(1)
+    startup = startup.rename(columns={'resource': 'Library or dataset', 'kind': 'Kind', 'state': 'State'})
+    st.dataframe(startup[['Library or dataset', 'Kind', 'State', 'Load time (ms)']].set_index('Library or dataset'), use_container_width=False, width=600)
+
 st.markdown('''
     <br><br>
     <div style="text-align: center;">
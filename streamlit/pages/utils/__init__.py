@@ -1,4 +1,57 @@
+import hashlib
+import importlib.util
+from functools import lru_cache
 from pathlib import Path
 
 DATA_FOLDER = Path(__file__).parent.parent.parent / "data"
 IMG_FOLDER = Path(__file__).parent.parent.parent / "pictures"
+BENCHMARK_FOLDER = Path(__file__).parent.parent.parent / "benchmarks"
+PAGES_FOLDER = Path(__file__).parent.parent
+
+# Identifier columns used to join travel time matrices (from_id/to_id) to the grid and opportunity data.
+# When a column is missing, the row position of the source file is used as its identifier. The datasets sorted by
+# data_build get the column with these positions before their rows are reordered.
+GRID_ID_COLUMN = "grd_id"
+OPPORTUNITY_ID_COLUMN = "id"
+
+# Population column of the 1 km x 1 km population grid
+POPULATION_COLUMN = "he_vakiy"
+
+
+def load_page_module(page_number):
+    """
+    Imports a page script as a module so that its functions can be reused outside of the page, e.g. in command line tools.
+    Importing does not run the page, as the pages only call main() when run by Streamlit.
+
+    Args:
+        page_number: the number in the beginning of the page file name (1-4)
+
+    Returns:
+        module: the imported page module
+    """
+    path = next(PAGES_FOLDER.glob(f'{page_number}_*.py'))
+    spec = importlib.util.spec_from_file_location(f'page_{page_number}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def source_fingerprint(page_number):
+    """
+    Returns a hash of the source of a page script and of the shared modules in pages/utils it renders with, so that
+    files rendered by the page can be told apart from the ones rendered by older code
+
+    Args:
+        page_number: the number in the beginning of the page file name (1-4)
+    """
+    paths = [next(PAGES_FOLDER.glob(f'{page_number}_*.py')), *sorted((PAGES_FOLDER / 'utils').glob('*.py'))]
+    return _source_hash(tuple((str(path), path.stat().st_mtime_ns, path.stat().st_size) for path in paths))
+
+
+@lru_cache(maxsize=16)
+def _source_hash(files):
+    digest = hashlib.sha256()
+    for path, _, _ in files:
+        digest.update(Path(path).name.encode('utf-8'))
+        digest.update(Path(path).read_bytes())
+    return digest.hexdigest()
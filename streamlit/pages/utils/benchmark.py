@@ -0,0 +1,325 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+from datetime import datetime, timezone
+from importlib.metadata import version, PackageNotFoundError
+from pathlib import Path
+import folium
+import geopandas as gpd
+import pandas as pd
+from pages.utils import BENCHMARK_FOLDER, DATA_FOLDER, POPULATION_COLUMN, load_page_module
+from pages.utils.grid_pyramid import build_level, level_for_zoom
+from pages.utils.grid_stats import build_population_shares, build_statistics
+from pages.utils.opportunity_bins import build_bins
+from pages.utils.opportunity_cube import build_cube
+from pages.utils.synthetic_data import generate
+
+RESULTS_FILE = BENCHMARK_FOLDER / 'results.jsonl'
+
+# Row counts of the national datasets, scaled by --synthetic
+SYNTHETIC_COUNTS = {'cells': 157784, 'municipalities': 310, 'opportunities': 20000}
+
+# Libraries whose upgrades are most likely to change the timings
+LIBRARIES = ['geopandas', 'pandas', 'numpy', 'shapely', 'pyproj', 'pyarrow', 'folium', 'branca', 'plotly', 'streamlit']
+
+
+def library_versions():
+    """
+    Returns the installed versions of the benchmarked libraries
+    """
+    versions = {}
+    for library in LIBRARIES:
+        try:
+            versions[library] = version(library)
+        except PackageNotFoundError:
+            versions[library] = None
+    return versions
+
+
+def render_map(m):
+    """
+    Serializes a folium map to HTML in the same way as folium_static does, without sending it to a browser
+
+    Returns:
+        html: the rendered HTML document
+    """
+    return folium.Figure().add_child(m).render()
+
+
+def measure(kernel, repeat):
+    """
+    Runs a benchmark kernel repeatedly
+
+    Args:
+        kernel: function without arguments, returning the number of rows it processed (or None)
+        repeat: number of timed runs
+
+    Returns:
+        timings: list of durations (s)
+        rows: number of rows processed by the last run
+    """
+    timings = []
+    rows = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = kernel()
+        timings.append(time.perf_counter() - start)
+    return timings, rows
+
+
+def largest_municipality(grid):
+    """
+    Returns the municipality with the largest population (or the most grid cells), used as the default municipal view
+    """
+    if POPULATION_COLUMN in grid.columns:
+        return grid.groupby('mncplty')[POPULATION_COLUMN].sum().idxmax()
+    return grid['mncplty'].value_counts().index[0]
+
+
+def page_kernels(municipality=None, folder=DATA_FOLDER):
+    """
+    Creates the benchmark kernels of the hot paths of pages 1-4. The data needed by the kernels is loaded once here,
+    and the loading itself is timed as separate kernels.
+
+    Args:
+        municipality: municipality used for the municipal views, defaults to the one with the largest population
+        folder: folder the datasets are read from
+
+    Returns:
+        kernels: list of (page, name, view, function) tuples
+        municipality: the municipality used for the municipal views
+    """
+    page1, page2, page3, page4 = (load_page_module(number) for number in range(1, 5))
+
+    opportunities_raw = gpd.read_parquet(folder / 'opportunities.parquet')
+    opportunities = opportunities_raw.to_crs('EPSG:4326')
+    pt_data = pd.read_csv(folder / 'access_ttm_pt.csv')
+    cycling_data = pd.read_csv(folder / 'access_ttm_cycling.csv')
+    grid_csv = pd.read_csv(folder / 'grid.csv')
+    grid_raw = gpd.read_parquet(folder / 'grid.parquet')
+    grid = grid_raw.to_crs('EPSG:4326')
+    palma_raw = gpd.read_file(folder / 'palma_null.gpkg')
+    palma = palma_raw.to_crs('EPSG:4326')
+    municipality = municipality or largest_municipality(grid)
+
+    opportunity_types = opportunities['opprtnt'].unique()
+    palma_column = 'jl_ruok_30'
+    filtered_palma = palma[[palma_column, 'kunta', 'vuosi', 'nimi', 'namn', 'name', 'geometry']]
+    filtered_palma = filtered_palma[filtered_palma[palma_column].notna()]
+
+    def read(reader, path):
+        return lambda: len(reader(folder / path))
+
+    def reproject(data):
+        return lambda: len(data.to_crs('EPSG:4326'))
+
+    def filter_opportunities():
+        return len(opportunities[(opportunities['mncplty'] == municipality) & opportunities['opprtnt'].isin(opportunity_types)])
+
+    def filter_education():
+        return len(pt_data[pt_data['nimi'].isin([municipality])]) + len(cycling_data[cycling_data['nimi'].isin([municipality])]) + len(grid_csv[grid_csv['nimi'].isin([municipality])])
+
+    def create_df(options):
+        def kernel():
+            pt, cycling, population = pt_data, cycling_data, grid_csv
+            if options:
+                pt, cycling, population = (data[data['nimi'].isin(options)] for data in (pt_data, cycling_data, grid_csv))
+            page2.create_df(pt, cycling, population, options)
+            return len(pt) + len(cycling)
+        return kernel
+
+    statistics_table = build_statistics(grid)
+
+    def select_columns(area):
+        return lambda: len(page3.select_columns(grid, '60', 'JL', 'ruok', area, True, 'equal', statistics_table)[3])
+
+    def page1_map(area, zoom_level):
+        data = opportunities if area == 'Finland' else opportunities[opportunities['mncplty'] == area]
+
+        def kernel():
+            m, _ = page1.create_charts(area, data, zoom_level, opportunity_types)
+            render_map(m)
+            return len(data)
+        return kernel
+
+    def page3_map(area):
+        zoom_level, bins, mode_column, filtered_grid = page3.select_columns(grid, '60', 'JL', 'ruok', area, True, 'equal', statistics_table)
+        filtered_grid = filtered_grid[filtered_grid[mode_column] > 0][[mode_column, 'mncplty', 'geometry']]
+
+        def kernel():
+            centroid = filtered_grid.geometry.unary_union.centroid
+            m = folium.Map(location=[centroid.y, centroid.x], zoom_start=zoom_level, tiles="cartodbpositron")
+            render_map(page3.create_map(m, bins, filtered_grid.reset_index(), 'Number of accessible grocery store(s)', mode_column))
+            return len(filtered_grid)
+        return kernel
+
+    national_level = build_level(grid, level_for_zoom(7))
+
+    def page3_coarse_map():
+        mode_column = 'JL_ruok60'
+        bins = page3.select_columns(grid, '60', 'JL', 'ruok', 'Finland', True, 'equal', statistics_table)[1]
+        cells = national_level['data']
+        cells = cells[cells[mode_column] > 0][[mode_column, 'geometry']]
+        centroid = cells.geometry.unary_union.centroid
+        m = folium.Map(location=[centroid.y, centroid.x], zoom_start=7, tiles="cartodbpositron")
+        render_map(page3.create_map(m, bins, cells.reset_index(), 'Number of accessible grocery store(s)', mode_column))
+        return len(cells)
+
+    def page4_map():
+        centroid = filtered_palma.geometry.unary_union.centroid
+        m = folium.Map(location=[centroid.y, centroid.x], zoom_start=5, tiles="cartodbpositron")
+        render_map(page4.create_map(m, filtered_palma, 'Grocery store', palma_column))
+        return len(filtered_palma)
+
+    def unary_union(data):
+        def kernel():
+            data.geometry.unary_union.centroid
+            return len(data)
+        return kernel
+
+    municipal_grid = grid[grid['mncplty'] == municipality]
+    kernels = [
+        (1, 'Load opportunities.parquet', None, read(gpd.read_parquet, 'opportunities.parquet')),
+        (1, 'Reproject opportunities', None, reproject(opportunities_raw)),
+        (1, 'Filter municipality', 'municipal', filter_opportunities),
+        (1, 'Build hexagon bins', None, lambda: len(build_bins(opportunities)['hexagons'])),
+        (1, 'Build opportunity count cube', None, lambda: len(build_cube(opportunities, grid)['counts'])),
+        (1, 'Build and render map and chart', 'national', page1_map('Finland', 5)),
+        (1, 'Build and render map and chart', 'municipal', page1_map(municipality, 9)),
+        (2, 'Load access_ttm_pt.csv, access_ttm_cycling.csv and grid.csv', None,
+         lambda: len(pd.read_csv(folder / 'access_ttm_pt.csv')) + len(pd.read_csv(folder / 'access_ttm_cycling.csv')) + len(pd.read_csv(folder / 'grid.csv'))),
+        (2, 'Filter municipality', 'municipal', filter_education),
+        (2, 'create_df', 'national', create_df([])),
+        (2, 'create_df', 'municipal', create_df([municipality])),
+        (3, 'Load grid.parquet', None, read(gpd.read_parquet, 'grid.parquet')),
+        (3, 'Reproject grid', None, reproject(grid_raw)),
+        (3, 'Build grid statistics', None, lambda: len(build_statistics(grid))),
+        (3, 'Build population shares', None, lambda: len(build_population_shares(grid))),
+        (3, 'select_columns', 'national', select_columns('Finland')),
+        (3, 'select_columns', 'municipal', select_columns(municipality)),
+        (3, 'unary_union centroid', 'national', unary_union(grid)),
+        (3, 'unary_union centroid', 'municipal', unary_union(municipal_grid)),
+        (3, 'Build and render map', 'national', page3_map('Finland')),
+        (3, 'Build grid pyramid', None, lambda: len(build_level(grid, level_for_zoom(7))['data'])),
+        (3, 'Build and render aggregated map', 'national', page3_coarse_map),
+        (3, 'Build and render map', 'municipal', page3_map(municipality)),
+        (4, 'Load palma_null.gpkg', None, read(gpd.read_file, 'palma_null.gpkg')),
+        (4, 'Reproject palma', None, reproject(palma_raw)),
+        (4, 'rank_list', 'national', lambda: len(page4.rank_list(filtered_palma, palma_column))),
+        (4, 'Build and render map', 'national', page4_map),
+    ]
+    return kernels, municipality
+
+
+def run(repeat=3, municipality=None, pages=None, folder=DATA_FOLDER, synthetic=None):
+    """
+    Runs the benchmark kernels of the given pages
+
+    Args:
+        repeat: number of timed runs per kernel
+        municipality: municipality used for the municipal views
+        pages: list of page numbers to benchmark, all pages by default
+        folder: folder the datasets are read from
+        synthetic: parameters of the synthetic datasets in the folder, saved with the results
+
+    Returns:
+        record: dictionary with the environment information and the timings of each kernel
+    """
+    kernels, municipality = page_kernels(municipality, folder)
+    results = []
+    for page, name, view, kernel in kernels:
+        if pages and page not in pages:
+            continue
+        timings, rows = measure(kernel, repeat)
+        results.append({
+            'page': page,
+            'kernel': name,
+            'view': view,
+            'rows': rows,
+            'median_s': statistics.median(timings),
+            'min_s': min(timings),
+            'max_s': max(timings)
+        })
+
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'libraries': library_versions(),
+        'data_folder': str(folder),
+        'synthetic': synthetic,
+        'municipality': municipality,
+        'repeat': repeat,
+        'results': results
+    }
+
+
+def save(record, path=RESULTS_FILE):
+    """
+    Appends a benchmark record as a line of JSON to the results file
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def read_history(path=RESULTS_FILE):
+    """
+    Reads the saved benchmark records
+
+    Returns:
+        history: DataFrame with one row per kernel and run, empty if nothing has been saved
+    """
+    if not path.exists():
+        return pd.DataFrame()
+    rows = []
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            record = json.loads(line)
+            for result in record['results']:
+                rows.append({'timestamp': record['timestamp'], 'host': record['host'], 'municipality': record['municipality'], **result})
+    history = pd.DataFrame(rows)
+    history['timestamp'] = pd.to_datetime(history['timestamp'])
+    return history
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times the hot paths of the app's pages on this machine and saves the results.")
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per kernel (default: 3)')
+    parser.add_argument('--municipality', help='municipality of the municipal views (default: the one with the largest population)')
+    parser.add_argument('--pages', type=int, nargs='+', choices=[1, 2, 3, 4], help='pages to benchmark (default: all)')
+    parser.add_argument('--data-folder', default=str(DATA_FOLDER), help=f'folder the datasets are read from (default: {DATA_FOLDER})')
+    parser.add_argument('--synthetic', type=float, metavar='SCALE',
+                        help='benchmark synthetic datasets generated in a temporary folder, SCALE times the national row counts (e.g. 1 or 2)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic datasets (default: 0)')
+    parser.add_argument('--output', default=str(RESULTS_FILE), help=f'JSON lines file the results are appended to (default: {RESULTS_FILE})')
+    args = parser.parse_args()
+
+    # The timing spans of the pages must not try to open the metrics endpoint of a running app
+    os.environ.setdefault('EQUITY_METRICS_PORT', '0')
+    if args.synthetic:
+        synthetic = {name: max(int(count * args.synthetic), 1) for name, count in SYNTHETIC_COUNTS.items()}
+        synthetic['seed'] = args.seed
+        with tempfile.TemporaryDirectory(prefix='equity-synthetic-') as folder:
+            start = time.perf_counter()
+            generate(Path(folder), synthetic['cells'], synthetic['municipalities'], synthetic['opportunities'], args.seed)
+            print(f"Generated synthetic datasets ({synthetic['cells']} cells, {synthetic['municipalities']} municipalities, "
+                  f"{synthetic['opportunities']} opportunities) in {time.perf_counter() - start:.1f} s")
+            record = run(args.repeat, args.municipality, args.pages, Path(folder), synthetic)
+    else:
+        record = run(args.repeat, args.municipality, args.pages, Path(args.data_folder))
+    for result in record['results']:
+        view = f" ({result['view']})" if result['view'] else ''
+        print(f"Page {result['page']}  {result['kernel'] + view:<70} {1000 * result['median_s']:>10.1f} ms")
+
+    save(record, Path(args.output))
+
+
+if __name__ == "__main__":
+    main()
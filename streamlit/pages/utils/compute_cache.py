@@ -0,0 +1,198 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from pympler.asizeof import asizeof
+from pages.utils import metrics
+from pages.utils.shared_data import on_reload, version
+
+# Memory budget of the cached maps, figures and tables of this process
+BUDGET_MB = float(os.environ.get('EQUITY_COMPUTE_CACHE_MB', 512))
+
+
+class Flight:
+    """
+    A computation in progress. Sessions asking for the same key wait on its event instead of computing the value again.
+    """
+    __slots__ = ('event', 'value', 'failed')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.failed = False
+
+
+class Entry:
+    """
+    A cached value with its estimated size and the time it took to compute
+    """
+    __slots__ = ('value', 'nbytes', 'seconds', 'hits')
+
+    def __init__(self, value, nbytes, seconds):
+        self.value = value
+        self.nbytes = nbytes
+        self.seconds = seconds
+        self.hits = 0
+
+
+def value_size(value):
+    """
+    Estimates the memory used by a cached value
+
+    Args:
+        value: rendered HTML, a plotly figure, a (Geo)DataFrame or Series, a numpy array, None, or a tuple, list or
+            dictionary of these
+
+    Returns:
+        nbytes: estimated size in bytes
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(value_size(item) for item in value)
+    if isinstance(value, dict):
+        return sum(value_size(item) for item in value.values())
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(deep=True)))
+    if hasattr(value, 'to_plotly_json'):
+        return len(value.to_json())
+    return asizeof(value)
+
+
+class ComputeCache:
+    """
+    Thread-safe memoization shared by all sessions of the process, with single-flight semantics: concurrent requests
+    for a key that is not cached wait for one computation. The least recently used values are evicted when the
+    estimated size of the cached values exceeds the budget.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.nbytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'waits': 0, 'evictions': 0, 'compute_seconds': 0.0}
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value of a key, computing it if needed
+
+        Args:
+            key: hashable key identifying the value, including everything the value depends on
+            compute: function without arguments computing the value
+
+        Returns:
+            value: the cached or computed value
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry.hits += 1
+                    self.stats['hits'] += 1
+                    return entry.value
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = Flight()
+                    self.stats['misses'] += 1
+                else:
+                    self.stats['waits'] += 1
+
+            if leader:
+                return self._compute(key, compute, flight)
+
+            flight.event.wait()
+            if not flight.failed:
+                return flight.value
+            # The computation failed or was interrupted by a rerun of its session, so this session tries again
+
+    def _compute(self, key, compute, flight):
+        start = time.perf_counter()
+        try:
+            value = compute()
+        except BaseException:
+            flight.failed = True
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+            raise
+
+        seconds = time.perf_counter() - start
+        nbytes = value_size(value)
+        with self._lock:
+            self.stats['compute_seconds'] += seconds
+            if nbytes <= self.budget:
+                self._entries[key] = Entry(value, nbytes, seconds)
+                self.nbytes += nbytes
+                while self.nbytes > self.budget:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.nbytes -= evicted.nbytes
+                    self.stats['evictions'] += 1
+            flight.value = value
+            del self._flights[key]
+        flight.event.set()
+        return value
+
+    def clear(self, match=None):
+        """
+        Removes cached values, e.g. after the data they were computed from has changed
+
+        Args:
+            match: function telling from a key whether its value is removed, all values by default
+        """
+        with self._lock:
+            for key in [key for key in self._entries if match is None or match(key)]:
+                self.nbytes -= self._entries.pop(key).nbytes
+
+    def prometheus_lines(self):
+        """
+        Renders the cache statistics for the metrics endpoint
+        """
+        with self._lock:
+            stats = dict(self.stats, entries=len(self._entries), bytes=self.nbytes)
+        lines = []
+        for name, kind, description in [
+            ('hits', 'counter', 'Requests answered from the cache.'),
+            ('misses', 'counter', 'Requests that computed their value.'),
+            ('waits', 'counter', 'Requests that waited for the computation of another session.'),
+            ('evictions', 'counter', 'Values evicted to stay within the memory budget.'),
+            ('compute_seconds', 'counter', 'Time spent computing cached values.'),
+            ('entries', 'gauge', 'Cached values.'),
+            ('bytes', 'gauge', 'Estimated memory of the cached values.')
+        ]:
+            metric = f'equity_compute_cache_{name}' + ('_total' if kind == 'counter' else '')
+            value = f'{stats[name]:.6f}' if name == 'compute_seconds' else stats[name]
+            lines += [f'# HELP {metric} {description}', f'# TYPE {metric} {kind}', f'{metric} {value}']
+        return lines
+
+
+cache = ComputeCache(BUDGET_MB * 2 ** 20)
+metrics.add_collector(cache.prometheus_lines)
+# Only the values computed from the old version of a reloaded dataset are dropped
+on_reload(lambda name, old, new: cache.clear(match=lambda key: (name, old) in key[1]))
+
+
+def cached(key, compute, datasets=()):
+    """
+    Returns the value of a map, figure or table builder from the cache shared by all sessions. The returned value
+    is shared, so the pages must not modify it.
+
+    Args:
+        key: hashable key including the page and every selection the value depends on
+        compute: function without arguments building the value
+        datasets: names of the datasets the value is computed from, whose versions are added to the key so that
+            values computed from an older version of a dataset are never returned
+
+    Returns:
+        value: the cached or computed value
+    """
+    return cache.get_or_compute((key, tuple((name, version(name)) for name in datasets)), compute)
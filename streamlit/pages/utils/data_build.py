@@ -0,0 +1,303 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+from pathlib import Path
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import shapely
+from pages.utils import DATA_FOLDER, GRID_ID_COLUMN
+
+# Folder of the optimized datasets built with `python -m pages.utils.data_build`
+BUILD_FOLDER = Path(os.environ.get('EQUITY_BUILD_FOLDER', DATA_FOLDER / 'build'))
+MANIFEST_FILE = 'manifest.json'
+# Changes the fingerprints of all datasets, increase it when optimize or to_arrow change what the pages get
+BUILD_VERSION = 2
+
+# Datasets used by the pages: source file in the data folder and the CRS the pages use (None for tables)
+DATASETS = {
+    'opportunities': ('opportunities.parquet', 'EPSG:4326'),
+    'grid': ('grid.parquet', 'EPSG:4326'),
+    'palma': ('palma_null.gpkg', 'EPSG:4326'),
+    'municipality_polygons': ('kunnat2023.parquet', 'EPSG:4326'),
+    'finland_polygon': ('suomi.gpkg', 'EPSG:4326'),
+    'access_ttm_pt': ('access_ttm_pt.csv', None),
+    'access_ttm_cycling': ('access_ttm_cycling.csv', None),
+    'grid_csv': ('grid.csv', None),
+    'municipality_names': ('unique_mncplty.csv', None),
+    'ttm_pt': ('ttm_pt.parquet', None),
+    'ttm_cycling': ('ttm_cycling.parquet', None),
+}
+
+# Datasets whose rows are sorted along a Hilbert curve, so that the cells of an area are stored next to each other,
+# with their identifier column. A source without the identifier column gets the row positions of the source as its
+# identifiers before sorting, which the travel time matrices refer to (see pages.utils.GRID_ID_COLUMN). The other
+# datasets keep the row order of their source, as the pages list their values in order of appearance.
+SPATIAL_SORT = {'grid': GRID_ID_COLUMN}
+
+# String columns with at most this share of distinct values are stored as categoricals
+CATEGORY_SHARE = 0.5
+
+logger = logging.getLogger('equity.data_build')
+
+
+def source_path(name):
+    return DATA_FOLDER / DATASETS[name][0]
+
+
+def source_state(name):
+    """
+    Returns the size and modification time of the source file of a dataset, used to notice changed files without hashing them
+    """
+    stat = source_path(name).stat()
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+@lru_cache(maxsize=64)
+def _file_hash(path, size, mtime):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_hash(path):
+    """
+    Returns the SHA-256 of the contents of a file, hashed again only when its size or modification time changes
+    """
+    stat = Path(path).stat()
+    return _file_hash(str(path), stat.st_size, stat.st_mtime)
+
+
+def fingerprint(name):
+    """
+    Returns the fingerprint of a dataset: a hash of the contents of its source file and of the build version. The
+    caches of the pages include the fingerprints of the datasets they were computed from in their keys.
+
+    Args:
+        name: name of the dataset (see DATASETS)
+
+    Returns:
+        fingerprint: 16 hexadecimal characters, None if the source file does not exist
+    """
+    try:
+        state = source_state(name)
+    except FileNotFoundError:
+        return None
+    # The manifest of the build folder saves hashing the sources when a worker starts
+    entry = read_manifest(BUILD_FOLDER).get(name)
+    if entry is not None and entry['build_version'] == BUILD_VERSION and \
+            (entry['source_size'], entry['source_mtime']) == (state['size'], state['mtime']):
+        return entry['fingerprint']
+    return hashlib.sha256(f'{BUILD_VERSION}:{file_hash(source_path(name))}'.encode()).hexdigest()[:16]
+
+
+_manifests = {}
+
+
+def read_manifest(folder):
+    """
+    Reads the manifest of a build folder, again only when the file changes
+
+    Returns:
+        manifest: dictionary of the built datasets by name, empty if nothing has been built
+    """
+    path = folder / MANIFEST_FILE
+    try:
+        modified = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    cached = _manifests.get(path)
+    if cached is None or cached[0] != modified:
+        cached = _manifests[path] = (modified, json.loads(path.read_text()))
+    return cached[1]
+
+
+def read_source(name):
+    """
+    Reads a dataset from its source file in the data folder and reprojects it to the CRS used by the pages
+
+    Args:
+        name: name of the dataset (see DATASETS)
+
+    Returns:
+        data: GeoDataFrame or DataFrame
+    """
+    file_name, crs = DATASETS[name]
+    path = DATA_FOLDER / file_name
+    if path.suffix == '.csv':
+        return pd.read_csv(path)
+    if crs is None:
+        return pd.read_parquet(path)
+    data = gpd.read_parquet(path) if path.suffix == '.parquet' else gpd.read_file(path)
+    return data.to_crs(crs)
+
+
+def optimize(data, spatial_sort=False, id_column=None):
+    """
+    Converts a dataset to compact dtypes: integers to the smallest of int16, int32 and int64 holding their values,
+    floats to float32 and repetitive strings to categoricals
+
+    Args:
+        data: (Geo)DataFrame read with read_source
+        spatial_sort: whether the rows are sorted along a Hilbert curve of the geometries
+        id_column: identifier column of the rows, added with the row positions of data when spatial_sort is set and
+            data does not have it, so that the identifiers keep referring to the source rows after sorting
+
+    Returns:
+        data: optimized (Geo)DataFrame with a default index
+    """
+    geometry = data.geometry.name if isinstance(data, gpd.GeoDataFrame) else None
+    if spatial_sort and id_column is not None and id_column not in data.columns:
+        data = data.assign(**{id_column: np.arange(len(data))})
+    columns = {}
+    for column in data.columns:
+        values = data[column]
+        if column == geometry or pd.api.types.is_bool_dtype(values.dtype):
+            continue
+        if pd.api.types.is_integer_dtype(values.dtype):
+            values = pd.to_numeric(values, downcast='integer')
+            columns[column] = values.astype('int16') if values.dtype.itemsize < 2 else values
+        elif pd.api.types.is_float_dtype(values.dtype):
+            columns[column] = values.astype('float32')
+        elif values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) == 'string' \
+                and values.nunique() <= CATEGORY_SHARE * len(values):
+            columns[column] = values.astype('category')
+    data = data.assign(**columns)
+
+    if spatial_sort and geometry is not None and len(data):
+        data = data.iloc[np.argsort(data.geometry.hilbert_distance(), kind='stable')]
+    return data.reset_index(drop=True)
+
+
+def to_arrow(data):
+    """
+    Converts a (Geo)DataFrame to an Arrow table, storing geometries as WKB and the CRS in the schema metadata
+    """
+    metadata = {}
+    if isinstance(data, gpd.GeoDataFrame):
+        geometry = data.geometry.name
+        metadata = {'geometry_column': geometry, 'crs': data.crs.to_string() if data.crs else ''}
+        data = pd.DataFrame(data).assign(**{geometry: data.geometry.to_wkb().to_numpy()})
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    return table.replace_schema_metadata({**(table.schema.metadata or {}), b'equity': json.dumps(metadata).encode()})
+
+
+def from_arrow(table):
+    """
+    Converts an Arrow table written by to_arrow back to a (Geo)DataFrame. Numeric columns without missing values
+    are views of the Arrow buffers, so a memory mapped table is not copied. Strings and geometries are decoded.
+    """
+    metadata = json.loads(table.schema.metadata.get(b'equity', b'{}'))
+    data = table.to_pandas(split_blocks=True, self_destruct=False)
+    geometry = metadata.get('geometry_column')
+    if geometry is None:
+        return data
+    return gpd.GeoDataFrame(data.assign(**{geometry: shapely.from_wkb(data[geometry].to_numpy())}),
+                            geometry=geometry, crs=metadata['crs'] or None)
+
+
+def load(name):
+    """
+    Reads a dataset from its source file and optimizes it like the build does, for datasets that have not been built
+    """
+    return optimize(read_source(name), name in SPATIAL_SORT, SPATIAL_SORT.get(name))
+
+
+def open_artifact(name, folder=BUILD_FOLDER):
+    """
+    Memory maps a built dataset
+
+    Args:
+        name: name of the dataset
+        folder: build folder
+
+    Returns:
+        data: (Geo)DataFrame, or None if the dataset has not been built or its source has changed since
+    """
+    entry = read_manifest(folder).get(name)
+    if entry is None:
+        return None
+    if entry['fingerprint'] != fingerprint(name):
+        logger.warning('%s in %s is older than %s, reading the source instead', name, folder, DATASETS[name][0])
+        return None
+    source = pa.memory_map(str(folder / entry['file']), 'r')
+    return from_arrow(pa.ipc.open_file(source).read_all())
+
+
+def build(names=None, folder=BUILD_FOLDER, reuse=None):
+    """
+    Builds optimized datasets from the data folder as uncompressed Arrow IPC files, and records their schema, row
+    count, size and hashes in the manifest of the folder. Each file is written under a temporary name and renamed,
+    so a running app never opens a partially written file.
+
+    Args:
+        names: names of the datasets to build, all datasets found in the data folder by default
+        folder: folder to build to
+        reuse: another build folder whose up-to-date files are copied instead of building them again
+
+    Returns:
+        manifest: dictionary of the built datasets
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    manifest = dict(read_manifest(folder))
+    reused = read_manifest(reuse) if reuse is not None and reuse != folder else {}
+    for name in names or DATASETS:
+        if not source_path(name).exists():
+            continue
+        start = time.perf_counter()
+        state = source_state(name)
+        current = fingerprint(name)
+        file_name = f'{name}.arrow'
+        temporary = folder / f'.{file_name}.tmp'
+
+        if name in reused and reused[name]['fingerprint'] == current:
+            shutil.copyfile(reuse / reused[name]['file'], temporary)
+            entry = dict(reused[name])
+        else:
+            table = to_arrow(load(name))
+            with pa.OSFile(str(temporary), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            entry = {
+                'file': file_name,
+                'source': DATASETS[name][0],
+                'fingerprint': current,
+                'build_version': BUILD_VERSION,
+                'rows': table.num_rows,
+                'schema': {field.name: str(field.type) for field in table.schema},
+                'sha256': file_hash(temporary),
+                'source_sha256': file_hash(source_path(name))
+            }
+        os.replace(temporary, folder / file_name)
+        manifest[name] = {**entry, 'bytes': (folder / file_name).stat().st_size, 'source_size': state['size'],
+                          'source_mtime': state['mtime'], 'built': datetime.now(timezone.utc).isoformat(timespec='seconds')}
+        print(f'Built {name:<24} {manifest[name]["rows"]:>10} rows {state["size"] / 2 ** 20:>10.1f} MB -> '
+              f'{manifest[name]["bytes"] / 2 ** 20:>8.1f} MB {time.perf_counter() - start:>8.1f} s')
+
+    temporary = folder / f'.{MANIFEST_FILE}.tmp'
+    temporary.write_text(json.dumps(manifest, indent=2))
+    os.replace(temporary, folder / MANIFEST_FILE)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds optimized Arrow files of the datasets of the app and their manifest.')
+    parser.add_argument('datasets', nargs='*', help=f'datasets to build (default: all): {", ".join(DATASETS)}')
+    parser.add_argument('--folder', default=str(BUILD_FOLDER), help=f'folder to build to (default: {BUILD_FOLDER})')
+    args = parser.parse_args()
+    unknown = set(args.datasets) - set(DATASETS)
+    if unknown:
+        parser.error(f'unknown datasets: {", ".join(sorted(unknown))}')
+    build(args.datasets, Path(args.folder))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import importlib
+import logging
+import os
+import threading
+import time
+from pages.utils import metrics
+
+# Set EQUITY_PRELOAD=0 to load the libraries and datasets only when a page needs them
+PRELOAD = os.environ.get('EQUITY_PRELOAD', '1') not in ('', '0')
+
+# Heavy libraries imported by the pages, in the order they are imported in the background
+MODULES = ['numpy', 'pandas', 'pyarrow', 'shapely', 'pyproj', 'geopandas', 'scipy.sparse', 'branca.colormap', 'folium', 'plotly.express']
+
+# Datasets loaded in the background (see data_build.DATASETS), the ones of the most visited pages first
+DATASETS = ['opportunities', 'municipality_polygons', 'access_ttm_pt', 'access_ttm_cycling', 'grid_csv', 'finland_polygon',
+            'municipality_names', 'grid', 'palma', 'ttm_pt', 'ttm_cycling']
+# Tables precomputed over the datasets after they have been loaded: dataset, module and function building the table
+STATISTICS = {
+    'grid statistics': ('grid', 'pages.utils.grid_stats', 'grid_statistics'),
+    'grid population shares': ('grid', 'pages.utils.grid_stats', 'grid_population_shares'),
+    'grid inequality': ('grid', 'pages.utils.inequality', 'grid_inequality'),
+    'grid pyramid': ('grid', 'pages.utils.grid_pyramid', 'pyramid'),
+    'opportunity bins': ('opportunities', 'pages.utils.opportunity_bins', 'opportunity_bins'),
+    'opportunity cube': ('opportunities', 'pages.utils.opportunity_cube', 'opportunity_cube')
+}
+
+logger = logging.getLogger('equity.data_store')
+
+_lock = threading.Lock()
+_thread = None
+# Versions of the datasets used by the rerun running in the current script thread (see shared_data.version)
+_rerun = threading.local()
+# {resource: {'kind': 'import', 'dataset' or 'statistics', 'state': 'pending', 'loading', 'ready', 'failed' or 'missing', 'seconds': float}}
+_status = {}
+
+
+def _load(kind, name, load):
+    with _lock:
+        _status[name] = {'kind': kind, 'state': 'loading', 'seconds': None}
+    start = time.perf_counter()
+    try:
+        with metrics.span(0, f'preload {name}'):
+            load()
+    except Exception:
+        logger.exception('Preloading %s failed', name)
+        state = 'failed'
+    else:
+        state = 'ready'
+    with _lock:
+        _status[name].update(state=state, seconds=time.perf_counter() - start)
+
+
+def _run():
+    for module in MODULES:
+        _load('import', module, lambda: importlib.import_module(module))
+
+    # The datasets are loaded with shared_data.read_dataset, like the pages load them. It loads each version of a
+    # dataset once: the first caller loads it, and the others wait on the event of that version only, so a page that
+    # needs a dataset still being loaded waits for that dataset and not for the rest of the preload.
+    from pages.utils.data_build import source_path
+    from pages.utils.shared_data import read_dataset
+    for name in DATASETS:
+        if source_path(name).exists():
+            _load('dataset', name, lambda: read_dataset(name))
+        else:
+            with _lock:
+                _status[name]['state'] = 'missing'
+
+    # The precomputed tables go through the compute cache, which the pages read them from
+    for name, (dataset, module, function) in STATISTICS.items():
+        if source_path(dataset).exists():
+            _load('statistics', name, lambda: getattr(importlib.import_module(module), function)())
+        else:
+            with _lock:
+                _status[name]['state'] = 'missing'
+
+
+class PinnedVersions(dict):
+    """
+    Versions of the datasets pinned by a rerun. Unlike a plain dict it can be weakly referenced, so that
+    shared_data.version can release the pinned versions when the next rerun of the thread replaces them or the
+    thread ends.
+    """
+
+
+def preload():
+    """
+    Imports the heavy libraries and loads the shared datasets in a background thread, once per process, so that
+    the landing page renders without waiting for them and the pages find them ready. Called by every page at the
+    start of each rerun, which also starts a new set of pinned dataset versions for the rerun.
+    """
+    global _thread
+    _rerun.versions = PinnedVersions()
+    if _thread is not None or not PRELOAD:
+        return
+    with _lock:
+        if _thread is not None:
+            return
+        for module in MODULES:
+            _status[module] = {'kind': 'import', 'state': 'pending', 'seconds': None}
+        for name in DATASETS:
+            _status[name] = {'kind': 'dataset', 'state': 'pending', 'seconds': None}
+        for name in STATISTICS:
+            _status[name] = {'kind': 'statistics', 'state': 'pending', 'seconds': None}
+        _thread = threading.Thread(target=_run, name='equity-preload', daemon=True)
+    _thread.start()
+
+
+def pinned_versions():
+    """
+    Returns the dataset versions pinned by the rerun running in the calling thread, None outside of a rerun. A
+    rerun keeps using the version of a dataset it got first, even if a new version is swapped in meanwhile.
+
+    Returns:
+        versions: dictionary of fingerprints by dataset name, filled in by shared_data.version
+    """
+    return getattr(_rerun, 'versions', None)
+
+
+def status():
+    """
+    Returns the state and the load time of each preloaded library and dataset
+
+    Returns:
+        status: list of dictionaries with the resource, kind, state and seconds
+    """
+    with _lock:
+        return [{'resource': name, **state} for name, state in _status.items()]
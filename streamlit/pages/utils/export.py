@@ -0,0 +1,237 @@
+import argparse
+import hashlib
+import html
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from urllib.parse import quote
+from pages.utils import load_page_module, source_fingerprint
+from pages.utils.static_assets import write_file
+
+# Folder of the prerendered pages, which Nginx serves at /export/ and falls back to when the workers do not answer
+EXPORT_FOLDER = Path(__file__).parent.parent.parent / 'export'
+# Fingerprints of the inputs of the exported files, by their path in the export folder
+MANIFEST_FILE = 'manifest.json'
+# Changing this rebuilds every file, e.g. when the layout of the export changes
+EXPORT_VERSION = 1
+
+# Sections of the export by page: the folder of the files and the datasets they are rendered from
+SECTIONS = {
+    2: ('education', ('access_ttm_pt', 'access_ttm_cycling', 'grid_csv')),
+    3: ('cumulative', ('grid',)),
+    4: ('equity', ('palma',))
+}
+MODES = {
+    'JL': 'Public transport + 1 000 m walk',
+    'PP': 'Bicycle'
+}
+TRAVEL_TIMES = (30, 45, 60)
+# Area of the curves of all municipalities on page 2
+ALL_MUNICIPALITIES = 'All municipalities'
+
+NO_MAP = '<!DOCTYPE html><html><head><meta charset="utf-8"></head><body><p>No cell of the area has access to {}.</p></body></html>'
+
+# Page modules and datasets of a worker process, loaded once by load_worker
+_pages = {}
+_data = {}
+
+
+def load_worker(pages):
+    """
+    Loads the page modules and datasets of the given pages in an export worker. The maps are rendered with their
+    layers embedded, so that the exported files do not depend on the static folder of the app.
+    """
+    from streamlit import config
+    from pages.utils.shared_data import read_dataset
+
+    config.set_option('server.enableStaticServing', False)
+    for page in pages:
+        _pages[page] = load_page_module(page)
+        for name in SECTIONS[page][1]:
+            if name not in _data:
+                _data[name] = read_dataset(name)
+
+
+def export_item(item):
+    """
+    Renders one file of the export in a worker process
+
+    Args:
+        item: tuple of the page number, the path of the file in the export folder and the selection
+
+    Returns:
+        path: the path of the file in the export folder
+        content: bytes of the file
+    """
+    page, path, selection = item
+    module = _pages[page]
+    if page == 2:
+        pt_data, cycling_data, grid = _data['access_ttm_pt'], _data['access_ttm_cycling'], _data['grid_csv']
+        options = [] if selection == ALL_MUNICIPALITIES else [selection]
+        if options:
+            pt_data = pt_data[pt_data['nimi'].isin(options)]
+            cycling_data = cycling_data[cycling_data['nimi'].isin(options)]
+            grid = grid[grid['nimi'].isin(options)]
+        data_long = module.create_df(pt_data, cycling_data, grid, options)
+        if path.endswith('.json'):
+            return path, data_long.to_json(orient='records').encode('utf-8')
+        return path, module.create_fig(data_long).to_html(include_plotlyjs='cdn').encode('utf-8')
+    if page == 3:
+        area, mode, opportunity_type, travel_time, use_same_intervals = selection
+        rendered = module.render_map(_data['grid'], area, mode, opportunity_type, module.OPPORTUNITY_ABBREVIATIONS[opportunity_type],
+                                     travel_time, use_same_intervals, module.CUMULATIVE_INDICATOR)
+        return path, (rendered or NO_MAP.format(html.escape(opportunity_type.lower()))).encode('utf-8')
+    mode, opportunity_type, travel_time = selection
+    rendered, df = module.render_map_and_ranking(_data['palma'], mode.lower(), opportunity_type, module.OPPORTUNITY_ABBREVIATIONS[opportunity_type], travel_time)
+    if path.endswith('.json'):
+        return path, df.to_json(orient='records', force_ascii=False).encode('utf-8')
+    return path, rendered.encode('utf-8')
+
+
+def plan(pages, areas=None):
+    """
+    Lists the files of the export: the curves of page 2 for each municipality, the cumulative access maps of page 3
+    for each area, mode, opportunity type, cut-off and class interval setting, and the Palma ratio maps and rankings
+    of page 4 for each mode, opportunity type and cut-off
+
+    Args:
+        pages: page numbers to export
+        areas: areas of the maps of page 3 (default: Finland and all municipalities)
+
+    Returns:
+        items: list of (page, path, selection) tuples, see export_item
+    """
+    from pages.utils.shared_data import read_dataset
+
+    items = []
+    if 2 in pages:
+        municipalities = sorted(read_dataset('access_ttm_cycling')['nimi'].dropna().unique())
+        for municipality in [ALL_MUNICIPALITIES, *municipalities]:
+            for suffix in ('.html', '.json'):
+                items.append((2, f'education/{municipality}{suffix}', municipality))
+    if 3 in pages:
+        page3 = load_page_module(3)
+        if areas is None:
+            areas = ['Finland', *read_dataset('municipality_names')['mncplty'].unique()]
+        for area in areas:
+            for mode in MODES:
+                for opportunity_type, abbreviation in page3.OPPORTUNITY_ABBREVIATIONS.items():
+                    for travel_time in TRAVEL_TIMES:
+                        for use_same_intervals in (True, False):
+                            name = f'{mode}_{abbreviation}{travel_time}' + ('' if use_same_intervals else '_cutoff_intervals')
+                            items.append((3, f'cumulative/{area}/{name}.html', (area, mode, opportunity_type, travel_time, use_same_intervals)))
+    if 4 in pages:
+        page4 = load_page_module(4)
+        for mode in MODES:
+            for opportunity_type, abbreviation in page4.OPPORTUNITY_ABBREVIATIONS.items():
+                for travel_time in TRAVEL_TIMES:
+                    for suffix in ('.html', '.json'):
+                        items.append((4, f'equity/{mode.lower()}_{abbreviation}_{travel_time}{suffix}', (mode, opportunity_type, travel_time)))
+    return items
+
+
+def input_fingerprints(items):
+    """
+    Returns the fingerprints of the inputs of the files: the selection, the versions of the datasets and the source of
+    the page and of the shared modules it renders with. A file is rendered again only when its fingerprint changes.
+    """
+    from pages.utils.shared_data import version
+
+    sources = {}
+    for page in {page for page, _, _ in items}:
+        versions = [version(name) for name in SECTIONS[page][1]]
+        sources[page] = json.dumps([EXPORT_VERSION, source_fingerprint(page), versions])
+    return {path: hashlib.sha256(f'{sources[page]}{selection!r}'.encode('utf-8')).hexdigest()[:20] for page, path, selection in items}
+
+
+def remove(folder, path):
+    """
+    Removes an exported file with its compressed copies
+    """
+    target = folder / path
+    for variant in (target, target.with_name(target.name + '.gz'), target.with_name(target.name + '.br')):
+        if variant.exists():
+            variant.unlink()
+
+
+def write_index(folder, manifest):
+    """
+    Writes the index pages of the export, which link to the exported files of each section
+    """
+    def page(title, links):
+        rows = ''.join(f'<li><a href="{quote(href)}">{html.escape(label)}</a></li>' for href, label in links)
+        return (f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{html.escape(title)}</title></head>'
+                f'<body><h3>{html.escape(title)}</h3><ul>{rows}</ul></body></html>').encode('utf-8')
+
+    sections = {}
+    for path in sorted(manifest):
+        section, name = path.split('/', 1)
+        sections.setdefault(section, []).append((name, name.rsplit('.', 1)[0].replace('/', ' / ')))
+    for section, links in sections.items():
+        write_file(folder / section / 'index.html', page(f'Equity of access in Finland: {section}', links))
+    write_file(folder / 'index.html', page('Equity of access in Finland (prerendered maps and figures)',
+                                           [(f'{section}/index.html', section) for section in sections]))
+
+
+def export(folder=EXPORT_FOLDER, pages=(2, 3, 4), areas=None, workers=None):
+    """
+    Renders the maps, figures and tables of the selections of pages 2-4 to static files that Nginx serves without
+    the Streamlit workers. Files whose inputs have not changed since the previous export are kept, and the files of
+    selections that no longer exist are removed.
+
+    Args:
+        folder: export folder
+        pages: page numbers to export
+        areas: areas of the maps of page 3 (default: Finland and all municipalities)
+        workers: number of worker processes (default: number of CPUs)
+
+    Returns:
+        rendered: number of rendered files
+        kept: number of unchanged files
+        removed: number of removed files
+    """
+    manifest_path = folder / MANIFEST_FILE
+    previous = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+    items = plan(pages, areas)
+    fingerprints = input_fingerprints(items)
+    pending = [item for item in items if previous.get(item[1]) != fingerprints[item[1]] or not (folder / item[1]).exists()]
+
+    # Files of the exported sections that are not planned any more are removed, the other sections are kept as they are
+    complete = {SECTIONS[page][0] for page in pages if page != 3 or areas is None}
+    manifest = {path: key for path, key in previous.items() if path.split('/', 1)[0] not in complete}
+    removed = [path for path in previous if path not in fingerprints and path not in manifest]
+    for path in removed:
+        remove(folder, path)
+
+    if pending:
+        with ProcessPoolExecutor(workers or os.cpu_count(), initializer=load_worker, initargs=(pages,)) as executor:
+            for path, content in executor.map(export_item, pending, chunksize=max(len(pending) // (8 * (workers or os.cpu_count())), 1)):
+                write_file(folder / path, content)
+    manifest.update(fingerprints)
+
+    temporary = manifest_path.with_name(f'.{MANIFEST_FILE}.tmp')
+    temporary.write_text(json.dumps(manifest, indent=0, sort_keys=True))
+    os.replace(temporary, manifest_path)
+    write_index(folder, manifest)
+    return len(pending), len(items) - len(pending), len(removed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prerenders the maps, figures and tables of pages 2-4 to static files served by Nginx.')
+    parser.add_argument('--folder', default=str(EXPORT_FOLDER), help=f'export folder (default: {EXPORT_FOLDER})')
+    parser.add_argument('--pages', type=int, nargs='+', choices=sorted(SECTIONS), default=sorted(SECTIONS), help='pages to export (default: all)')
+    parser.add_argument('--areas', nargs='+', help='areas of the maps of page 3 (default: Finland and all municipalities)')
+    parser.add_argument('--workers', type=int, help='number of worker processes (default: number of CPUs)')
+    args = parser.parse_args()
+
+    # The timing spans of the pages must not try to open the metrics endpoint of a running app
+    os.environ.setdefault('EQUITY_METRICS_PORT', '0')
+    start = time.perf_counter()
+    rendered, kept, removed = export(Path(args.folder), args.pages, args.areas, args.workers)
+    print(f'Rendered {rendered} files, kept {kept} unchanged and removed {removed} in {time.perf_counter() - start:.1f} s')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import ast
+import numpy as np
+import pandas as pd
+
+# Rows evaluated at a time, so that the intermediate results of an expression take little memory
+CHUNK_ROWS = 65536
+# Longest expression accepted, which bounds the depth of the recursion over the parsed expression
+MAX_LENGTH = 300
+
+# Functions that can be used in expressions, with their number of arguments. min and max ignore missing values.
+FUNCTIONS = {
+    'abs': (1, np.abs),
+    'min': (2, np.fmin),
+    'max': (2, np.fmax)
+}
+
+
+def divide(numerator, denominator):
+    """
+    Divides element-wise, giving a missing value (NaN) where the denominator is 0
+    """
+    numerator, denominator = np.broadcast_arrays(numerator, denominator)
+    return np.divide(numerator, denominator, out=np.full(numerator.shape, np.nan, dtype='float32'), where=denominator != 0)
+
+
+OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: divide
+}
+
+
+def numeric_columns(data):
+    """
+    Returns the columns of a (Geo)DataFrame that can be used in expressions
+    """
+    return [column for column in data.columns if pd.api.types.is_numeric_dtype(data[column].dtype)
+            and not pd.api.types.is_bool_dtype(data[column].dtype)]
+
+
+def parse(expression, columns):
+    """
+    Parses an expression over the indicator columns, e.g. 'JL_tyo60 - PP_tyo60' or 'JL_ruok30 / JL_ruok60'. Numbers,
+    the operators + - * / and parentheses, and the functions abs, min and max can be used.
+
+    Args:
+        expression: the expression as text
+        columns: names of the columns that can be used
+
+    Returns:
+        tree: the parsed expression
+        normalized: the expression written out in a canonical form, used as its cache key
+
+    Raises:
+        ValueError: if the expression is not valid, with a message for the user
+    """
+    if len(expression.strip()) > MAX_LENGTH:
+        raise ValueError(f'The expression is too long, it can have at most {MAX_LENGTH} characters.')
+    try:
+        tree = ast.parse(expression.strip(), mode='eval').body
+    except (SyntaxError, RecursionError, MemoryError):
+        raise ValueError(f'"{expression}" is not a valid expression.') from None
+    columns = set(columns)
+
+    def check(node):
+        if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            check(node.left)
+            check(node.right)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            check(node.operand)
+        elif isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            pass
+        elif isinstance(node, ast.Name):
+            if node.id not in columns:
+                raise ValueError(f'Unknown indicator "{node.id}".')
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and not node.keywords:
+            if len(node.args) != FUNCTIONS[node.func.id][0]:
+                raise ValueError(f'{node.func.id}() takes {FUNCTIONS[node.func.id][0]} argument(s).')
+            for argument in node.args:
+                check(argument)
+        else:
+            raise ValueError(f'"{ast.unparse(node)}" is not supported in expressions.')
+
+    try:
+        check(tree)
+        return tree, ast.unparse(tree)
+    except (RecursionError, MemoryError):
+        raise ValueError(f'"{expression}" is too complex.') from None
+
+
+def compile_tree(tree):
+    """
+    Turns a parsed expression into a function that evaluates it for a chunk of rows
+
+    Returns:
+        function: function of a dictionary of float32 column chunks by name, returning the values of the chunk
+    """
+    if isinstance(tree, ast.BinOp):
+        left, right, operator = compile_tree(tree.left), compile_tree(tree.right), OPERATORS[type(tree.op)]
+        return lambda chunk: operator(left(chunk), right(chunk))
+    if isinstance(tree, ast.UnaryOp):
+        operand = compile_tree(tree.operand)
+        return (lambda chunk: np.negative(operand(chunk))) if isinstance(tree.op, ast.USub) else operand
+    if isinstance(tree, ast.Constant):
+        value = np.float32(tree.value)
+        return lambda chunk: value
+    if isinstance(tree, ast.Name):
+        return lambda chunk: chunk[tree.id]
+    function = FUNCTIONS[tree.func.id][1]
+    arguments = [compile_tree(argument) for argument in tree.args]
+    return lambda chunk: function(*(argument(chunk) for argument in arguments))
+
+
+def evaluate(expression, data):
+    """
+    Evaluates an expression for every row of a (Geo)DataFrame. The rows are evaluated in chunks, so only the
+    result and chunk-sized intermediate arrays are allocated besides the columns of the data.
+
+    Args:
+        expression: the expression as text (see parse)
+        data: the grid or another (Geo)DataFrame with the columns used in the expression
+
+    Returns:
+        values: float32 array in the row order of data, NaN where the expression has no value (division by 0)
+
+    Raises:
+        ValueError: if the expression is not valid
+    """
+    tree, _ = parse(expression, numeric_columns(data))
+    function = compile_tree(tree)
+    names = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and node.id not in FUNCTIONS}
+    columns = {name: data[name].to_numpy() for name in names}
+
+    values = np.empty(len(data), dtype='float32')
+    with np.errstate(invalid='ignore', over='ignore'):
+        for start in range(0, len(data), CHUNK_ROWS):
+            chunk = {name: column[start:start + CHUNK_ROWS].astype('float32', copy=False) for name, column in columns.items()}
+            values[start:start + CHUNK_ROWS] = function(chunk)
+    return values
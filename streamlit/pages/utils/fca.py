@@ -0,0 +1,204 @@
+import numpy as np
+import pandas as pd
+import streamlit as st
+from scipy import sparse
+from pages.utils import GRID_ID_COLUMN, OPPORTUNITY_ID_COLUMN, POPULATION_COLUMN
+from pages.utils.shared_data import on_reload, read_dataset, version
+
+# Travel time matrices between grid cells (from_id) and opportunities (to_id) produced with R5R (see data_build.DATASETS)
+TTM_DATASETS = {
+    'JL': 'ttm_pt',
+    'PP': 'ttm_cycling'
+}
+
+# Opportunity types of opportunities.parquet ('opprtnt') by the abbreviation used in the access data field names
+OPPORTUNITY_TYPES = {
+    'aptk': 'Pharmacy',
+    'ruok': 'Grocery store',
+    'kirja': 'Library',
+    'lahi': 'Public sports facility',
+    'koul': 'School',
+    'sair': 'Healthcare'
+}
+
+# Stepwise distance decay of the enhanced 2SFCA (Luo & Qi 2009). The travel time cut-off is split into three
+# equally long zones, which get the weights used in the original method for the 0-10, 10-20 and 20-30 min zones.
+DECAY_ZONES = [(1 / 3, 1.0), (2 / 3, 0.68), (1.0, 0.22)]
+
+
+def decay_weights(travel_times, cutoff):
+    """
+    Assigns the stepwise E2SFCA distance decay weight to each travel time
+
+    Args:
+        travel_times: array of travel times (min)
+        cutoff: travel time cut-off (min), travel times above it get weight 0
+
+    Returns:
+        weights: array of weights with the same shape as travel_times
+    """
+    travel_times = np.asarray(travel_times, dtype='float64')
+    weights = np.zeros(travel_times.shape)
+    # Loop from the farthest zone to the closest so that the closer zone wins at the zone limits
+    for share, weight in reversed(DECAY_ZONES):
+        weights[travel_times <= share * cutoff] = weight
+    return weights
+
+
+def positions(ids, values):
+    """
+    Looks up the positions of identifiers, -1 for the ones not found. The identifiers of a categorical column are
+    looked up once per category.
+    """
+    index = pd.Index(ids)
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        found = np.append(index.get_indexer(values.cat.categories), -1)
+        return found[values.cat.codes.to_numpy()]
+    return index.get_indexer(values)
+
+
+def weight_matrix(ttm, origin_ids, destination_ids, cutoff):
+    """
+    Builds a sparse origin x destination matrix of distance decay weights from a travel time matrix
+
+    Args:
+        ttm: DataFrame with from_id, to_id and travel_time_p50 columns
+        origin_ids: identifiers of the grid cells, in the row order of the grid
+        destination_ids: identifiers of the opportunities, in the row order of the opportunity data
+        cutoff: travel time cut-off (min)
+
+    Returns:
+        weights: scipy.sparse.csr_matrix of shape (len(origin_ids), len(destination_ids))
+    """
+    ttm = ttm[ttm['travel_time_p50'] <= cutoff]
+    rows = positions(origin_ids, ttm['from_id'])
+    cols = positions(destination_ids, ttm['to_id'])
+    # Drop pairs whose origin or destination is not part of the given data
+    valid = (rows >= 0) & (cols >= 0)
+    weights = decay_weights(ttm['travel_time_p50'].to_numpy()[valid], cutoff)
+    return sparse.csr_matrix((weights, (rows[valid], cols[valid])), shape=(len(origin_ids), len(destination_ids)))
+
+
+def e2sfca(population, supply, weights):
+    """
+    Calculates the enhanced two-step floating catchment area (E2SFCA) accessibility with two sparse matrix passes.
+    The first pass divides the supply of each facility by the weighted population within its catchment, and the
+    second pass sums the weighted supply-to-demand ratios of all facilities within the catchment of each origin.
+
+    Args:
+        population: array of population per origin
+        supply: array of capacity per destination (1 for a single facility)
+        weights: sparse origin x destination matrix of distance decay weights
+
+    Returns:
+        access: array of facilities per inhabitant for each origin
+    """
+    demand = weights.T @ np.asarray(population, dtype='float64')
+    ratio = np.divide(supply, demand, out=np.zeros(len(demand)), where=demand > 0)
+    return weights @ ratio
+
+
+def read_with_ids(name, id_column, columns):
+    """
+    Returns the given columns of a dataset together with its identifiers
+
+    Args:
+        name: name of the dataset (see data_build.DATASETS)
+        id_column: name of the identifier column, row positions are used if the dataset does not have it
+        columns: list of other columns to return
+
+    Returns:
+        data: DataFrame of the columns
+        ids: array of identifiers in the row order of data
+    """
+    data = read_dataset(name)
+    ids = data[id_column].to_numpy() if id_column in data.columns else np.arange(len(data))
+    return data[columns], ids
+
+
+def read_ttm(mode_abbreviation):
+    """
+    Returns the grid-to-opportunity travel time matrix of the given mode, shared by all sessions
+
+    Args:
+        mode_abbreviation: JL (public transport) or PP (bicycle)
+
+    Returns:
+        ttm: DataFrame with from_id, to_id and travel_time_p50 columns
+    """
+    return read_dataset(TTM_DATASETS[mode_abbreviation])
+
+
+def fingerprints(mode_abbreviation):
+    """
+    Returns the versions of the datasets the E2SFCA accessibility of a mode is calculated from, passed to the
+    cached functions so that their results are calculated again when a dataset changes
+    """
+    return tuple(version(name) for name in ('grid', 'opportunities', TTM_DATASETS[mode_abbreviation]))
+
+
+def e2sfca_indicator(mode_abbreviation, opportunity_type_abbreviation, travel_time_value):
+    """
+    Calculates the E2SFCA accessibility of every grid cell for the selected mode, opportunity type and travel time cut-off
+
+    Args:
+        mode_abbreviation: JL (public transport) or PP (bicycle)
+        opportunity_type_abbreviation: abbreviation of the opportunity type (see OPPORTUNITY_TYPES)
+        travel_time_value: travel time cut-off (30, 45 or 60)
+
+    Returns:
+        access: array of opportunities per 1 000 inhabitants, in the row order of read_dataset('grid')
+    """
+    return _e2sfca_indicator(mode_abbreviation, opportunity_type_abbreviation, travel_time_value, fingerprints(mode_abbreviation))
+
+
+@st.cache_data(show_spinner=False)
+def _e2sfca_indicator(mode_abbreviation, opportunity_type_abbreviation, travel_time_value, dataset_fingerprints):
+    grid, grid_ids = read_with_ids('grid', GRID_ID_COLUMN, [POPULATION_COLUMN])
+    opportunities, opportunity_ids = read_with_ids('opportunities', OPPORTUNITY_ID_COLUMN, ['opprtnt'])
+
+    # Only the facilities of the selected type compete for the same population
+    selected = (opportunities['opprtnt'] == OPPORTUNITY_TYPES[opportunity_type_abbreviation]).to_numpy()
+    weights = weight_matrix(read_ttm(mode_abbreviation), grid_ids, opportunity_ids[selected], int(travel_time_value))
+    # Protected small counts of the population grid are stored as negative numbers
+    population = grid[POPULATION_COLUMN].fillna(0).clip(lower=0).to_numpy()
+
+    return 1000 * e2sfca(population, np.ones(selected.sum()), weights)
+
+
+def municipal_e2sfca(mode_abbreviation, opportunity_type_abbreviation, travel_time_value):
+    """
+    Aggregates the E2SFCA accessibility of the grid cells to municipalities as a population weighted mean
+
+    Args:
+        mode_abbreviation: JL (public transport) or PP (bicycle)
+        opportunity_type_abbreviation: abbreviation of the opportunity type (see OPPORTUNITY_TYPES)
+        travel_time_value: travel time cut-off (30, 45 or 60)
+
+    Returns:
+        municipal_access: Series of opportunities per 1 000 inhabitants indexed by municipality name
+    """
+    return _municipal_e2sfca(mode_abbreviation, opportunity_type_abbreviation, travel_time_value, fingerprints(mode_abbreviation))
+
+
+@st.cache_data(show_spinner=False)
+def _municipal_e2sfca(mode_abbreviation, opportunity_type_abbreviation, travel_time_value, dataset_fingerprints):
+    grid = read_dataset('grid')
+    # Protected small counts of the population grid are stored as negative numbers
+    population = grid[POPULATION_COLUMN].fillna(0).clip(lower=0).to_numpy()
+    access = e2sfca_indicator(mode_abbreviation, opportunity_type_abbreviation, travel_time_value)
+
+    sums = pd.DataFrame({'weighted': access * population, 'population': population}).groupby(grid['mncplty'].to_numpy()).sum()
+    return (sums['weighted'] / sums['population'].where(sums['population'] > 0)).rename('E2SFCA')
+
+
+def clear_results(name, old, new):
+    """
+    Drops the cached E2SFCA results when a dataset they are calculated from has been reloaded
+    """
+    if name in ('grid', 'opportunities', *TTM_DATASETS.values()):
+        _e2sfca_indicator.clear()
+        _municipal_e2sfca.clear()
+
+
+on_reload(clear_results)
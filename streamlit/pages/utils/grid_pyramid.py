@@ -0,0 +1,129 @@
+import math
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely import box
+from pages.utils import POPULATION_COLUMN
+from pages.utils.compute_cache import cached
+from pages.utils.grid_stats import access_columns
+from pages.utils.shared_data import read_dataset
+
+# Cell sizes (m) of the aggregated grids, from the finest to the coarsest
+LEVELS = [5000, 10000, 25000]
+# Projected CRS of the population grid, in which the aggregated cells are aligned with the 1 km cells
+GRID_CRS = 'EPSG:3067'
+# The coarsest level whose cells are at most this many pixels wide at the zoom level of the map is used
+MAX_CELL_PIXELS = 24
+# Ground resolution (m per pixel) of web map tiles at the equator at zoom level 0
+EQUATOR_RESOLUTION = 156543.03
+
+
+def level_for_zoom(zoom_level, latitude=65):
+    """
+    Chooses the aggregated grid for a map: the coarsest level whose cells still look like a fine grid at the zoom level
+
+    Args:
+        zoom_level: zoom level of the map
+        latitude: latitude of the center of the map
+
+    Returns:
+        size: cell size (m) of the level, None if the 1 km grid should be used
+    """
+    resolution = EQUATOR_RESOLUTION * math.cos(math.radians(latitude)) / 2 ** zoom_level
+    sizes = [size for size in LEVELS if size / resolution <= MAX_CELL_PIXELS]
+    return max(sizes) if sizes else None
+
+
+def build_level(grid, size):
+    """
+    Aggregates the 1 km grid to cells of the given size
+
+    Args:
+        grid: the national access data
+        size: cell size (m) of the aggregated grid
+
+    Returns:
+        level: dictionary with 'codes', the aggregated cell of each 1 km cell in the row order of grid, 'weights', the
+            population of each 1 km cell used as its weight, and 'data', a GeoDataFrame of the aggregated cells with
+            the total population, the number of 1 km cells and the population-weighted mean of every access field
+    """
+    centroids = grid.geometry.to_crs(GRID_CRS).centroid
+    x = np.floor(centroids.x.to_numpy() / size).astype('int64')
+    y = np.floor(centroids.y.to_numpy() / size).astype('int64')
+    codes, cells = pd.factorize(pd.MultiIndex.from_arrays([x, y]))
+    cell_x, cell_y = (np.asarray(values, dtype='float64') * size for values in zip(*cells))
+
+    weights = grid[POPULATION_COLUMN].fillna(0).clip(lower=0).to_numpy(dtype='float64')
+    level = {'codes': codes, 'weights': weights}
+    columns = {
+        POPULATION_COLUMN: np.bincount(codes, weights=weights, minlength=len(cells)),
+        'cells': np.bincount(codes, minlength=len(cells))
+    }
+    for column in access_columns(grid):
+        columns[column] = aggregate(level, grid[column].to_numpy(dtype='float64'))
+    level['data'] = gpd.GeoDataFrame(columns, geometry=box(cell_x, cell_y, cell_x + size, cell_y + size),
+                                     crs=GRID_CRS).to_crs(grid.crs)
+    return level
+
+
+def aggregate(level, values):
+    """
+    Calculates the population-weighted mean of the values of the 1 km cells in each aggregated cell. Cells without
+    a value are left out, and the mean of the aggregated cells without population is not weighted.
+
+    Args:
+        level: aggregated grid (see build_level)
+        values: values of the 1 km cells in the row order of the grid
+
+    Returns:
+        means: float32 array of the aggregated cells, NaN for cells without values
+    """
+    codes, weights = level['codes'], level['weights']
+    n_cells = codes.max() + 1 if len(codes) else 0
+    valid = ~np.isnan(values)
+    codes, weights, values = codes[valid], weights[valid], values[valid]
+    weighted = np.bincount(codes, weights=values * weights, minlength=n_cells)
+    population = np.bincount(codes, weights=weights, minlength=n_cells)
+    sums = np.bincount(codes, weights=values, minlength=n_cells)
+    counts = np.bincount(codes, minlength=n_cells)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(population > 0, weighted / population, sums / counts)
+    return means.astype('float32')
+
+
+def pyramid_level(size):
+    """
+    Returns an aggregated grid of the shared grid, built once per grid version and shared by all sessions
+
+    Args:
+        size: cell size (m), one of LEVELS
+    """
+    grid = read_dataset('grid')
+    return cached(('grid pyramid', size), lambda: build_level(grid, size), datasets=('grid',))
+
+
+def pyramid():
+    """
+    Returns all levels of the aggregated grid of the shared grid
+    """
+    return [pyramid_level(size) for size in LEVELS]
+
+
+def coarsen(data, column, size, stored=True):
+    """
+    Returns the population-weighted means of a field of the national grid in the cells of an aggregated grid
+
+    Args:
+        data: the national access data, or a copy of it with an added field (e.g. E2SFCA or a derived indicator)
+        column: the field to aggregate
+        size: cell size (m), one of LEVELS
+        stored: Boolean value, False if the values of the field differ from the stored field of the same name (e.g. in a
+        what-if scenario), in which case they are aggregated instead of read from the aggregated grid
+
+    Returns:
+        data: GeoDataFrame of the aggregated cells with the field and the geometry
+    """
+    level = pyramid_level(size)
+    if stored and column in level['data'].columns:
+        return level['data'][[column, 'geometry']]
+    return level['data'][['geometry']].assign(**{column: aggregate(level, data[column].to_numpy(dtype='float64'))})
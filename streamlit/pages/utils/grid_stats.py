@@ -0,0 +1,318 @@
+import re
+import numpy as np
+import pandas as pd
+from pages.utils import POPULATION_COLUMN
+from pages.utils.compute_cache import cached
+from pages.utils.shared_data import read_dataset
+
+# Cumulative access fields of the grid: mode, opportunity type and travel time cut-off, e.g. JL_ruok30
+ACCESS_COLUMN = re.compile(r'^(JL|PP)_([a-z]+)(30|45|60)$')
+# Area of the statistics of all grid cells
+NATIONAL = 'Finland'
+# Number of classes of the maps
+CLASSES = 6
+# Quantiles of the cells with access shown in the summaries
+QUANTILES = [0.1, 0.25, 0.5, 0.75, 0.9]
+# Natural breaks are calculated from this many quantiles of each distribution instead of all of its cells
+JENKS_POINTS = 64
+# Distributions whose natural breaks are calculated at a time
+JENKS_BATCH = 512
+
+# Population groups of the summaries: population columns of the grid summed per group
+AGE_GROUPS = {
+    'Total': [POPULATION_COLUMN],
+    '0-6 years': ['he_0_2', 'he_3_6'],
+    '7-17 years': ['he_7_12', 'he_13_15', 'he_16_17'],
+    '18-64 years': ['he_18_19', 'he_20_24', 'he_25_29', 'he_30_34', 'he_35_39', 'he_40_44', 'he_45_49', 'he_50_54',
+                    'he_55_59', 'he_60_64'],
+    '65+ years': ['he_65_69', 'he_70_74', 'he_75_79', 'he_80_84', 'he_85_']
+}
+# Numbers of accessible opportunities for which the share of the population that can access at least as many is calculated
+THRESHOLDS = [1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000]
+# Municipalities are ranked against the municipalities of the same population size class
+SIZE_CLASSES = [0, 5000, 10000, 20000, 50000, 100000, np.inf]
+SIZE_LABELS = ['under 5 000', '5 000-10 000', '10 000-20 000', '20 000-50 000', '50 000-100 000', 'over 100 000']
+
+
+def access_columns(grid):
+    """
+    Returns the cumulative access fields of the grid
+    """
+    return [column for column in grid.columns if ACCESS_COLUMN.match(column)]
+
+
+def interpolate(sorted_values, starts, counts, fractions):
+    """
+    Calculates quantiles of groups of sorted values with linear interpolation, like numpy.quantile
+
+    Args:
+        sorted_values: values sorted by group and value
+        starts: position of the first value of each group
+        counts: number of values of each group
+        fractions: quantiles to calculate (0-1)
+
+    Returns:
+        quantiles: array of shape (groups, quantiles), NaN for empty groups
+    """
+    fractions = np.asarray(fractions)
+    positions = starts[:, None] + fractions[None, :] * np.maximum(counts - 1, 0)[:, None]
+    lower = np.floor(positions).astype('int64')
+    upper = np.ceil(positions).astype('int64')
+    empty = counts == 0
+    lower[empty] = upper[empty] = 0
+    # Empty groups look up a padding value and get NaN
+    sorted_values = np.append(sorted_values, np.nan)
+    weight = positions - lower
+    quantiles = sorted_values[lower] * (1 - weight) + sorted_values[upper] * weight
+    quantiles[empty] = np.nan
+    return quantiles
+
+
+def jenks_breaks(points, classes=CLASSES):
+    """
+    Calculates the Fisher-Jenks natural breaks of many distributions at once with dynamic programming
+
+    Args:
+        points: array of shape (distributions, points), each row sorted in ascending order
+        classes: number of classes
+
+    Returns:
+        breaks: array of shape (distributions, classes + 1): the minimum, the upper limits of the classes but the
+            last one, and the maximum of each distribution
+    """
+    n_groups, n_points = points.shape
+    sums = np.concatenate([np.zeros((n_groups, 1)), np.cumsum(points, axis=1)], axis=1)
+    squares = np.concatenate([np.zeros((n_groups, 1)), np.cumsum(points ** 2, axis=1)], axis=1)
+    # cost[g, j, i]: sum of squared deviations of the points j..i of a distribution from their mean
+    j, i = np.meshgrid(np.arange(n_points), np.arange(n_points), indexing='ij')
+    sizes = np.maximum(i - j + 1, 1)
+    segment_sums = sums[:, i + 1] - sums[:, j]
+    cost = squares[:, i + 1] - squares[:, j] - segment_sums ** 2 / sizes
+    cost[:, j > i] = np.inf
+
+    best = cost[:, 0, :]
+    starts = []
+    for _ in range(1, classes):
+        # The last class starts at point j >= 1 and the previous classes cover the points before it
+        previous = np.concatenate([np.full((n_groups, 1), np.inf), best[:, :-1]], axis=1)
+        total = previous[:, :, None] + cost
+        starts.append(np.argmin(total, axis=1))
+        best = np.min(total, axis=1)
+
+    breaks = np.empty((n_groups, classes + 1))
+    breaks[:, 0] = points[:, 0]
+    breaks[:, classes] = points[:, -1]
+    rows = np.arange(n_groups)
+    end = np.full(n_groups, n_points - 1)
+    for k in range(classes - 1, 0, -1):
+        start = starts[k - 1][rows, end]
+        breaks[:, k] = points[rows, np.maximum(start - 1, 0)]
+        end = np.maximum(start - 1, 0)
+    # Distributions with fewer distinct values than classes get repeated limits
+    return np.maximum.accumulate(breaks, axis=1)
+
+
+def group_statistics(values, codes, n_groups, population):
+    """
+    Calculates the distribution statistics of an access field in groups of grid cells
+
+    Args:
+        values: values of the field in each cell
+        codes: group of each cell (0 to n_groups - 1)
+        n_groups: number of groups
+        population: population of each cell
+
+    Returns:
+        statistics: DataFrame with a row per group
+    """
+    valid = ~np.isnan(values)
+    values, codes, population = values[valid], codes[valid], population[valid]
+    counts = np.bincount(codes, minlength=n_groups)
+    populations = np.bincount(codes, weights=population, minlength=n_groups)
+    positive = values > 0
+
+    statistics = {
+        'cells': counts,
+        'population': populations,
+        'mean': np.bincount(codes, weights=values, minlength=n_groups) / np.where(counts > 0, counts, np.nan),
+        'weighted_mean': np.bincount(codes, weights=values * population, minlength=n_groups) / np.where(populations > 0, populations, np.nan),
+        'zero_share': np.bincount(codes, weights=~positive, minlength=n_groups) / np.where(counts > 0, counts, np.nan),
+        'zero_population_share': np.bincount(codes, weights=population * ~positive, minlength=n_groups) / np.where(populations > 0, populations, np.nan)
+    }
+
+    # Sorted by group and value, the cells with access are at the end of each group
+    order = np.lexsort((values, codes))
+    sorted_values = values[order]
+    starts = np.cumsum(counts) - counts
+    statistics['min'] = interpolate(sorted_values, starts, counts, [0])[:, 0]
+    statistics['max'] = interpolate(sorted_values, starts, counts, [1])[:, 0]
+
+    positive_counts = np.bincount(codes, weights=positive, minlength=n_groups).astype('int64')
+    positive_starts = starts + counts - positive_counts
+    for quantile, column in zip(QUANTILES, interpolate(sorted_values, positive_starts, positive_counts, QUANTILES).T):
+        statistics[f'q{round(quantile * 100)}'] = column
+
+    breaks = interpolate(sorted_values, positive_starts, positive_counts, np.linspace(0, 1, CLASSES + 1))
+    points = interpolate(sorted_values, positive_starts, positive_counts, np.linspace(0, 1, JENKS_POINTS))
+    natural = np.full((n_groups, CLASSES + 1), np.nan)
+    has_values = positive_counts > 0
+    indices = np.flatnonzero(has_values)
+    for start in range(0, len(indices), JENKS_BATCH):
+        batch = indices[start:start + JENKS_BATCH]
+        natural[batch] = jenks_breaks(points[batch])
+    for k in range(CLASSES + 1):
+        statistics[f'quantile_{k}'] = breaks[:, k]
+        statistics[f'jenks_{k}'] = natural[:, k]
+    return pd.DataFrame(statistics)
+
+
+def build_statistics(grid):
+    """
+    Calculates the distribution statistics of every access field in every municipality and in the whole country
+
+    Args:
+        grid: the national access data
+
+    Returns:
+        statistics: DataFrame indexed by area and field, with the number of cells with a value, their population,
+            min, max, mean, population-weighted mean, share of cells and of population without access, quantiles of
+            the cells with access (q10-q90), their quantile (quantile_0-6) and natural (jenks_0-6) class limits,
+            and the population size class of the municipality, its rank by the population-weighted mean among the
+            municipalities of the class (1 = best access) and the number of municipalities ranked in the class
+    """
+    codes, areas = pd.factorize(np.asarray(grid['mncplty'], dtype=object), sort=True)
+    # Protected small counts of the population grid are stored as negative numbers
+    population = grid[POPULATION_COLUMN].clip(lower=0).fillna(0).to_numpy(dtype='float64')
+    national = np.zeros(len(grid), dtype='int64')
+
+    tables = []
+    for column in access_columns(grid):
+        values = grid[column].to_numpy(dtype='float64')
+        for group_codes, names in [(codes, list(areas)), (national, [NATIONAL])]:
+            table = group_statistics(values, group_codes, len(names), population)
+            table.index = pd.MultiIndex.from_arrays([names, [column] * len(names)], names=['area', 'field'])
+            tables.append(table)
+    table = pd.concat(tables).sort_index()
+
+    # Population size classes by the total population of the municipalities, none for the whole country
+    sizes = pd.Series(np.bincount(codes, weights=population, minlength=len(areas)), index=areas)
+    sizes = pd.cut(sizes, SIZE_CLASSES, labels=SIZE_LABELS, right=False).astype(object)
+    table['size_class'] = table.index.get_level_values('area').map(sizes)
+    groups = table.groupby([table.index.get_level_values('field'), 'size_class'])['weighted_mean']
+    table['rank'] = groups.rank(ascending=False, method='min')
+    table['comparable'] = groups.transform('count')
+    return table
+
+
+def build_population_shares(grid):
+    """
+    Calculates the share of the population that can access at least each number of opportunities in THRESHOLDS, for
+    every access field, population group and municipality and the whole country. The cells are counted once per
+    field: each cell is assigned to the largest threshold its value reaches, and the population of the cells is
+    summed by municipality and threshold and accumulated from the largest threshold down.
+
+    Args:
+        grid: the national access data
+
+    Returns:
+        shares: DataFrame indexed by area, field and population group with a column (0-1) per threshold, NaN if
+            the group has no population in the area
+    """
+    codes, areas = pd.factorize(np.asarray(grid['mncplty'], dtype=object), sort=True)
+    names = [*areas, NATIONAL]
+    # Protected small counts of the population grid are stored as negative numbers
+    populations = {group: grid[columns].clip(lower=0).fillna(0).sum(axis=1).to_numpy(dtype='float64')
+                   for group, columns in AGE_GROUPS.items() if set(columns) <= set(grid.columns)}
+    levels = len(THRESHOLDS) + 1
+
+    tables = []
+    for column in access_columns(grid):
+        values = grid[column].to_numpy(dtype='float64')
+        valid = ~np.isnan(values)
+        keys = codes[valid] * levels + np.searchsorted(THRESHOLDS, values[valid], side='right')
+        for group, population in populations.items():
+            counts = np.bincount(keys, weights=population[valid], minlength=len(areas) * levels).reshape(len(areas), levels)
+            counts = np.vstack([counts, counts.sum(axis=0)])
+            # at_least[:, k]: population of the cells that reach at least k thresholds
+            at_least = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                shares = at_least[:, 1:] / at_least[:, :1]
+            index = pd.MultiIndex.from_arrays([names, [column] * len(names), [group] * len(names)], names=['area', 'field', 'group'])
+            tables.append(pd.DataFrame(shares, index=index, columns=THRESHOLDS))
+    return pd.concat(tables).sort_index()
+
+
+def grid_statistics():
+    """
+    Returns the statistics table of the shared grid, calculated once per grid version and shared by all sessions
+    """
+    grid = read_dataset('grid')
+    return cached(('grid statistics',), lambda: build_statistics(grid), datasets=('grid',))
+
+
+def grid_population_shares():
+    """
+    Returns the population shares table of the shared grid (see build_population_shares), calculated once per grid
+    version and shared by all sessions
+    """
+    grid = read_dataset('grid')
+    return cached(('grid population shares',), lambda: build_population_shares(grid), datasets=('grid',))
+
+
+def population_shares(area, column, threshold, table=None):
+    """
+    Returns the shares of the population groups of an area that can access at least a number of opportunities
+
+    Args:
+        area: municipality name or 'Finland'
+        column: access field, e.g. JL_ruok30
+        threshold: number of opportunities, one of THRESHOLDS
+        table: population shares table built with build_population_shares, the one of the shared grid by default
+
+    Returns:
+        shares: Series of shares (0-1) by population group, None if the area has no grid cells
+    """
+    table = grid_population_shares() if table is None else table
+    if (area, column) not in table.index:
+        return None
+    return table.loc[(area, column), threshold].reindex(list(AGE_GROUPS)).dropna()
+
+
+def statistics(area, column, table=None):
+    """
+    Returns the statistics of an access field in an area
+
+    Args:
+        area: municipality name or 'Finland'
+        column: access field, e.g. JL_ruok30
+        table: statistics table built with build_statistics, the one of the shared grid by default
+
+    Returns:
+        statistics: Series (see build_statistics), None if the area has no grid cells
+    """
+    table = grid_statistics() if table is None else table
+    key = (area, column)
+    return table.loc[key] if key in table.index else None
+
+
+def class_breaks(area, column, classification='equal', table=None):
+    """
+    Returns the class limits of a map of an access field
+
+    Args:
+        area: municipality name or 'Finland'
+        column: access field, e.g. JL_ruok30
+        classification: 'equal' for equally wide classes from 0 to the maximum, 'quantile' for classes with an equal
+            number of cells with access, or 'jenks' for natural breaks
+        table: statistics table built with build_statistics, the one of the shared grid by default
+
+    Returns:
+        bins: list of CLASSES + 1 class limits
+    """
+    row = statistics(area, column, table)
+    if row is None:
+        return [0] * (CLASSES + 1)
+    if classification == 'equal' or np.isnan(row['quantile_0']):
+        max_value = row['max']
+        return [0, max_value / 6, max_value / 3, max_value / 2, 2 * max_value / 3, 5 * max_value / 6, max_value]
+    return [float(row[f'{classification}_{k}']) for k in range(CLASSES + 1)]
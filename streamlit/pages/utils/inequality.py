@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+from pages.utils import POPULATION_COLUMN
+from pages.utils.compute_cache import cached
+from pages.utils.grid_stats import NATIONAL, access_columns
+from pages.utils.shared_data import read_dataset
+
+# Mean income of the residents of a grid cell, which orders the residents for the income-related measures
+INCOME_COLUMN = 'hr_mtu'
+# Share of the residents with the lowest and the highest income compared by the 20/20 ratio
+RATIO_SHARE = 0.2
+# Access fields processed at a time, which bounds the memory of the cell x field matrices
+FIELD_BATCH = 8
+
+# Inequality measures of the table: name of the column and description
+MEASURES = {
+    'gini': 'Gini index of access between residents (0 = equal access, 1 = all access concentrated on one resident)',
+    'theil': 'Theil index of access between residents (0 = equal access)',
+    'concentration': 'Income concentration index of access (positive = higher income residents have better access)',
+    'ratio_20_20': 'Mean access of the 20 % of residents with the highest income divided by that of the 20 % with the lowest'
+}
+
+
+def segment_cumsum(values, starts, counts):
+    """
+    Calculates cumulative sums of the rows of a matrix that restart at the first row of each segment
+
+    Args:
+        values: matrix with the rows sorted by segment
+        starts: first row of each segment
+        counts: number of rows of each segment
+
+    Returns:
+        sums: matrix of the inclusive cumulative sums within the segments
+    """
+    total = np.cumsum(values, axis=0)
+    offsets = np.vstack([np.zeros((1, values.shape[1])), total[starts[1:] - 1]])
+    return total - np.repeat(offsets, counts, axis=0)
+
+
+def group_inequality(values, income, population, codes, n_groups):
+    """
+    Calculates the inequality measures of access fields in groups of grid cells. The cells are sorted once by group
+    and income and once by group and value for all fields, and each measure is reduced per group with np.add.reduceat
+    over the sorted rows. The residents of a cell share its access and its mean income, so each cell is weighted by its
+    population, and a cell on the border of an income group is divided between the groups by its population.
+
+    Args:
+        values: matrix of the values of the fields (cells x fields), NaN where a cell has no value
+        income: mean income of each cell, NaN where it is not known
+        population: population of each cell
+        codes: group of each cell (0 to n_groups - 1)
+        n_groups: number of groups
+
+    Returns:
+        measures: dictionary of matrices (groups x fields) by measure (see MEASURES), NaN for groups without residents
+    """
+    valid = ~np.isnan(values)
+    x = np.where(valid, values, 0.0)
+    weights = population[:, None] * valid
+
+    # Sorted by group and income: the income-related measures
+    order = np.lexsort((np.nan_to_num(income), codes))
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    counts = np.diff(np.r_[starts, len(codes)])
+    groups = sorted_codes[starts]
+    x_income, w_income = x[order], weights[order] * ~np.isnan(income[order])[:, None]
+
+    measures = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w_total = np.add.reduceat(w_income, starts, axis=0)
+        w_group = np.repeat(w_total, counts, axis=0)
+        end = segment_cumsum(w_income, starts, counts) / w_group
+        start = end - w_income / w_group
+        access_mean = np.add.reduceat(w_income * x_income, starts, axis=0) / w_total
+        # Concentration index: twice the covariance of access and the fractional income rank, divided by the mean
+        rank = (start + end) / 2
+        measures['concentration'] = 2 * np.add.reduceat(w_income * x_income * rank, starts, axis=0) / (w_total * access_mean) - 1
+        bottom = np.clip(np.minimum(end, RATIO_SHARE) - start, 0, None) * w_group
+        top = np.clip(end - np.maximum(start, 1 - RATIO_SHARE), 0, None) * w_group
+        bottom_mean = np.add.reduceat(bottom * x_income, starts, axis=0) / np.add.reduceat(bottom, starts, axis=0)
+        top_mean = np.add.reduceat(top * x_income, starts, axis=0) / np.add.reduceat(top, starts, axis=0)
+        measures['ratio_20_20'] = top_mean / bottom_mean
+
+        # Sorted by group and value: the Gini and Theil indices. Adding the group code times the range of the values to
+        # the values sorts all fields by group and value with one argsort, in the same groups as above.
+        keys = codes[:, None] * (x.max(initial=0) + 1) + x
+        value_order = np.argsort(keys, axis=0, kind='stable')
+        x_value, w_value = np.take_along_axis(x, value_order, axis=0), np.take_along_axis(weights, value_order, axis=0)
+        w_total = np.add.reduceat(w_value, starts, axis=0)
+        access_total = np.add.reduceat(w_value * x_value, starts, axis=0)
+        cumulative = segment_cumsum(w_value * x_value, starts, counts)
+        # Area under the Lorenz curve of access by population, summed as trapezoids
+        lorenz = np.add.reduceat(w_value * (2 * cumulative - w_value * x_value), starts, axis=0)
+        measures['gini'] = 1 - lorenz / (w_total * access_total)
+        share = x_value / np.repeat(access_total / w_total, counts, axis=0)
+        theil = np.add.reduceat(w_value * np.where(share > 0, share * np.log(np.where(share > 0, share, 1)), 0), starts, axis=0) / w_total
+        # Like the Gini index, the Theil index is not defined for groups without access
+        measures['theil'] = np.where(access_total > 0, theil, np.nan)
+
+    result = {}
+    for measure, table in measures.items():
+        full = np.full((n_groups, values.shape[1]), np.nan)
+        full[groups] = np.where(np.isfinite(table), table, np.nan)
+        result[measure] = full
+    return result
+
+
+def build_inequality(grid):
+    """
+    Calculates the inequality measures of every access field in every municipality and in the whole country
+
+    Args:
+        grid: the national access data
+
+    Returns:
+        inequality: DataFrame indexed by area and field with a column per measure (see MEASURES)
+    """
+    codes, areas = pd.factorize(np.asarray(grid['mncplty'], dtype=object), sort=True)
+    # Protected small counts of the population grid are stored as negative numbers
+    population = grid[POPULATION_COLUMN].clip(lower=0).fillna(0).to_numpy(dtype='float64')
+    income = grid[INCOME_COLUMN].to_numpy(dtype='float64') if INCOME_COLUMN in grid.columns else np.full(len(grid), np.nan)
+    national = np.zeros(len(grid), dtype='int64')
+    columns = access_columns(grid)
+
+    tables = []
+    for batch in range(0, len(columns), FIELD_BATCH):
+        fields = columns[batch:batch + FIELD_BATCH]
+        values = grid[fields].to_numpy(dtype='float64')
+        for group_codes, names in [(codes, list(areas)), (national, [NATIONAL])]:
+            measures = group_inequality(values, income, population, group_codes, len(names))
+            index = pd.MultiIndex.from_product([names, fields], names=['area', 'field'])
+            tables.append(pd.DataFrame({measure: table.ravel() for measure, table in measures.items()}, index=index))
+    return pd.concat(tables).sort_index()[list(MEASURES)]
+
+
+def grid_inequality():
+    """
+    Returns the inequality table of the shared grid, calculated once per grid version and shared by all sessions
+    """
+    grid = read_dataset('grid')
+    return cached(('grid inequality',), lambda: build_inequality(grid), datasets=('grid',))
+
+
+def inequality(column, measure, table=None):
+    """
+    Returns an inequality measure of an access field in every municipality
+
+    Args:
+        column: access field, e.g. JL_ruok30
+        measure: one of MEASURES
+        table: inequality table built with build_inequality, the one of the shared grid by default
+
+    Returns:
+        values: Series of the measure indexed by municipality name, without the whole country
+    """
+    table = grid_inequality() if table is None else table
+    values = table.xs(column, level='field')[measure]
+    return values.drop(NATIONAL, errors='ignore')
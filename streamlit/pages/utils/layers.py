@@ -0,0 +1,258 @@
+import json
+import folium
+import numpy as np
+import pandas as pd
+from branca.element import Template
+from pages.utils.metrics import span
+from pages.utils.static_assets import MIN_FILE_BYTES, publish, static_layers
+
+# Number of positions per axis the coordinates of a layer are rounded to. Over the extent of Finland this is about
+# 10 m, and over a municipality less than a meter.
+QUANTIZATION = 100000
+# Significant digits kept of the numeric properties
+PROPERTY_DIGITS = 6
+OBJECT_NAME = 'layer'
+
+
+def quantize(data, quantization=QUANTIZATION):
+    """
+    Returns the transform of TopoJSON quantization for the extent of a layer
+
+    Returns:
+        transform: dictionary with the scale and translate of the quantized coordinates
+    """
+    x0, y0, x1, y1 = data.total_bounds
+    scale = [(x1 - x0) / (quantization - 1) or 1.0, (y1 - y0) / (quantization - 1) or 1.0]
+    return {'scale': scale, 'translate': [float(x0), float(y0)]}
+
+
+def polygon_rings(geometry):
+    """
+    Returns the polygons of a Polygon or MultiPolygon as lists of coordinate arrays of their rings, exterior first
+    """
+    polygons = getattr(geometry, 'geoms', [geometry])
+    return [[np.asarray(polygon.exterior.coords), *(np.asarray(ring.coords) for ring in polygon.interiors)]
+            for polygon in polygons if not polygon.is_empty]
+
+
+def property_value(value):
+    """
+    Converts a property to a JSON value, rounding floats to PROPERTY_DIGITS significant digits
+    """
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else float(f'{value:.{PROPERTY_DIGITS}g}')
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.bool_):
+        return bool(value)
+    return None if pd.isna(value) else value
+
+
+def compact_json(data):
+    """
+    Returns data as JSON without whitespace that can be embedded in a script element
+    """
+    text = json.dumps(data, separators=(',', ':'))
+    return text.replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026')
+
+
+def topology(data, properties=(), quantization=QUANTIZATION):
+    """
+    Encodes the polygons of a GeoDataFrame as quantized TopoJSON. The coordinates are rounded to a grid of
+    quantization x quantization positions and delta-encoded, and the borders shared by neighbouring polygons (e.g.
+    grid cells or municipalities) are stored once as arcs that the polygons refer to.
+
+    Args:
+        data: GeoDataFrame of Polygon and MultiPolygon geometries
+        properties: the columns kept as properties, only the ones used by styles and tooltips
+        quantization: number of positions per axis
+
+    Returns:
+        topology: TopoJSON dictionary with the polygons in objects.layer
+    """
+    transform = quantize(data, quantization)
+    (kx, ky), (x0, y0) = transform['scale'], transform['translate']
+
+    # Quantize the rings, dropping repeated positions and rings that collapse to fewer than three positions
+    shapes, rings = [], []
+    for geometry in data.geometry:
+        polygons = []
+        for polygon in polygon_rings(geometry) if geometry is not None else []:
+            ring_ids = []
+            for coordinates in polygon:
+                ring = np.round((coordinates[:, :2] - (x0, y0)) / (kx, ky)).astype('int64')
+                ring = ring[np.any(ring != np.roll(ring, 1, axis=0), axis=1)]
+                if len(ring) >= 3:
+                    ring_ids.append(len(rings))
+                    rings.append(ring[:, 0] * quantization + ring[:, 1])
+                elif not ring_ids:
+                    break
+            if ring_ids:
+                polygons.append(ring_ids)
+        shapes.append(polygons)
+
+    # A position is a junction if it has different neighbours in different rings: there the shared borders start or end
+    junctions = set()
+    if rings:
+        keys = np.concatenate(rings)
+        previous = np.concatenate([np.roll(ring, 1) for ring in rings])
+        following = np.concatenate([np.roll(ring, -1) for ring in rings])
+        neighbours = pd.DataFrame({'key': keys, 'low': np.minimum(previous, following), 'high': np.maximum(previous, following)})
+        counts = neighbours.drop_duplicates()['key'].value_counts()
+        junctions = set(counts.index[counts > 1])
+
+    # Cut the rings into arcs at the junctions and store each arc once, in either direction
+    arcs, arc_ids = [], {}
+
+    def arc_index(arc):
+        if arc in arc_ids:
+            return arc_ids[arc]
+        reverse = arc[::-1]
+        if reverse in arc_ids:
+            return ~arc_ids[reverse]
+        arc_ids[arc] = len(arcs)
+        arcs.append(arc)
+        return arc_ids[arc]
+
+    ring_arcs = []
+    for ring in rings:
+        keys = ring.tolist()
+        cuts = [i for i, key in enumerate(keys) if key in junctions]
+        if not cuts:
+            # A ring without junctions is one closed arc, which starts from its smallest position in the direction of
+            # its smaller neighbour so that the same ring of a neighbour is found in either direction
+            start = keys.index(min(keys))
+            keys = keys[start:] + keys[:start]
+            if keys[-1] < keys[1]:
+                keys = keys[:1] + keys[:0:-1]
+            ring_arcs.append([arc_index(tuple(keys + keys[:1]))])
+            continue
+        keys = keys[cuts[0]:] + keys[:cuts[0] + 1]
+        cuts = [cut - cuts[0] for cut in cuts] + [len(keys) - 1]
+        ring_arcs.append([arc_index(tuple(keys[start:end + 1])) for start, end in zip(cuts[:-1], cuts[1:])])
+
+    encoded = []
+    for arc in arcs:
+        positions = np.column_stack(np.divmod(np.asarray(arc, dtype='int64'), quantization))
+        encoded.append(np.vstack([positions[:1], np.diff(positions, axis=0)]).tolist())
+
+    geometries = []
+    columns = [data[column].tolist() for column in properties]
+    for i, polygons in enumerate(shapes):
+        # Features whose polygons collapse to nothing at the quantization are left out
+        if not polygons:
+            continue
+        geometry = {'properties': {column: property_value(values[i]) for column, values in zip(properties, columns)}}
+        if len(polygons) == 1:
+            geometry.update(type='Polygon', arcs=[ring_arcs[ring] for ring in polygons[0]])
+        else:
+            geometry.update(type='MultiPolygon', arcs=[[ring_arcs[ring] for ring in polygon] for polygon in polygons])
+        geometries.append(geometry)
+
+    return {
+        'type': 'Topology',
+        'transform': transform,
+        'objects': {OBJECT_NAME: {'type': 'GeometryCollection', 'geometries': geometries}},
+        'arcs': encoded
+    }
+
+
+class CompactGeoJson(folium.TopoJson):
+    """
+    A polygon layer like folium.GeoJson that is embedded in the map as quantized TopoJSON with only the given
+    properties. The distinct styles returned by the style and highlight functions are embedded once, and the features
+    refer to them by index. When the static folder is served, the TopoJSON of larger layers is written to a file named
+    by its hash instead, which the map fetches and browsers cache across reruns and sessions.
+
+    Args:
+        data: GeoDataFrame of Polygon and MultiPolygon geometries
+        page: page number under which the encoding time and the size of the encoded layer are recorded
+        properties: the columns used by the style functions and tooltips
+        style_function: function mapping a feature to a style dictionary
+        highlight_function: function mapping a feature to the style shown when the mouse is over it
+        quantization: number of positions per axis (see topology)
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }}_styles = {{ this.styles|tojson }};
+            var {{ this.get_name() }} = L.geoJson(
+                null,
+                {
+                    style: function(feature) {
+                        return {{ this.get_name() }}_styles[feature.properties.style];
+                    },
+                {%- if this.highlight_function is not none %}
+                    onEachFeature: function(feature, layer) {
+                        layer.on({
+                            mouseover: function(e) {
+                                e.target.setStyle({{ this.get_name() }}_styles[feature.properties.highlight]);
+                            },
+                            mouseout: function(e) {
+                                {{ this.get_name() }}.resetStyle(e.target);
+                            }
+                        });
+                    },
+                {%- endif %}
+                }
+            ).addTo({{ this._parent.get_name() }});
+            function {{ this.get_name() }}_add(data) {
+                {{ this.get_name() }}.addData(topojson.feature(data, data.objects.{{ this.object_name }}));
+            }
+        {%- if this.data_url %}
+            fetch({{ this.data_url|tojson }}).then(function(response) {
+                return response.json();
+            }).then({{ this.get_name() }}_add);
+        {%- else %}
+            {{ this.get_name() }}_add({{ this.data_json }});
+        {%- endif %}
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, data, page, properties=(), style_function=None, highlight_function=None, quantization=QUANTIZATION):
+        with span(page, 'encode_layer', rows=len(data)) as current:
+            super().__init__(topology(data, properties, quantization), f'objects.{OBJECT_NAME}', style_function=style_function)
+            self.payload_bytes = len(compact_json(self.data))
+            current.bytes = self.payload_bytes
+        self.object_name = OBJECT_NAME
+        self.highlight_function = highlight_function
+        self.page = page
+        self.styles = []
+        self.data_json = None
+        self.data_url = None
+
+    def render(self, **kwargs):
+        """
+        Renders the layer with the styles as indices and the TopoJSON without whitespace, either in the map or in a
+        static file
+        """
+        self.style_data()
+        self.data_json = compact_json(self.data)
+        if len(self.data_json) >= MIN_FILE_BYTES and static_layers():
+            with span(self.page, 'publish_layer') as current:
+                self.data_url = publish(self.data_json.encode('utf-8'), '.json')
+                current.bytes = len(self.data_json)
+        super().render(**kwargs)
+
+    def style_data(self):
+        """
+        Replaces the styles of the features with indices of the distinct styles
+        """
+        if self.styles:
+            return
+        indices = {}
+
+        def style_index(style):
+            key = json.dumps(style, sort_keys=True)
+            if key not in indices:
+                indices[key] = len(self.styles)
+                self.styles.append(style)
+            return indices[key]
+
+        for geometry in self.data['objects'][OBJECT_NAME]['geometries']:
+            feature = {'type': 'Feature', 'properties': dict(geometry['properties'])}
+            geometry['properties']['style'] = style_index(self.style_function(feature))
+            if self.highlight_function is not None:
+                geometry['properties']['highlight'] = style_index(self.highlight_function(feature))
@@ -0,0 +1,359 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from datetime import datetime, timezone
+from pathlib import Path
+import numpy as np
+from tornado.websocket import websocket_connect
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from pages.utils import BENCHMARK_FOLDER, PAGES_FOLDER
+from pages.utils.sessions import resident_memory
+
+RESULTS_FILE = BENCHMARK_FOLDER / 'loadtest.jsonl'
+APP_FILE = PAGES_FOLDER.parent / 'Equity_of_access_App.py'
+
+# Widget types whose values the simulated sessions can set
+WIDGETS = ('selectbox', 'multiselect', 'radio', 'checkbox')
+
+
+class Session:
+    """
+    A simulated browser session talking to a Streamlit server over its websocket, like the Streamlit frontend does
+    """
+
+    def __init__(self, port):
+        self.url = f'ws://127.0.0.1:{port}/_stcore/stream'
+        self.connection = None
+        self.pages = []
+        self.page_hash = ''
+        self.widgets = {}
+        self.values = {}
+        self.messages = {}
+        self.errors = []
+
+    async def connect(self):
+        self.connection = await websocket_connect(self.url, subprotocols=['streamlit'], max_message_size=1 << 30)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+    async def open_page(self, number):
+        """
+        Opens a page like a click in the sidebar, 0 is the landing page
+
+        Returns:
+            latency: seconds until the page script finished
+        """
+        if number and not self.pages:
+            await self.rerun()
+        self.page_hash = self.pages[number] if number else ''
+        self.values = {}
+        return await self.rerun()
+
+    def widget(self, label):
+        """
+        Returns the widget of the latest run whose label starts with the given text
+        """
+        for widget in self.widgets.values():
+            if widget['label'].startswith(label):
+                return widget
+        raise KeyError(f'No widget labelled {label!r} on the page')
+
+    def options(self, label):
+        return list(self.widget(label)['options'])
+
+    async def set(self, label, value):
+        """
+        Sets the value of a widget like a user would, and waits for the rerun
+
+        Args:
+            label: beginning of the label of the widget
+            value: option (selectbox, radio), list of options (multiselect) or bool (checkbox)
+
+        Returns:
+            latency: seconds until the page script finished
+        """
+        widget = self.widget(label)
+        if widget['type'] == 'checkbox':
+            self.values[widget['id']] = bool(value)
+        elif widget['type'] == 'multiselect':
+            self.values[widget['id']] = [widget['options'].index(option) for option in value]
+        else:
+            self.values[widget['id']] = widget['options'].index(value)
+        return await self.rerun()
+
+    async def rerun(self):
+        message = BackMsg()
+        message.rerun_script.query_string = ''
+        message.rerun_script.page_script_hash = self.page_hash
+        for widget_id, value in self.values.items():
+            kind = self.widgets[widget_id]['type'] if widget_id in self.widgets else None
+            state = message.rerun_script.widget_states.widgets.add()
+            state.id = widget_id
+            if kind == 'checkbox':
+                state.bool_value = value
+            elif kind == 'multiselect':
+                state.int_array_value.data.extend(value)
+            else:
+                state.int_value = value
+
+        start = time.perf_counter()
+        await self.connection.write_message(message.SerializeToString(), binary=True)
+        widgets = {}
+        while True:
+            data = await self.connection.read_message()
+            if data is None:
+                raise ConnectionError('The server closed the websocket')
+            forward = ForwardMsg()
+            forward.ParseFromString(data)
+            if forward.WhichOneof('type') == 'ref_hash':
+                forward = self.messages[forward.ref_hash]
+            elif forward.hash:
+                self.messages[forward.hash] = forward
+
+            kind = forward.WhichOneof('type')
+            if kind == 'new_session':
+                self.pages = [page.page_script_hash for page in forward.new_session.app_pages]
+            elif kind == 'delta' and forward.delta.WhichOneof('type') == 'new_element':
+                element = forward.delta.new_element
+                element_type = element.WhichOneof('type')
+                if element_type in WIDGETS:
+                    proto = getattr(element, element_type)
+                    widgets[proto.id] = {'type': element_type, 'id': proto.id, 'label': proto.label,
+                                         'options': list(getattr(proto, 'options', []))}
+                elif element_type == 'exception':
+                    self.errors.append(element.exception.message)
+            elif kind == 'script_finished':
+                if forward.script_finished == ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    continue
+                break
+
+        self.widgets = widgets
+        self.values = {widget_id: value for widget_id, value in self.values.items() if widget_id in widgets}
+        return time.perf_counter() - start
+
+
+def pick_area(session, rng, label, national_share):
+    """
+    Picks a municipality from a selectbox, or the whole country with the given probability
+    """
+    areas = [area for area in session.options(label) if area]
+    if 'Finland' in areas and rng.random() < national_share:
+        return 'Finland'
+    return rng.choice([area for area in areas if area != 'Finland'])
+
+
+async def page1(session, rng, steps, national_share):
+    latencies = [await session.open_page(1)]
+    types = session.options('Select opportunity types')
+    latencies.append(await session.set('Select opportunity types', rng.sample(types, rng.randint(1, len(types)))))
+    for _ in range(steps):
+        latencies.append(await session.set('Select a municipality', pick_area(session, rng, 'Select a municipality', national_share)))
+    return latencies
+
+
+async def page2(session, rng, steps, national_share):
+    latencies = [await session.open_page(2)]
+    municipalities = session.options('Select municipalities:')
+    for _ in range(steps // 2 + 1):
+        latencies.append(await session.set('Select municipalities:', rng.sample(municipalities, rng.randint(1, 3))))
+    latencies.append(await session.set('Compare municipalities', True))
+    for _ in range(steps - steps // 2):
+        latencies.append(await session.set('Select municipalities (selection 1)', rng.sample(municipalities, rng.randint(1, 3))))
+        latencies.append(await session.set('Select municipalities (selection 2)', rng.sample(municipalities, rng.randint(1, 3))))
+    return latencies
+
+
+async def page3(session, rng, steps, national_share):
+    latencies = [await session.open_page(3)]
+    latencies.append(await session.set('Select mode', rng.choice([mode for mode in session.options('Select mode') if mode])))
+    latencies.append(await session.set('Select opportunity type', rng.choice(['Pharmacy', 'Grocery store', 'Library', 'School'])))
+    for _ in range(steps):
+        latencies.append(await session.set('Select area of interest', pick_area(session, rng, 'Select area of interest', national_share)))
+        latencies.append(await session.set('Select travel time cut-off', rng.choice(session.options('Select travel time cut-off'))))
+    return latencies
+
+
+async def page4(session, rng, steps, national_share):
+    latencies = [await session.open_page(4)]
+    for _ in range(steps):
+        label = rng.choice(['Select mode', 'Select opportunity type', 'Select travel time cut-off'])
+        latencies.append(await session.set(label, rng.choice(session.options(label))))
+    return latencies
+
+
+# Widget sequences of the simulated users of each page
+SCENARIOS = {1: page1, 2: page2, 3: page3, 4: page4}
+
+
+async def run_session(port, page, seed, steps, national_share):
+    session = Session(port)
+    try:
+        await session.connect()
+        latencies = await SCENARIOS[page](session, random.Random(seed), steps, national_share)
+        return {'page': page, 'latencies': latencies, 'errors': session.errors}
+    except Exception as error:
+        return {'page': page, 'latencies': [], 'errors': session.errors + [f'{type(error).__name__}: {error}']}
+    finally:
+        session.close()
+
+
+async def run_level(port, pid, sessions, pages, steps, national_share, seed):
+    """
+    Runs the given number of concurrent sessions, spread evenly over the pages
+
+    Returns:
+        results: list of dictionaries with the latencies and errors of each session
+        seconds: wall clock time of the level
+        peak_rss: highest sampled RSS of the server (bytes)
+    """
+    peak_rss = resident_memory(pid) or 0
+    done = asyncio.Event()
+
+    async def sample_memory():
+        nonlocal peak_rss
+        while not done.is_set():
+            peak_rss = max(peak_rss, resident_memory(pid) or 0)
+            await asyncio.sleep(0.2)
+
+    sampler = asyncio.create_task(sample_memory())
+    start = time.perf_counter()
+    results = await asyncio.gather(*[
+        run_session(port, pages[i % len(pages)], seed + i, steps, national_share) for i in range(sessions)
+    ])
+    seconds = time.perf_counter() - start
+    done.set()
+    await sampler
+    return results, seconds, peak_rss
+
+
+def summarize(results, seconds, sessions, peak_rss):
+    """
+    Summarizes the latencies of a concurrency level by page
+
+    Returns:
+        rows: list of dictionaries with percentiles (ms), throughput (reruns/s) and peak RSS (MB)
+    """
+    rows = []
+    for page in sorted({result['page'] for result in results}) + ['all']:
+        selected = [result for result in results if page == 'all' or result['page'] == page]
+        latencies = np.array([latency for result in selected for latency in result['latencies']])
+        row = {
+            'sessions': sessions,
+            'page': page,
+            'reruns': len(latencies),
+            'errors': sum(len(result['errors']) for result in selected),
+            'throughput': len(latencies) / seconds,
+            'peak_rss_mb': peak_rss / 2 ** 20
+        }
+        for percentile in (50, 95, 99):
+            row[f'p{percentile}_ms'] = float(np.percentile(latencies, percentile) * 1000) if len(latencies) else None
+        rows.append(row)
+    return rows
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, env=None):
+    """
+    Starts the app in a local headless Streamlit server and waits until it answers its health check
+
+    Returns:
+        process: the server process
+    """
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'streamlit', 'run', str(APP_FILE), '--server.port', str(port), '--server.address', '127.0.0.1',
+         '--server.headless', 'true', '--browser.gatherUsageStats', 'false', '--server.fileWatcherType', 'none'],
+        cwd=APP_FILE.parent, env={**os.environ, 'EQUITY_METRICS_PORT': '0', **(env or {})},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/_stcore/health', timeout=1) as response:
+                if response.read() == b'ok':
+                    return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('The Streamlit server did not start within 60 s')
+
+
+def run(levels, pages, steps=5, national_share=0.1, seed=0, warmup=True):
+    """
+    Load tests the app in a local server with increasing numbers of concurrent sessions
+
+    Args:
+        levels: list of numbers of concurrent sessions
+        pages: list of page numbers the sessions are spread over
+        steps: number of widget changes per session
+        national_share: probability that a session picks the whole country instead of a municipality
+        seed: seed of the random widget choices
+        warmup: whether one session per page is run first, so that the libraries and datasets have been loaded
+
+    Returns:
+        record: dictionary with the settings and a summary row per concurrency level and page
+    """
+    port = free_port()
+    process = start_server(port)
+    rows = []
+    try:
+        if warmup:
+            asyncio.run(run_level(port, process.pid, len(pages), pages, 1, 0, seed - 1000))
+        for sessions in levels:
+            results, seconds, peak_rss = asyncio.run(run_level(port, process.pid, sessions, pages, steps, national_share, seed))
+            rows += summarize(results, seconds, sessions, peak_rss)
+            for error in sorted({error for result in results for error in result['errors']})[:5]:
+                print(f'Error with {sessions} sessions: {error}', file=sys.stderr)
+    finally:
+        process.terminate()
+        process.wait()
+
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'cpu_count': os.cpu_count(),
+        'pages': pages,
+        'steps': steps,
+        'national_share': national_share,
+        'rows': rows
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load tests the app with simulated concurrent sessions in a local Streamlit server.')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='numbers of concurrent sessions to test (default: 1 2 4 8 16)')
+    parser.add_argument('--pages', type=int, nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS), help='pages the sessions are spread over (default: all)')
+    parser.add_argument('--steps', type=int, default=5, help='widget changes per session (default: 5)')
+    parser.add_argument('--national-share', type=float, default=0.1, help='probability of selecting the whole country instead of a municipality (default: 0.1)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random widget choices (default: 0)')
+    parser.add_argument('--no-warmup', action='store_true', help='measure the cold start too')
+    parser.add_argument('--output', default=str(RESULTS_FILE), help=f'JSON lines file the results are appended to (default: {RESULTS_FILE})')
+    args = parser.parse_args()
+
+    record = run(args.sessions, args.pages, args.steps, args.national_share, args.seed, not args.no_warmup)
+    print(f"{'Sessions':>8} {'Page':>5} {'Reruns':>7} {'Errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'Reruns/s':>9} {'Peak RSS MB':>12}")
+    for row in record['rows']:
+        percentiles = ' '.join(f"{row[key]:>9.0f}" if row[key] is not None else f"{'-':>9}" for key in ('p50_ms', 'p95_ms', 'p99_ms'))
+        print(f"{row['sessions']:>8} {row['page']:>5} {row['reruns']:>7} {row['errors']:>6} {percentiles} {row['throughput']:>9.2f} {row['peak_rss_mb']:>12.0f}")
+
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(record) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import streamlit.components.v1 as components
+
+# The metrics endpoint listens on localhost only; set EQUITY_METRICS_PORT=0 to disable it.
+# With EQUITY_METRICS_LOG=1 every span is also logged as a line of JSON.
+METRICS_PORT = int(os.environ.get('EQUITY_METRICS_PORT', 9108))
+LOG_SPANS = os.environ.get('EQUITY_METRICS_LOG', '') not in ('', '0')
+
+# Upper bounds (s) of the duration histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+logger = logging.getLogger('equity.metrics')
+if LOG_SPANS and not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_lock = threading.Lock()
+_stages = {}
+_collectors = []
+_documents = {}
+_server = None
+
+
+class Span:
+    """
+    A timed stage of a page rerun. The rows processed and the bytes produced by the stage can be set while it runs.
+    """
+    __slots__ = ('page', 'stage', 'rows', 'bytes', 'duration')
+
+    def __init__(self, page, stage, rows=None):
+        self.page = page
+        self.stage = stage
+        self.rows = rows
+        self.bytes = None
+        self.duration = None
+
+
+class StageStats:
+    """
+    Aggregated spans of one stage of one page
+    """
+    __slots__ = ('count', 'duration', 'buckets', 'rows', 'bytes', 'last_bytes')
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.rows = 0
+        self.bytes = 0
+        self.last_bytes = None
+
+
+def record(span):
+    """
+    Adds a finished span to the aggregated stage statistics
+    """
+    with _lock:
+        stats = _stages.get((span.page, span.stage))
+        if stats is None:
+            stats = _stages[(span.page, span.stage)] = StageStats()
+        stats.count += 1
+        stats.duration += span.duration
+        for i, bound in enumerate(BUCKETS):
+            if span.duration <= bound:
+                stats.buckets[i] += 1
+                break
+        if span.rows is not None:
+            stats.rows += span.rows
+        if span.bytes is not None:
+            stats.bytes += span.bytes
+            stats.last_bytes = span.bytes
+
+    if LOG_SPANS:
+        logger.info(json.dumps({
+            'time': time.time(),
+            'session': session_id(),
+            'page': span.page,
+            'stage': span.stage,
+            'duration_s': round(span.duration, 6),
+            'rows': span.rows,
+            'bytes': span.bytes
+        }))
+
+
+@contextmanager
+def span(page, stage, rows=None):
+    """
+    Times a stage of a page rerun. Spans that end with an exception (including Streamlit's rerun and stop
+    exceptions) are not recorded.
+
+    Args:
+        page: page number (0 for the landing page)
+        stage: name of the stage, e.g. 'read_data' or 'folium_static'
+        rows: number of rows processed, can also be set on the yielded span
+
+    Yields:
+        span: the running Span
+    """
+    start_server()
+    current = Span(page, stage, rows)
+    start = time.perf_counter()
+    yield current
+    current.duration = time.perf_counter() - start
+    record(current)
+
+
+def map_html(m, page, publish=True):
+    """
+    Serializes a folium map to HTML like streamlit_folium.folium_static does, with the local copies of the map
+    libraries if they are used, and records the serialization time and the size of the HTML. When the maps are served
+    as static files, the HTML is written to one and its URL is returned instead.
+
+    Args:
+        m: folium.Map object
+        page: page number the map is displayed on
+        publish: Boolean value, if False the map and its layers are kept in the HTML (see static_assets.inline_assets)
+
+    Returns:
+        html: the rendered HTML document, or the URL path of the map file
+    """
+    import folium
+    from pages.utils.static_assets import inline_assets, localize, publish_map, static_maps
+
+    with span(page, 'folium_static') as current, (nullcontext() if publish else inline_assets()):
+        html = localize(folium.Figure().add_child(m).render())
+        current.bytes = len(html)
+    if not publish:
+        return html
+    if static_maps():
+        with span(page, 'publish_map'):
+            return publish_map(html)
+    return html
+
+
+def show_map(html, height=500, width=700):
+    """
+    Displays a map rendered with map_html
+
+    Args:
+        html: the rendered HTML document, or the URL path of the map file
+        height: height of the map (px)
+        width: width of the map (px)
+    """
+    if html.startswith('/'):
+        components.iframe(html, height=height + 10, width=width)
+    else:
+        components.html(html, height=height + 10, width=width)
+
+
+def session_id():
+    """
+    Returns the id of the Streamlit session running the current thread, None outside of sessions
+    """
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else None
+
+
+def add_collector(collector):
+    """
+    Adds a function returning extra lines of the metrics document, e.g. the session memory accounting
+    """
+    _collectors.append(collector)
+
+
+def add_document(path, render):
+    """
+    Serves the text returned by render at the given path of the metrics endpoint
+    """
+    _documents[path] = render
+
+
+def _labels(page, stage, **extra):
+    labels = {'page': str(page), 'stage': stage, **extra}
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def prometheus_text():
+    """
+    Renders the aggregated stage statistics in the Prometheus text exposition format
+
+    Returns:
+        text: the metrics document
+    """
+    with _lock:
+        stages = sorted(_stages.items())
+        lines = [
+            '# HELP equity_stage_duration_seconds Duration of the stages of page reruns.',
+            '# TYPE equity_stage_duration_seconds histogram'
+        ]
+        for (page, stage), stats in stages:
+            cumulative = 0
+            for bound, count in zip(BUCKETS, stats.buckets):
+                cumulative += count
+                lines.append(f'equity_stage_duration_seconds_bucket{_labels(page, stage, le=bound)} {cumulative}')
+            lines.append(f'equity_stage_duration_seconds_bucket{_labels(page, stage, le="+Inf")} {stats.count}')
+            lines.append(f'equity_stage_duration_seconds_sum{_labels(page, stage)} {stats.duration:.6f}')
+            lines.append(f'equity_stage_duration_seconds_count{_labels(page, stage)} {stats.count}')
+
+        lines += ['# HELP equity_stage_rows_total Rows processed by the stages of page reruns.',
+                  '# TYPE equity_stage_rows_total counter']
+        lines += [f'equity_stage_rows_total{_labels(page, stage)} {stats.rows}' for (page, stage), stats in stages if stats.rows]
+
+        lines += ['# HELP equity_stage_output_bytes_total Bytes of HTML produced by the stages of page reruns.',
+                  '# TYPE equity_stage_output_bytes_total counter']
+        lines += [f'equity_stage_output_bytes_total{_labels(page, stage)} {stats.bytes}' for (page, stage), stats in stages if stats.last_bytes is not None]
+
+        lines += ['# HELP equity_stage_last_output_bytes Bytes of HTML produced by the latest run of a stage.',
+                  '# TYPE equity_stage_last_output_bytes gauge']
+        lines += [f'equity_stage_last_output_bytes{_labels(page, stage)} {stats.last_bytes}' for (page, stage), stats in stages if stats.last_bytes is not None]
+
+    for collector in _collectors:
+        lines += collector()
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metrics document at /metrics and the documents added with add_document
+    """
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            body = prometheus_text().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif path in _documents:
+            body = _documents[path]().encode('utf-8')
+            content_type = 'text/plain; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth logging
+        pass
+
+
+def start_server(port=METRICS_PORT):
+    """
+    Starts the metrics endpoint on localhost in a background thread, once per process.
+    A port that is already in use is logged and the endpoint is left disabled.
+    """
+    global _server
+    if _server is not None or not port:
+        return
+    with _lock:
+        if _server is not None:
+            return
+        try:
+            _server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+        except OSError as error:
+            logger.warning('Metrics endpoint could not be started on port %s: %s', port, error)
+            _server = False
+            return
+    threading.Thread(target=_server.serve_forever, name='equity-metrics', daemon=True).start()
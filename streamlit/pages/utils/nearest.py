@@ -0,0 +1,169 @@
+import numpy as np
+import pandas as pd
+import streamlit as st
+from pyproj import Transformer
+from scipy.spatial import cKDTree
+from pages.utils.fca import OPPORTUNITY_TYPES
+from pages.utils.shared_data import on_reload, read_dataset, version
+
+# Distances are measured in ETRS-TM35FIN, the metric coordinate system of the source data
+METRIC_CRS = 'EPSG:3067'
+
+
+def projected_points(geometries):
+    """
+    Returns the centers of geometries in METRIC_CRS. The centers of the bounds are used, which for the grid cells
+    are their centroids.
+
+    Args:
+        geometries: GeoSeries in any coordinate reference system
+
+    Returns:
+        points: array of shape (len(geometries), 2) of x and y coordinates (m)
+    """
+    bounds = geometries.bounds.to_numpy()
+    x, y = (bounds[:, 0] + bounds[:, 2]) / 2, (bounds[:, 1] + bounds[:, 3]) / 2
+    if geometries.crs is not None and not geometries.crs.equals(METRIC_CRS):
+        x, y = Transformer.from_crs(geometries.crs, METRIC_CRS, always_xy=True).transform(x, y)
+    return np.column_stack([x, y])
+
+
+def projected_location(longitude, latitude):
+    """
+    Returns a location given in WGS84 coordinates in METRIC_CRS, as an x, y pair (m)
+    """
+    return Transformer.from_crs('EPSG:4326', METRIC_CRS, always_xy=True).transform(longitude, latitude)
+
+
+def opportunity_index():
+    """
+    Returns the KD-trees of the opportunities of each type, built once per version of the opportunity data and
+    shared by all sessions
+
+    Returns:
+        trees: dictionary of (cKDTree, row positions of the opportunities in read_dataset('opportunities')) by the
+        abbreviation of the opportunity type (see fca.OPPORTUNITY_TYPES)
+    """
+    return _opportunity_index(version('opportunities'))
+
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _opportunity_index(fingerprint):
+    opportunities = read_dataset('opportunities')
+    points = projected_points(opportunities.geometry)
+    trees = {}
+    for abbreviation, opportunity_type in OPPORTUNITY_TYPES.items():
+        rows = np.flatnonzero((opportunities['opprtnt'] == opportunity_type).to_numpy())
+        trees[abbreviation] = (cKDTree(points[rows]), rows)
+    return trees
+
+
+def grid_points():
+    """
+    Returns the centroids of the grid cells in METRIC_CRS, in the row order of read_dataset('grid')
+    """
+    return _grid_points(version('grid'))
+
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _grid_points(fingerprint):
+    return projected_points(read_dataset('grid').geometry)
+
+
+def nearest(points, opportunity_type_abbreviation, k=1):
+    """
+    Finds the k nearest opportunities of a type to each point by straight-line distance
+
+    Args:
+        points: array of shape (n, 2) of coordinates in METRIC_CRS
+        opportunity_type_abbreviation: abbreviation of the opportunity type (see fca.OPPORTUNITY_TYPES)
+        k: number of opportunities
+
+    Returns:
+        distances: array of shape (n, k) of distances (m), inf where there are fewer than k opportunities
+        rows: array of shape (n, k) of row positions in read_dataset('opportunities'), -1 where there are fewer than k
+    """
+    tree, rows = opportunity_index()[opportunity_type_abbreviation]
+    points = np.asarray(points, dtype='float64').reshape(-1, 2)
+    if tree.n == 0:
+        return np.full((len(points), k), np.inf), np.full((len(points), k), -1)
+    distances, found = tree.query(points, k=k)
+    distances, found = distances.reshape(len(points), k), found.reshape(len(points), k)
+    # Missing neighbours are returned with the index tree.n
+    return distances, np.where(found < tree.n, rows[np.minimum(found, tree.n - 1)], -1)
+
+
+def count_within(points, opportunity_type_abbreviation, radius):
+    """
+    Counts the opportunities of a type within a straight-line distance of each point
+
+    Args:
+        points: array of shape (n, 2) of coordinates in METRIC_CRS
+        opportunity_type_abbreviation: abbreviation of the opportunity type (see fca.OPPORTUNITY_TYPES)
+        radius: distance (m)
+
+    Returns:
+        counts: array of the number of opportunities for each point
+    """
+    tree, _ = opportunity_index()[opportunity_type_abbreviation]
+    points = np.asarray(points, dtype='float64').reshape(-1, 2)
+    return np.asarray(tree.query_ball_point(points, radius, return_length=True), dtype='int64').reshape(len(points))
+
+
+def distance_indicator(opportunity_type_abbreviation):
+    """
+    Calculates the straight-line distance from every grid cell to the nearest opportunity of a type, for comparison
+    with the travel time based indicators
+
+    Args:
+        opportunity_type_abbreviation: abbreviation of the opportunity type (see fca.OPPORTUNITY_TYPES)
+
+    Returns:
+        distances: array of distances (km), in the row order of read_dataset('grid')
+    """
+    return _distance_indicator(opportunity_type_abbreviation, version('grid'), version('opportunities'))
+
+
+@st.cache_data(show_spinner=False)
+def _distance_indicator(opportunity_type_abbreviation, grid_fingerprint, opportunity_fingerprint):
+    distances, _ = nearest(grid_points(), opportunity_type_abbreviation)
+    return distances[:, 0] / 1000
+
+
+def nearest_table(longitude, latitude, opportunity_type_abbreviation, k=5, radius=5000):
+    """
+    Lists the nearest opportunities of a type to a location given in WGS84 coordinates
+
+    Args:
+        longitude: longitude of the location
+        latitude: latitude of the location
+        opportunity_type_abbreviation: abbreviation of the opportunity type (see fca.OPPORTUNITY_TYPES)
+        k: number of listed opportunities
+        radius: distance (m) within which the opportunities are counted
+
+    Returns:
+        table: DataFrame of the names, municipalities and distances (km) of the nearest opportunities
+        count: number of opportunities within the radius
+    """
+    x, y = projected_location(longitude, latitude)
+    distances, rows = nearest([[x, y]], opportunity_type_abbreviation, k)
+    found = rows[0] >= 0
+    opportunities = read_dataset('opportunities')
+    table = pd.DataFrame({
+        'Name': opportunities['name'].to_numpy()[rows[0][found]],
+        'Municipality': opportunities['mncplty'].to_numpy()[rows[0][found]],
+        'Distance (km)': np.round(distances[0][found] / 1000, 2)
+    })
+    return table, int(count_within([[x, y]], opportunity_type_abbreviation, radius)[0])
+
+
+def clear_results(name, old, new):
+    """
+    Drops the cached distances when the grid or the opportunity data has been reloaded. The indices are keyed by the
+    version of the data and replaced on their next use.
+    """
+    if name in ('grid', 'opportunities'):
+        _distance_indicator.clear()
+
+
+on_reload(clear_results)
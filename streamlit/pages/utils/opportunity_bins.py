@@ -0,0 +1,107 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from pages.utils.compute_cache import cached
+from pages.utils.shared_data import read_dataset
+
+# Distance (m) from the center of a hexagon to its corners
+HEX_RADIUS = 10000
+# Projected CRS in which the points are binned, so that the hexagons have the same size everywhere
+BIN_CRS = 'EPSG:3067'
+# The points are drawn instead of the hexagons at this zoom level and above, or when there are at most MAX_POINTS of them
+POINT_ZOOM = 8
+MAX_POINTS = 2000
+
+
+def hexagon_indices(x, y, radius=HEX_RADIUS):
+    """
+    Assigns points to the pointy-top hexagons of a hexagonal grid
+
+    Args:
+        x, y: arrays of projected coordinates (m)
+        radius: distance from the center of a hexagon to its corners
+
+    Returns:
+        q, r: integer axial coordinates of the hexagon of each point
+    """
+    q = (np.sqrt(3) / 3 * x - y / 3) / radius
+    r = (2 / 3 * y) / radius
+    # Round the cube coordinates (q, -q - r, r) to the nearest hexagon, fixing the coordinate with the largest error
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq.astype('int64'), rr.astype('int64')
+
+
+def hexagons(q, r, radius=HEX_RADIUS):
+    """
+    Returns the polygons of hexagons given by their axial coordinates
+
+    Returns:
+        polygons: array of shapely polygons in the projected coordinates
+    """
+    center_x = radius * np.sqrt(3) * (q + r / 2)
+    center_y = radius * 1.5 * r
+    angles = np.radians(np.arange(7) * 60 - 30)
+    corners = np.stack([center_x[:, None] + radius * np.cos(angles), center_y[:, None] + radius * np.sin(angles)], axis=-1)
+    return shapely.polygons(corners)
+
+
+def build_bins(opportunities, radius=HEX_RADIUS):
+    """
+    Counts the opportunities of each type in the hexagons of a hexagonal grid
+
+    Args:
+        opportunities: GeoDataFrame of opportunity points with the type in 'opprtnt'
+        radius: distance from the center of a hexagon to its corners (m)
+
+    Returns:
+        bins: dictionary with 'types', the opportunity types, 'counts', an integer array of shape (types, hexagons),
+            and 'hexagons', a GeoSeries of the hexagons that contain at least one opportunity in the CRS of the data
+    """
+    points = opportunities.geometry.to_crs(BIN_CRS)
+    q, r = hexagon_indices(points.x.to_numpy(), points.y.to_numpy(), radius)
+    codes, cells = pd.factorize(pd.MultiIndex.from_arrays([q, r]))
+    type_codes, types = pd.factorize(np.asarray(opportunities['opprtnt'], dtype=object))
+    counts = np.bincount(type_codes * len(cells) + codes, minlength=len(types) * len(cells)).reshape(len(types), len(cells))
+    cell_q, cell_r = (np.asarray(values, dtype='float64') for values in zip(*cells)) if len(cells) else (np.empty(0), np.empty(0))
+    polygons = gpd.GeoSeries(hexagons(cell_q, cell_r, radius), crs=BIN_CRS).to_crs(opportunities.crs)
+    return {'types': list(types), 'counts': counts, 'hexagons': polygons}
+
+
+def opportunity_bins():
+    """
+    Returns the hexagon counts of the shared opportunity data, built once per dataset version and shared by all sessions
+    """
+    opportunities = read_dataset('opportunities')
+    return cached(('opportunity bins', HEX_RADIUS), lambda: build_bins(opportunities), datasets=('opportunities',))
+
+
+def density(selected_types, bins=None):
+    """
+    Sums the hexagon counts of the selected opportunity types
+
+    Args:
+        selected_types: opportunity types to count
+        bins: hexagon counts built with build_bins, the ones of the shared opportunity data by default
+
+    Returns:
+        density: GeoDataFrame of the hexagons with at least one selected opportunity and their 'count'
+    """
+    bins = opportunity_bins() if bins is None else bins
+    rows = [bins['types'].index(type) for type in selected_types if type in bins['types']]
+    counts = bins['counts'][rows].sum(axis=0)
+    nonzero = counts > 0
+    return gpd.GeoDataFrame({'count': counts[nonzero]}, geometry=bins['hexagons'][nonzero].reset_index(drop=True))
+
+
+def use_density(zoom_level, n_points):
+    """
+    Tells whether opportunities are drawn as hexagons: for the maps zoomed out too far to tell the points apart
+    """
+    return zoom_level < POINT_ZOOM and n_points > MAX_POINTS
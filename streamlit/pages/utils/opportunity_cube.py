@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+from pages.utils import POPULATION_COLUMN
+from pages.utils.compute_cache import cached
+from pages.utils.shared_data import read_dataset
+
+# Area of the counts of the whole country
+NATIONAL = 'Finland'
+# Opportunities per this many residents are shown in the per capita view
+PER_RESIDENTS = 10000
+
+
+def build_cube(opportunities, grid):
+    """
+    Counts the opportunities of each type in each municipality and in the whole country
+
+    Args:
+        opportunities: opportunity points with the municipality in 'mncplty', the type in 'opprtnt' and its color in 'color'
+        grid: population grid with the municipality in 'mncplty'
+
+    Returns:
+        cube: dictionary with 'counts', a DataFrame of the number of opportunities with a row per municipality of
+            either dataset and 'Finland' last and a column per opportunity type in alphabetical order, 'colors', the
+            color of each type, and 'population', the population of each municipality and of the whole country
+    """
+    population = grid[POPULATION_COLUMN].fillna(0).clip(lower=0).groupby(np.asarray(grid['mncplty'], dtype=object)).sum()
+    # Municipalities without opportunities are included with zero counts
+    municipalities = np.union1d(np.asarray(opportunities['mncplty'], dtype=object), population.index.to_numpy(dtype=object))
+    municipality_codes = np.searchsorted(municipalities, np.asarray(opportunities['mncplty'], dtype=object))
+    types, type_codes = np.unique(np.asarray(opportunities['opprtnt'], dtype=object), return_inverse=True)
+    counts = np.bincount(municipality_codes * len(types) + type_codes, minlength=len(municipalities) * len(types))
+    counts = counts.reshape(len(municipalities), len(types))
+    counts = pd.DataFrame(np.vstack([counts, counts.sum(axis=0)]), index=[*municipalities, NATIONAL], columns=types)
+
+    colors = pd.Series(np.asarray(opportunities['color'], dtype=object), index=np.asarray(opportunities['opprtnt'], dtype=object))
+    colors = colors[~colors.index.duplicated()].reindex(types)
+
+    population = population.reindex(municipalities, fill_value=0)
+    population[NATIONAL] = population.sum()
+    return {'counts': counts, 'colors': colors, 'population': population}
+
+
+def opportunity_cube():
+    """
+    Returns the opportunity count cube of the shared datasets, built once per dataset version and shared by all sessions
+    """
+    opportunities, grid = read_dataset('opportunities'), read_dataset('grid')
+    return cached(('opportunity cube',), lambda: build_cube(opportunities, grid), datasets=('opportunities', 'grid'))
+
+
+def type_counts(area, selected_types, cube=None):
+    """
+    Returns the number of opportunities of the selected types in an area
+
+    Args:
+        area: municipality name or 'Finland'
+        selected_types: opportunity types to count
+        cube: count cube built with build_cube, the one of the shared datasets by default
+
+    Returns:
+        counts: DataFrame with 'opprtnt', 'color' and 'count' of the selected types with at least one opportunity in
+            the area, in alphabetical order of the types
+    """
+    cube = opportunity_cube() if cube is None else cube
+    counts = cube['counts']
+    types = [type for type in counts.columns if type in set(selected_types)]
+    if area not in counts.index:
+        return pd.DataFrame({'opprtnt': [], 'color': [], 'count': []})
+    row = counts.loc[area, types]
+    row = row[row > 0]
+    return pd.DataFrame({'opprtnt': row.index, 'color': cube['colors'].reindex(row.index).to_numpy(), 'count': row.to_numpy()})
+
+
+def per_capita(selected_types, cube=None):
+    """
+    Returns the number of opportunities per PER_RESIDENTS residents of every municipality with residents
+
+    Args:
+        selected_types: opportunity types to include
+        cube: count cube built with build_cube, the one of the shared datasets by default
+
+    Returns:
+        per_capita: long DataFrame with 'mncplty', 'opprtnt', 'color' and 'per_capita'
+    """
+    cube = opportunity_cube() if cube is None else cube
+    counts = cube['counts'].drop(index=NATIONAL)
+    counts = counts[[type for type in counts.columns if type in set(selected_types)]]
+    population = cube['population'].reindex(counts.index)
+    rates = counts.div(population.where(population > 0), axis=0) * PER_RESIDENTS
+    rates = rates[population > 0].rename_axis(index='mncplty', columns='opprtnt').stack().rename('per_capita').reset_index()
+    return rates.assign(color=cube['colors'].reindex(rates['opprtnt']).to_numpy())
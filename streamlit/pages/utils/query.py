@@ -0,0 +1,75 @@
+import streamlit as st
+
+
+def initial_params(page):
+    """
+    Returns the query parameters of the URL the page was opened with in this session. They are read once per page
+    and session, because the defaults of the widgets are part of their identity and must not change while the user
+    changes the widgets.
+
+    Args:
+        page: page number
+
+    Returns:
+        params: dictionary of the lists of values of the query parameters
+    """
+    key = f'query parameters {page}'
+    if key not in st.session_state:
+        st.session_state[key] = st.experimental_get_query_params()
+    return st.session_state[key]
+
+
+def option_index(params, name, options, default=0):
+    """
+    Returns the index of the option given in a query parameter, used as the index of a selectbox or radio
+
+    Args:
+        params: query parameters (see initial_params)
+        name: name of the parameter
+        options: options of the widget
+        default: index used when the parameter is missing or not one of the options
+    """
+    options = [str(option) for option in options]
+    values = params.get(name, [])
+    return options.index(values[0]) if values and values[0] in options else default
+
+
+def option_defaults(params, name, options):
+    """
+    Returns the options given in a repeated query parameter, used as the default of a multiselect
+    """
+    options = set(str(option) for option in options)
+    return [value for value in params.get(name, []) if value in options]
+
+
+def text_value(params, name, default=''):
+    """
+    Returns the text given in a query parameter, used as the value of a text input
+    """
+    return params.get(name, [default])[0]
+
+
+def flag_value(params, name, default=False):
+    """
+    Returns the value of a checkbox given in a query parameter as 1 or 0
+    """
+    values = params.get(name)
+    return values[0] == '1' if values else default
+
+
+def share(**values):
+    """
+    Writes the selection of a page to the query parameters of the URL, so that the address of the page opens the same
+    selection when it is shared. Empty values are left out, lists become repeated parameters and booleans 1 or 0.
+
+    Args:
+        values: the selected values by parameter name
+    """
+    params = {}
+    for name, value in values.items():
+        if isinstance(value, bool):
+            value = int(value)
+        if value is None or (not isinstance(value, int) and len(value) == 0):
+            continue
+        params[name] = value
+    st.experimental_set_query_params(**params)
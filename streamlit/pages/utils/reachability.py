@@ -0,0 +1,136 @@
+import numpy as np
+import streamlit as st
+from scipy.spatial import cKDTree
+from pages.utils import GRID_ID_COLUMN, OPPORTUNITY_ID_COLUMN
+from pages.utils.compute_cache import cached
+from pages.utils.fca import TTM_DATASETS, positions, read_ttm
+from pages.utils.nearest import grid_points, projected_location
+from pages.utils.shared_data import read_dataset, version
+
+# Longest travel time (min) kept in the store, the largest value of the uint8 travel times
+MAX_TRAVEL_TIME = np.iinfo('uint8').max
+
+
+def compress(rows, columns, times, row_count):
+    """
+    Stores the travel times of a matrix by row in compressed sparse row form, sorted by travel time within each row
+    so that the pairs within a cut-off are a prefix of the row. Unlike a scipy sparse matrix, travel times of 0 are kept.
+    The travel times must not exceed MAX_TRAVEL_TIME.
+
+    Args:
+        rows: array of row positions of the pairs
+        columns: array of column positions of the pairs
+        times: array of travel times (min) of the pairs
+        row_count: number of rows
+
+    Returns:
+        indptr: array of length row_count + 1, the pairs of row i are indptr[i]:indptr[i + 1]
+        indices: array of the column positions of the pairs
+        times: array of the travel times of the pairs
+    """
+    order = np.lexsort((times, rows))
+    indptr = np.zeros(row_count + 1, dtype='int64')
+    np.cumsum(np.bincount(rows, minlength=row_count), out=indptr[1:])
+    return indptr, columns[order].astype('int32'), times[order].astype('uint8')
+
+
+def travel_time_store(mode_abbreviation):
+    """
+    Returns the travel time matrix of a mode indexed both by origin grid cell and by destination opportunity, built
+    once per version of the data and shared by all sessions
+
+    Args:
+        mode_abbreviation: JL (public transport) or PP (bicycle)
+
+    Returns:
+        store: dictionary with 'origins' (pairs by row position in read_dataset('grid')) and 'destinations' (pairs by
+        row position in read_dataset('opportunities')), each in the form returned by compress
+    """
+    return cached(('travel time store', mode_abbreviation), lambda: build_store(mode_abbreviation),
+                  datasets=('grid', 'opportunities', TTM_DATASETS[mode_abbreviation]))
+
+
+def build_store(mode_abbreviation):
+    """
+    Builds the origin and destination indexed travel time matrices of a mode (see travel_time_store)
+    """
+    grid = read_dataset('grid')
+    opportunities = read_dataset('opportunities')
+    grid_ids = grid[GRID_ID_COLUMN].to_numpy() if GRID_ID_COLUMN in grid.columns else np.arange(len(grid))
+    opportunity_ids = opportunities[OPPORTUNITY_ID_COLUMN].to_numpy() if OPPORTUNITY_ID_COLUMN in opportunities.columns else np.arange(len(opportunities))
+
+    ttm = read_ttm(mode_abbreviation)
+    origins = positions(grid_ids, ttm['from_id'])
+    destinations = positions(opportunity_ids, ttm['to_id'])
+    times = ttm['travel_time_p50'].to_numpy()
+    # Drop pairs whose origin or destination is not part of the data, and the travel times that do not fit the uint8
+    # storage of compress, which are far beyond the cut-offs of the app
+    valid = (origins >= 0) & (destinations >= 0) & (times <= MAX_TRAVEL_TIME)
+    origins, destinations, times = origins[valid], destinations[valid], times[valid]
+    return {
+        'origins': compress(origins, destinations, times, len(grid)),
+        'destinations': compress(destinations, origins, times, len(opportunities))
+    }
+
+
+def lookup(compressed, row, cutoff):
+    """
+    Returns the pairs of a row within a travel time cut-off
+
+    Args:
+        compressed: matrix in the form returned by compress
+        row: row position
+        cutoff: travel time cut-off (min)
+
+    Returns:
+        columns: array of the column positions reachable within the cut-off, the closest first
+        times: array of their travel times (min)
+    """
+    indptr, indices, times = compressed
+    start, end = indptr[row], indptr[row + 1]
+    end = start + np.searchsorted(times[start:end], cutoff, side='right')
+    return indices[start:end], times[start:end]
+
+
+def reachable_opportunities(mode_abbreviation, cell, cutoff):
+    """
+    Lists the opportunities that can be reached from a grid cell within a travel time cut-off
+
+    Args:
+        mode_abbreviation: JL (public transport) or PP (bicycle)
+        cell: row position of the grid cell in read_dataset('grid')
+        cutoff: travel time cut-off (min)
+
+    Returns:
+        opportunities: array of row positions in read_dataset('opportunities'), the closest first
+        times: array of their travel times (min)
+    """
+    return lookup(travel_time_store(mode_abbreviation)['origins'], cell, cutoff)
+
+
+def reaching_cells(mode_abbreviation, opportunity, cutoff):
+    """
+    Lists the grid cells from which an opportunity can be reached within a travel time cut-off
+
+    Args:
+        mode_abbreviation: JL (public transport) or PP (bicycle)
+        opportunity: row position of the opportunity in read_dataset('opportunities')
+        cutoff: travel time cut-off (min)
+
+    Returns:
+        cells: array of row positions in read_dataset('grid'), the closest first
+        times: array of their travel times (min)
+    """
+    return lookup(travel_time_store(mode_abbreviation)['destinations'], opportunity, cutoff)
+
+
+def nearest_cell(longitude, latitude):
+    """
+    Returns the row position in read_dataset('grid') of the grid cell closest to a location in WGS84 coordinates
+    """
+    return int(_grid_index(version('grid')).query(projected_location(longitude, latitude))[1])
+
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _grid_index(fingerprint):
+    return cKDTree(grid_points())
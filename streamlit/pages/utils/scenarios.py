@@ -0,0 +1,204 @@
+import numpy as np
+import pandas as pd
+import streamlit as st
+from pages.utils import POPULATION_COLUMN
+from pages.utils.fca import OPPORTUNITY_TYPES
+from pages.utils.nearest import nearest, opportunity_index, projected_location
+from pages.utils.reachability import reaching_cells
+from pages.utils.shared_data import read_dataset
+
+# Session state key of the scenario, shared by pages 3 and 4
+SCENARIO_KEY = 'scenario'
+OPEN = 'Open'
+CLOSE = 'Close'
+# Mean income of the residents of a grid cell, which orders the residents for the Palma ratio
+INCOME_COLUMN = 'hr_mtu'
+# Income groups of the Palma ratio: the top 10 % divided by the bottom 40 %
+PALMA_TOP = 0.1
+PALMA_BOTTOM = 0.4
+
+
+def current_scenario():
+    """
+    Returns the changes of the scenario of this session
+
+    Returns:
+        scenario: tuple of changes, (OPEN, type abbreviation, row of the proxy opportunity, latitude, longitude) for an
+        opened facility and (CLOSE, type abbreviation, row of the opportunity) for a closed one
+    """
+    return tuple(st.session_state.get(SCENARIO_KEY, ()))
+
+
+def open_facility(opportunity_type_abbreviation, latitude, longitude):
+    """
+    Adds a facility at a location to the scenario. The travel times of a new location are not known, so the facility
+    is reached like the existing opportunity nearest to it (of any type), whose travel times are precomputed.
+
+    Returns:
+        distance: distance from the location to the proxy opportunity (m)
+    """
+    location = projected_location(longitude, latitude)
+    trees = opportunity_index()
+    candidates = [nearest([location], abbreviation) for abbreviation in trees]
+    distance, row = min((distances[0, 0], rows[0, 0]) for distances, rows in candidates)
+    st.session_state[SCENARIO_KEY] = current_scenario() + ((OPEN, opportunity_type_abbreviation, int(row), latitude, longitude),)
+    return distance
+
+
+def close_facility(opportunity_type_abbreviation, latitude, longitude):
+    """
+    Removes the existing facility of a type nearest to a location in the scenario
+
+    Returns:
+        row: the row position of the closed facility in read_dataset('opportunities'), None if it had already been closed
+    """
+    distances, rows = nearest([projected_location(longitude, latitude)], opportunity_type_abbreviation)
+    change = (CLOSE, opportunity_type_abbreviation, int(rows[0, 0]))
+    if rows[0, 0] < 0 or change in current_scenario():
+        return None
+    st.session_state[SCENARIO_KEY] = current_scenario() + (change,)
+    return change[2]
+
+
+def scenario_delta(scenario, mode_abbreviation, opportunity_type_abbreviation, cutoff, cell_count):
+    """
+    Calculates the change of the cumulative access of every grid cell caused by a scenario. Only the travel time
+    column of each changed facility is looked up (see reachability.reaching_cells), so a change costs a row lookup
+    instead of a recalculation of the access of all cells.
+
+    Args:
+        scenario: changes of the scenario (see current_scenario)
+        mode_abbreviation: JL (public transport) or PP (bicycle)
+        opportunity_type_abbreviation: abbreviation of the opportunity type of the access field
+        cutoff: travel time cut-off (min)
+        cell_count: number of grid cells
+
+    Returns:
+        delta: integer array of the change of the number of accessible opportunities, in the row order of read_dataset('grid')
+    """
+    delta = np.zeros(cell_count, dtype='int64')
+    for action, abbreviation, row, *_ in scenario:
+        if abbreviation != opportunity_type_abbreviation:
+            continue
+        cells, _ = reaching_cells(mode_abbreviation, row, int(cutoff))
+        np.add.at(delta, cells, 1 if action == OPEN else -1)
+    return delta
+
+
+def palma_ratio(access, income, population):
+    """
+    Calculates the Palma ratio of an area: the population-weighted mean access of the 10 % of the residents with the
+    highest income divided by that of the 40 % with the lowest income. The residents of a grid cell share its mean
+    income, and a cell on the border of a group is divided between the groups by its population.
+
+    Args:
+        access: array of the access of the grid cells of the area
+        income: array of the mean income of the cells
+        population: array of the population of the cells
+
+    Returns:
+        ratio: the Palma ratio, NaN if the area has no residents or the bottom 40 % has no access
+    """
+    order = np.argsort(income, kind='stable')
+    access, population = np.asarray(access, dtype='float64')[order], np.asarray(population, dtype='float64')[order]
+    total = population.sum()
+    if total <= 0:
+        return np.nan
+    end = np.cumsum(population) / total
+    start = end - population / total
+    # Share of the population of each cell that falls into the bottom and the top group
+    bottom = np.clip(np.minimum(end, PALMA_BOTTOM) - start, 0, None) * total
+    top = np.clip(end - np.maximum(start, 1 - PALMA_TOP), 0, None) * total
+    bottom_mean = (bottom * access).sum() / bottom.sum()
+    top_mean = (top * access).sum() / top.sum()
+    return top_mean / bottom_mean if bottom_mean > 0 else np.nan
+
+
+def scenario_palma(scenario, mode_abbreviation, opportunity_type_abbreviation, travel_time_value):
+    """
+    Recalculates the Palma ratios of the municipalities whose access a scenario changes. The ratios of the other
+    municipalities do not change and are not recalculated.
+
+    Args:
+        scenario: changes of the scenario (see current_scenario)
+        mode_abbreviation: JL (public transport) or PP (bicycle)
+        opportunity_type_abbreviation: abbreviation of the opportunity type of the access field
+        travel_time_value: travel time cut-off (30, 45 or 60)
+
+    Returns:
+        palma: DataFrame of the Palma ratios calculated from the grid before and after the scenario, indexed by
+        municipality name, empty if the scenario does not change the selected access field
+    """
+    grid = read_dataset('grid')
+    access = grid[f'{mode_abbreviation}_{opportunity_type_abbreviation}{travel_time_value}'].fillna(0).to_numpy()
+    delta = scenario_delta(scenario, mode_abbreviation, opportunity_type_abbreviation, travel_time_value, len(grid))
+    municipalities = grid['mncplty'].to_numpy()
+    changed = pd.unique(municipalities[delta != 0])
+    income = grid[INCOME_COLUMN].fillna(0).to_numpy()
+    # Protected small counts of the population grid are stored as negative numbers
+    population = grid[POPULATION_COLUMN].fillna(0).clip(lower=0).to_numpy()
+
+    rows = []
+    for municipality in changed:
+        cells = municipalities == municipality
+        before = palma_ratio(access[cells], income[cells], population[cells])
+        after = palma_ratio(np.maximum(access[cells] + delta[cells], 0), income[cells], population[cells])
+        rows.append((municipality, before, after))
+    return pd.DataFrame(rows, columns=['Kunta', 'Palma ratio', 'Scenario']).set_index('Kunta')
+
+
+def describe(scenario):
+    """
+    Lists the changes of a scenario as a table
+    """
+    opportunities = read_dataset('opportunities')
+    rows = []
+    for action, abbreviation, row, *location in scenario:
+        if action == OPEN:
+            name = f'New {OPPORTUNITY_TYPES[abbreviation].lower()} at {location[0]:.4f}, {location[1]:.4f}'
+        else:
+            name = opportunities['name'].iloc[row]
+        rows.append((action, OPPORTUNITY_TYPES[abbreviation], name))
+    return pd.DataFrame(rows, columns=['Change', 'Type', 'Facility'])
+
+
+def scenario_editor(page, latitude, longitude):
+    """
+    Shows the controls for opening and closing facilities in the scenario of the session and the list of its changes
+
+    Args:
+        page: page number, used in the widget keys
+        latitude: default latitude of the location of a change
+        longitude: default longitude of the location of a change
+
+    Returns:
+        scenario: changes of the scenario (see current_scenario)
+    """
+    st.markdown('##### What-if scenario')
+    col1, col2, col3, col4 = st.columns([1, 1, 1, 1])
+    with col1:
+        action = st.radio('Facility to:', (OPEN, CLOSE), horizontal=True, key=f'scenario action {page}')
+    with col2:
+        opportunity_type = st.selectbox('Facility type:', tuple(OPPORTUNITY_TYPES.values()), key=f'scenario type {page}')
+    with col3:
+        latitude = st.number_input('Latitude of the facility:', -90.0, 90.0, round(latitude, 4), format='%.4f', key=f'scenario latitude {page}')
+    with col4:
+        longitude = st.number_input('Longitude of the facility:', -180.0, 180.0, round(longitude, 4), format='%.4f', key=f'scenario longitude {page}')
+    abbreviation = {name: abbreviation for abbreviation, name in OPPORTUNITY_TYPES.items()}[opportunity_type]
+
+    col1, col2, _ = st.columns([1, 1, 2])
+    with col1:
+        if st.button('Add to scenario', key=f'scenario add {page}'):
+            if action == OPEN:
+                distance = open_facility(abbreviation, latitude, longitude)
+                st.info(f'The new facility is reached like the existing facility {distance / 1000:.1f} km from it.')
+            elif close_facility(abbreviation, latitude, longitude) is None:
+                st.info(f'The {opportunity_type.lower()} nearest to the location is already closed.')
+    with col2:
+        if st.button('Clear scenario', key=f'scenario clear {page}'):
+            st.session_state[SCENARIO_KEY] = ()
+
+    scenario = current_scenario()
+    if scenario:
+        st.dataframe(describe(scenario), hide_index=True)
+    return scenario
@@ -0,0 +1,297 @@
+import ctypes
+import gc
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
+import shapely
+from pympler.asizeof import asizeof
+from streamlit.runtime import Runtime
+from streamlit.runtime.app_session import AppSessionState
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from pages.utils import metrics
+from pages.utils.shared_data import is_shared
+
+# Heavy session objects that have not been used for this long are evicted; 0 disables the idle eviction
+IDLE_MINUTES = float(os.environ.get('EQUITY_SESSION_IDLE_MINUTES', 30))
+# When the resident memory of the process exceeds this limit, the least recently used session objects are evicted
+# until enough memory has been released; 0 disables the limit
+RSS_LIMIT_MB = float(os.environ.get('EQUITY_RSS_LIMIT_MB', 0))
+# Seconds between eviction checks
+CHECK_INTERVAL = float(os.environ.get('EQUITY_EVICTION_INTERVAL', 60))
+
+# Approximate memory of a shapely geometry besides its coordinates (GEOS object and Python wrapper)
+GEOMETRY_OVERHEAD = 200
+
+# Evictions are logged with the spans when EQUITY_METRICS_LOG=1
+logger = logging.getLogger('equity.metrics.sessions')
+
+_lock = threading.Lock()
+# {session id: {key: TrackedObject}}
+_tracked = {}
+_evictions = {'idle': 0, 'memory': 0}
+_evicted_bytes = {'idle': 0, 'memory': 0}
+_thread = None
+
+
+class TrackedObject:
+    """
+    A heavy object stored in the session state of a session, with the time it was last used and its estimated size
+    """
+    __slots__ = ('object_id', 'nbytes', 'last_used')
+
+    def __init__(self, object_id, nbytes, last_used):
+        self.object_id = object_id
+        self.nbytes = nbytes
+        self.last_used = last_used
+
+
+def object_size(obj):
+    """
+    Estimates the memory used by an object stored in the session state
+
+    Args:
+        obj: a (Geo)DataFrame, numpy array or any other Python object
+
+    Returns:
+        nbytes: estimated size in bytes, 0 for the datasets shared by all sessions
+    """
+    if is_shared(obj):
+        return 0
+    if isinstance(obj, pd.DataFrame):
+        nbytes = int(obj.memory_usage(deep=True, index=True).sum())
+        for column in obj.columns[obj.dtypes == 'geometry']:
+            geometries = np.asarray(obj[column].values)
+            nbytes += int(shapely.get_num_coordinates(geometries).sum()) * 16 + GEOMETRY_OVERHEAD * len(geometries)
+        return nbytes
+    if isinstance(obj, np.ndarray):
+        if obj.dtype == object:
+            return obj.nbytes + sum(sys.getsizeof(value) for value in obj.flat)
+        return obj.nbytes
+    return asizeof(obj)
+
+
+def resident_memory(pid='self'):
+    """
+    Returns the resident set size (RSS) of a process in bytes, None where /proc is not available
+
+    Args:
+        pid: process id, this process by default
+    """
+    try:
+        with open(f'/proc/{pid}/status', encoding='ascii') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def track(*keys):
+    """
+    Registers objects of the current session's st.session_state as heavy objects, and marks them used now.
+    Pages call this whenever they use the objects. Evicted objects are simply missing from the session state,
+    so the pages reload them with their usual "if key not in st.session_state" check.
+
+    Args:
+        keys: session state keys of the objects
+    """
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return
+    start_eviction()
+    now = time.monotonic()
+    with _lock:
+        objects = _tracked.setdefault(ctx.session_id, {})
+        for key in keys:
+            if key not in ctx.session_state:
+                continue
+            obj = ctx.session_state[key]
+            tracked = objects.get(key)
+            if tracked is None or tracked.object_id != id(obj):
+                objects[key] = TrackedObject(id(obj), object_size(obj), now)
+            else:
+                tracked.last_used = now
+
+
+def _app_sessions():
+    """
+    Returns the sessions of the running Streamlit server by id
+    """
+    if not Runtime.exists():
+        return {}
+    return {info.session.id: info.session for info in Runtime.instance()._session_mgr.list_sessions()}
+
+
+def session_report():
+    """
+    Lists the tracked heavy objects of every session
+
+    Returns:
+        report: DataFrame with the session id, key, estimated size (bytes) and idle time (s) of each object
+    """
+    now = time.monotonic()
+    with _lock:
+        rows = [
+            {'session': session_id, 'key': key, 'bytes': tracked.nbytes, 'idle_s': round(now - tracked.last_used)}
+            for session_id, objects in _tracked.items() for key, tracked in objects.items()
+        ]
+    return pd.DataFrame(rows, columns=['session', 'key', 'bytes', 'idle_s'])
+
+
+def _evict(candidates, reason, sessions):
+    """
+    Deletes objects from the session states of sessions whose script is not running
+
+    Args:
+        candidates: list of (session id, key) tuples
+        reason: 'idle' or 'memory'
+        sessions: the sessions of the server by id
+
+    Returns:
+        freed: estimated number of bytes released
+    """
+    freed = 0
+    for session_id, key in candidates:
+        session = sessions.get(session_id)
+        if session is None or session._state == AppSessionState.APP_IS_RUNNING:
+            continue
+        with _lock:
+            tracked = _tracked.get(session_id, {}).pop(key, None)
+        if tracked is None:
+            continue
+        session_state = session.session_state
+        if key in session_state and id(session_state[key]) == tracked.object_id:
+            del session_state[key]
+        freed += tracked.nbytes
+        _evictions[reason] += 1
+        _evicted_bytes[reason] += tracked.nbytes
+        logger.info(json.dumps({'time': time.time(), 'event': 'evict', 'reason': reason, 'session': session_id,
+                                'key': key, 'bytes': tracked.nbytes}))
+    return freed
+
+
+def _release_memory():
+    """
+    Collects the evicted objects and returns the freed heap to the operating system where possible
+    """
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def evict(now=None):
+    """
+    Applies the eviction policy once: objects idle for longer than IDLE_MINUTES are evicted, and if the resident
+    memory still exceeds RSS_LIMIT_MB, the least recently used objects are evicted until the estimated excess has
+    been released. Objects of closed sessions are forgotten.
+
+    Returns:
+        freed: estimated number of bytes released
+    """
+    now = time.monotonic() if now is None else now
+    sessions = _app_sessions()
+    with _lock:
+        for session_id in [session_id for session_id in _tracked if session_id not in sessions]:
+            del _tracked[session_id]
+        by_last_use = sorted(
+            ((tracked.last_used, session_id, key) for session_id, objects in _tracked.items() for key, tracked in objects.items()),
+            key=lambda item: item[0]
+        )
+
+    freed = 0
+    if IDLE_MINUTES:
+        idle = [(session_id, key) for last_used, session_id, key in by_last_use if now - last_used > IDLE_MINUTES * 60]
+        freed += _evict(idle, 'idle', sessions)
+
+    rss = resident_memory()
+    if RSS_LIMIT_MB and rss is not None and rss - freed > RSS_LIMIT_MB * 2 ** 20:
+        excess = rss - freed - RSS_LIMIT_MB * 2 ** 20
+        for last_used, session_id, key in by_last_use:
+            if excess <= 0:
+                break
+            released = _evict([(session_id, key)], 'memory', sessions)
+            excess -= released
+            freed += released
+
+    if freed:
+        _release_memory()
+    return freed
+
+
+def _run_eviction():
+    while True:
+        time.sleep(CHECK_INTERVAL)
+        try:
+            evict()
+        except Exception:
+            logger.exception('Evicting session objects failed')
+
+
+def start_eviction():
+    """
+    Starts the eviction check in a background thread, once per process
+    """
+    global _thread
+    if _thread is not None or not (IDLE_MINUTES or RSS_LIMIT_MB):
+        return
+    with _lock:
+        if _thread is not None:
+            return
+        _thread = threading.Thread(target=_run_eviction, name='equity-eviction', daemon=True)
+    _thread.start()
+
+
+def prometheus_lines():
+    """
+    Renders the session memory accounting for the metrics endpoint
+    """
+    report = session_report()
+    lines = [
+        '# HELP equity_process_resident_bytes Resident memory of the app process.',
+        '# TYPE equity_process_resident_bytes gauge',
+        f'equity_process_resident_bytes {resident_memory() or 0}',
+        '# HELP equity_sessions_tracked Sessions holding heavy objects in their session state.',
+        '# TYPE equity_sessions_tracked gauge',
+        f'equity_sessions_tracked {report["session"].nunique()}',
+        '# HELP equity_session_objects_bytes Estimated memory of the heavy session state objects by key.',
+        '# TYPE equity_session_objects_bytes gauge'
+    ]
+    lines += [f'equity_session_objects_bytes{{key="{key}"}} {nbytes}' for key, nbytes in report.groupby('key')['bytes'].sum().items()]
+    lines += ['# HELP equity_session_evictions_total Heavy session objects evicted.',
+              '# TYPE equity_session_evictions_total counter']
+    lines += [f'equity_session_evictions_total{{reason="{reason}"}} {count}' for reason, count in _evictions.items()]
+    lines += ['# HELP equity_session_evicted_bytes_total Estimated memory of the evicted session objects.',
+              '# TYPE equity_session_evicted_bytes_total counter']
+    lines += [f'equity_session_evicted_bytes_total{{reason="{reason}"}} {nbytes}' for reason, nbytes in _evicted_bytes.items()]
+    return lines
+
+
+def report_text():
+    """
+    Renders the per-session memory accounting as a plain text table for operators
+    """
+    report = session_report()
+    rss = resident_memory()
+    header = [
+        f'Resident memory: {rss / 2 ** 20:.0f} MB' if rss is not None else 'Resident memory: unknown',
+        f'Idle eviction: {IDLE_MINUTES:g} min' if IDLE_MINUTES else 'Idle eviction: disabled',
+        f'Memory limit: {RSS_LIMIT_MB:g} MB' if RSS_LIMIT_MB else 'Memory limit: disabled',
+        f'Evicted objects: {_evictions["idle"]} idle, {_evictions["memory"]} over the memory limit',
+        ''
+    ]
+    if report.empty:
+        return '\n'.join(header + ['No heavy session objects']) + '\n'
+    report['MB'] = (report.pop('bytes') / 2 ** 20).round(1)
+    return '\n'.join(header) + '\n' + report.sort_values('idle_s').to_string(index=False) + '\n'
+
+
+metrics.add_collector(prometheus_lines)
+metrics.add_document('/sessions', report_text)
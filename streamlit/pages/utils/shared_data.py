@@ -0,0 +1,296 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from pathlib import Path
+from pages.utils import metrics
+from pages.utils.data_build import BUILD_FOLDER, DATASETS, build, fingerprint, load, open_artifact
+from pages.utils.data_store import pinned_versions
+
+# Folder the datasets are published to as uncompressed Arrow IPC files. On Linux /dev/shm is a RAM-backed tmpfs,
+# so every worker process memory maps the same pages instead of holding its own copy of the data.
+SHARED_FOLDER = Path(os.environ.get('EQUITY_SHARED_DATA', '/dev/shm/equity-of-access'))
+
+# Seconds between checks for changed source files of the loaded datasets; 0 disables the reload
+RELOAD_INTERVAL = float(os.environ.get('EQUITY_RELOAD_INTERVAL', 30))
+
+# Reloads are logged with the timed stages when EQUITY_METRICS_LOG=1
+logger = logging.getLogger('equity.metrics.shared_data')
+
+# Reentrant, as a pinned version may be released by the garbage collector in a thread that holds the lock
+_lock = threading.RLock()
+# Ids of the datasets returned by read_dataset, which are shared by all sessions of the process
+_shared_ids = set()
+# {dataset name: fingerprint of the version used by new reruns}
+_versions = {}
+# {(dataset name, fingerprint): data}
+_loaded = {}
+# {(dataset name, fingerprint): threading.Event set when the version has been loaded}
+_loading = {}
+# {(dataset name, fingerprint)} of the versions that have been replaced by a newer one
+_replaced = set()
+# {(dataset name, fingerprint): number of reruns that have pinned the version}
+_pins = {}
+# Functions called with the dataset name, old and new fingerprint after a new version has been swapped in
+_listeners = []
+# {dataset name: fingerprint} of changed datasets seen by the last check, reloaded if unchanged at the next check
+_pending = {}
+_reloads = {}
+_watcher = None
+
+
+def publish(names=None, folder=SHARED_FOLDER):
+    """
+    Publishes the optimized datasets as Arrow IPC files, once for all worker processes. Datasets that are up to
+    date in the build folder are copied from there, the others are built from the data folder.
+
+    Args:
+        names: names of the datasets to publish, all available datasets by default
+        folder: folder to publish to
+
+    Returns:
+        manifest: dictionary of the published datasets (see data_build.build)
+    """
+    return build(names, folder, reuse=BUILD_FOLDER)
+
+
+def attach(name, folder=SHARED_FOLDER):
+    """
+    Memory maps a published dataset
+
+    Args:
+        name: name of the dataset
+        folder: folder the datasets have been published to
+
+    Returns:
+        data: (Geo)DataFrame, or None if the dataset has not been published or its source has changed since
+    """
+    return open_artifact(name, folder)
+
+
+def version(name):
+    """
+    Returns the fingerprint of the version of a dataset used by the current rerun. The version is pinned at the
+    first use of the dataset in a rerun, so a rerun that is running when a new version is swapped in finishes with
+    the old one. The pin is released when the pinned versions of the rerun are dropped (see data_store.preload).
+
+    Args:
+        name: name of the dataset (see DATASETS)
+
+    Returns:
+        fingerprint: fingerprint of the version (see data_build.fingerprint)
+    """
+    pinned = pinned_versions()
+    if pinned is not None and name in pinned:
+        return pinned[name]
+    with _lock:
+        current = _versions.get(name)
+    if current is None:
+        current = fingerprint(name)
+    with _lock:
+        current = _versions.setdefault(name, current)
+        if pinned is not None:
+            _pins[(name, current)] = _pins.get((name, current), 0) + 1
+    if pinned is not None:
+        pinned[name] = current
+        weakref.finalize(pinned, _release, (name, current))
+    return current
+
+
+def _release(key):
+    """
+    Releases a version pinned by a rerun. A version that has been replaced is dropped when no rerun uses it any more.
+    """
+    with _lock:
+        _pins[key] -= 1
+        if _pins[key] > 0:
+            return
+        del _pins[key]
+        if key in _replaced:
+            _drop(key)
+
+
+def _drop(key):
+    """
+    Drops a loaded version of a dataset, called with the lock held
+    """
+    data = _loaded.pop(key, None)
+    if data is not None:
+        _shared_ids.discard(id(data))
+
+
+def read_dataset(name):
+    """
+    Returns a dataset shared by all sessions of this process. It is attached from shared memory when it has been
+    published with `python -m pages.utils.shared_data`, memory mapped from the build folder when it has been built
+    with `python -m pages.utils.data_build`, and otherwise read from the data folder and optimized in memory. The
+    pages must not modify the returned data in place.
+
+    Args:
+        name: name of the dataset (see DATASETS)
+
+    Returns:
+        data: GeoDataFrame or DataFrame
+    """
+    start_watcher()
+    return _read_version(name, version(name))
+
+
+def _read_version(name, fingerprint):
+    """
+    Returns a version of a dataset, loading it once however many sessions ask for it at the same time. A version
+    that has been replaced is kept while a rerun has it pinned, otherwise it is not loaded again and the current
+    version is returned instead.
+    """
+    key = (name, fingerprint)
+    while True:
+        with _lock:
+            data = _loaded.get(key)
+            if data is not None:
+                return data
+            if key in _replaced and not _pins.get(key):
+                key = (name, _versions[name])
+                continue
+            event = _loading.get(key)
+            leader = event is None
+            if leader:
+                event = _loading[key] = threading.Event()
+        if leader:
+            break
+        event.wait()
+
+    try:
+        data = attach(name)
+        if data is None:
+            data = open_artifact(name)
+        if data is None:
+            data = load(name)
+        with _lock:
+            _loaded[key] = data
+            _shared_ids.add(id(data))
+    finally:
+        with _lock:
+            del _loading[key]
+        event.set()
+    return data
+
+
+def on_reload(listener):
+    """
+    Registers a function called after a new version of a dataset has been swapped in, used to drop the cached
+    results computed from the old version
+
+    Args:
+        listener: function called with the dataset name, the old fingerprint and the new fingerprint
+    """
+    _listeners.append(listener)
+
+
+def reload_changed():
+    """
+    Checks the loaded datasets for changed source files. The new version of a changed dataset is loaded while the
+    sessions keep using the old one, and then swapped in for new reruns. The old version is dropped when the
+    reruns that have it pinned have finished (see version). A changed file is reloaded only when it has not changed again since the
+    previous check, so that a file that is still being copied is not loaded.
+
+    Returns:
+        reloaded: names of the datasets whose new version was swapped in
+    """
+    with _lock:
+        current = dict(_versions)
+    reloaded = []
+    for name, old in current.items():
+        new = fingerprint(name)
+        if new is None or new == old:
+            _pending.pop(name, None)
+            continue
+        if _pending.get(name) != new:
+            _pending[name] = new
+            continue
+        del _pending[name]
+        start = time.perf_counter()
+        try:
+            with metrics.span(0, f'reload {name}'):
+                _read_version(name, new)
+        except Exception:
+            logger.exception('Loading the new version of %s failed, keeping the old version', name)
+            continue
+        with _lock:
+            _versions[name] = new
+            _replaced.add((name, old))
+            if not _pins.get((name, old)):
+                _drop((name, old))
+            _reloads[name] = _reloads.get(name, 0) + 1
+        for listener in _listeners:
+            listener(name, old, new)
+        reloaded.append(name)
+        logger.info(json.dumps({'time': time.time(), 'event': 'reload', 'dataset': name, 'old': old, 'new': new,
+                                'seconds': time.perf_counter() - start}))
+    return reloaded
+
+
+def _run_watcher():
+    while True:
+        time.sleep(RELOAD_INTERVAL)
+        try:
+            reload_changed()
+        except Exception:
+            logger.exception('Checking the datasets for changes failed')
+
+
+def start_watcher():
+    """
+    Starts checking the datasets for changes in a background thread, once per process
+    """
+    global _watcher
+    if _watcher is not None or not RELOAD_INTERVAL:
+        return
+    with _lock:
+        if _watcher is not None:
+            return
+        _watcher = threading.Thread(target=_run_watcher, name='equity-reload', daemon=True)
+    _watcher.start()
+
+
+def prometheus_lines():
+    """
+    Renders the dataset versions and reload counts for the metrics endpoint
+    """
+    with _lock:
+        versions = dict(_versions)
+        reloads = dict(_reloads)
+    lines = ['# HELP equity_dataset_version Fingerprint of the dataset version used by new reruns.',
+             '# TYPE equity_dataset_version gauge']
+    lines += [f'equity_dataset_version{{dataset="{name}",fingerprint="{current}"}} 1' for name, current in versions.items()]
+    lines += ['# HELP equity_dataset_reloads_total New dataset versions swapped in without a restart.',
+              '# TYPE equity_dataset_reloads_total counter']
+    lines += [f'equity_dataset_reloads_total{{dataset="{name}"}} {reloads.get(name, 0)}' for name in versions]
+    return lines
+
+
+def is_shared(obj):
+    """
+    Tells whether an object is a dataset returned by read_dataset, i.e. not owned by a single session
+    """
+    return id(obj) in _shared_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Publishes the datasets of the app as Arrow IPC files in shared memory for the worker processes.')
+    parser.add_argument('datasets', nargs='*', help=f'datasets to publish (default: all): {", ".join(DATASETS)}')
+    parser.add_argument('--folder', default=str(SHARED_FOLDER), help=f'folder to publish to (default: {SHARED_FOLDER})')
+    args = parser.parse_args()
+    unknown = set(args.datasets) - set(DATASETS)
+    if unknown:
+        parser.error(f'unknown datasets: {", ".join(sorted(unknown))}')
+    publish(args.datasets, Path(args.folder))
+
+
+metrics.add_collector(prometheus_lines)
+
+
+if __name__ == "__main__":
+    main()
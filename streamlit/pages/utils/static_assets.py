@@ -0,0 +1,313 @@
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Folder that Streamlit serves at /app/static when server.enableStaticServing is set, next to the main script.
+# Nginx serves it directly with long-lived cache headers (see nginx.conf).
+STATIC_FOLDER = Path(__file__).parent.parent.parent / 'static'
+STATIC_PATH = 'app/static'
+# Layer data of the maps, named by the hash of their contents
+LAYER_FOLDER = 'layers'
+# Rendered maps, named by the hash of their HTML, which the pages show in iframes
+MAP_FOLDER = 'maps'
+# Links to the rendered maps named by their selection, the data versions and the page source (see selection_map)
+SELECTION_FOLDER = 'selections'
+# Copies of the JS and CSS libraries of the maps, fetched with `python -m pages.utils.static_assets --fetch`
+LIBRARY_FOLDER = 'libraries'
+MANIFEST_FILE = 'manifest.json'
+# Layer data is written to files only when this is set and Streamlit serves the static folder
+STATIC_LAYERS = os.environ.get('EQUITY_STATIC_LAYERS', '1') not in ('', '0')
+# The pages show the maps from files instead of sending their HTML when this is set and Streamlit serves the static
+# folder. Like the library copies below, this needs Nginx, as Streamlit serves the files as text/plain.
+MAP_FRAGMENTS = os.environ.get('EQUITY_MAP_FRAGMENTS', '') not in ('', '0')
+# The maps use the copies of the libraries when this is set. Streamlit serves the static folder as text/plain, which
+# browsers do not run as scripts, so this should only be set when Nginx serves the folder.
+LOCAL_LIBRARIES = os.environ.get('EQUITY_LOCAL_LIBRARIES', '') not in ('', '0')
+# Layers smaller than this (bytes) are kept in the map HTML, where they cost less than a request
+MIN_FILE_BYTES = 4096
+# Number of hex digits of the content hash in the file names
+HASH_LENGTH = 20
+
+logger = logging.getLogger('equity.static_assets')
+
+# Set in the threads rendering maps within inline_assets
+_inline = threading.local()
+
+
+def fingerprint(content):
+    return hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+
+
+def base_url():
+    """
+    Returns the URL path of the static folder, including the base URL path of the server
+    """
+    from streamlit import config
+
+    base = config.get_option('server.baseUrlPath').strip('/')
+    return '/' + '/'.join(part for part in (base, STATIC_PATH) if part)
+
+
+def static_layers():
+    """
+    Tells whether layer data is written to static files: when enabled and Streamlit serves the static folder
+    """
+    from streamlit import config
+
+    return STATIC_LAYERS and config.get_option('server.enableStaticServing') and not getattr(_inline, 'active', False)
+
+
+def static_maps():
+    """
+    Tells whether the maps are shown from files: when enabled and Streamlit serves the static folder
+    """
+    from streamlit import config
+
+    return MAP_FRAGMENTS and config.get_option('server.enableStaticServing') and not getattr(_inline, 'active', False)
+
+
+@contextmanager
+def inline_assets():
+    """
+    Keeps the maps and layers rendered within the block in the map HTML instead of writing them to the static folder.
+    Used for the maps of open-ended inputs (formulas, locations, scenarios), which are seldom shown twice and would
+    each leave files behind.
+    """
+    previous = getattr(_inline, 'active', False)
+    _inline.active = True
+    try:
+        yield
+    finally:
+        _inline.active = previous
+
+
+def write_file(path, content):
+    """
+    Writes a file with its gzip and, if the brotli package is installed, brotli compressed copies for Nginx.
+    The files are written under temporary names and renamed, so that workers writing the same file do not clash.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    variants = {'': content, '.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(content)
+    for suffix, data in variants.items():
+        temporary = path.with_name(f'.{path.name}{suffix}.{os.getpid()}.tmp')
+        temporary.write_bytes(data)
+        os.replace(temporary, path.with_name(path.name + suffix))
+
+
+def publish(content, suffix, folder=LAYER_FOLDER):
+    """
+    Stores content in the static folder under the hash of the content. Content that is already stored is not written
+    again, only its modification time is updated so that prune keeps it.
+
+    Args:
+        content: bytes of the file
+        suffix: file name extension, e.g. '.json'
+        folder: subfolder of the static folder
+
+    Returns:
+        url: URL path of the file, which never changes content and can be cached indefinitely
+    """
+    name = fingerprint(content) + suffix
+    path = STATIC_FOLDER / folder / name
+    if path.exists():
+        os.utime(path)
+    else:
+        write_file(path, content)
+    return f'{base_url()}/{folder}/{name}'
+
+
+@lru_cache(maxsize=1)
+def library_urls():
+    """
+    Returns the local URLs of the fetched library copies by their original URL, none unless LOCAL_LIBRARIES is set
+    """
+    path = STATIC_FOLDER / LIBRARY_FOLDER / MANIFEST_FILE
+    if not LOCAL_LIBRARIES or not path.exists():
+        return {}
+    return {url: f'{base_url()}/{LIBRARY_FOLDER}/{name}' for url, name in json.loads(path.read_text()).items()}
+
+
+def stable_names(html):
+    """
+    Replaces the random ids in the names folium gives to the elements of a map with sequential numbers, so that the
+    same map always renders to the same HTML
+    """
+    ids = {}
+    return re.sub(r'(?<=_)[0-9a-f]{32}(?![0-9A-Za-z])', lambda match: ids.setdefault(match.group(), str(len(ids))), html)
+
+
+def publish_map(html):
+    """
+    Stores a rendered map in the static folder under the hash of its HTML. The same selection gives the same file in
+    every worker and after restarts, so browsers and Nginx keep serving it for as long as the data does not change.
+
+    Returns:
+        url: URL path of the map, which can also be shared on its own
+    """
+    return publish(stable_names(html).encode('utf-8'), '.html', MAP_FOLDER)
+
+
+def link_file(source, target):
+    """
+    Links a file written with write_file and its compressed copies under another name. The links share the
+    modification time of the file, so prune keeps or removes them together.
+    """
+    target.parent.mkdir(parents=True, exist_ok=True)
+    for suffix in ('', '.gz', '.br'):
+        variant = source.with_name(source.name + suffix)
+        if variant.exists():
+            temporary = target.with_name(f'.{target.name}{suffix}.{os.getpid()}.tmp')
+            os.link(variant, temporary)
+            os.replace(temporary, target.with_name(target.name + suffix))
+
+
+def selection_map(page, key, build, datasets):
+    """
+    Returns the map of a selection from the compute cache. When the maps are served as static files, the file of the
+    selection is looked up before the map is built, by a name derived from the selection, the versions of the datasets
+    and the source of the page. A selection that any worker has rendered since the data or the code last changed is
+    then not built again, also after restarts, and a shared link of the page only costs the lookup.
+
+    Args:
+        page: page number
+        key: key of the selection in the compute cache, of values with a stable repr (strings, numbers, tuples)
+        build: function returning the map rendered with metrics.map_html, or None when there is nothing to show
+        datasets: names of the datasets the map is built from
+
+    Returns:
+        html: the rendered HTML document or the URL path of the map file, None if build returned None
+    """
+    from pages.utils import source_fingerprint
+    from pages.utils.compute_cache import cached
+    from pages.utils.shared_data import version
+
+    if not static_maps():
+        return cached(key, build, datasets=datasets)
+    inputs = repr((key, [version(name) for name in datasets], source_fingerprint(page)))
+    name = fingerprint(inputs.encode('utf-8')) + '.html'
+    path = STATIC_FOLDER / MAP_FOLDER / SELECTION_FOLDER / name
+    if path.exists():
+        os.utime(path)
+        return f'{base_url()}/{MAP_FOLDER}/{SELECTION_FOLDER}/{name}'
+    html = cached(key, build, datasets=datasets)
+    # Maps kept in the HTML (see inline_assets) are not linked
+    if html is not None and html.startswith('/'):
+        link_file(STATIC_FOLDER / MAP_FOLDER / html.rsplit('/', 1)[1], path)
+    return html
+
+
+def localize(html):
+    """
+    Replaces the CDN URLs of the map libraries in a rendered map with their fingerprinted local copies
+    """
+    for url, local in library_urls().items():
+        html = html.replace(f'"{url}"', f'"{local}"')
+    return html
+
+
+def sample_map_urls():
+    """
+    Renders a map with the kinds of layers the pages use and returns the URLs of the libraries it loads
+    """
+    import branca.colormap as cm
+    import folium
+    import geopandas as gpd
+    from shapely import box
+    from pages.utils.layers import CompactGeoJson
+
+    m = folium.Map(tiles='cartodbpositron')
+    layer = CompactGeoJson(gpd.GeoDataFrame({'name': ['a']}, geometry=[box(24, 60, 25, 61)], crs='EPSG:4326'), 0, properties=['name'])
+    layer.add_child(folium.features.GeoJsonTooltip(fields=['name'])).add_to(m)
+    folium.CircleMarker([60, 24]).add_to(m)
+    m.add_child(cm.LinearColormap(['#ffffff', '#000000'], vmin=0, vmax=1))
+    html = folium.Figure().add_child(m).render()
+    return list(dict.fromkeys(re.findall(r'<(?:script|link)[^>]*?(?:src|href)="(https?://[^"]+)"', html)))
+
+
+def fetch_libraries():
+    """
+    Downloads the libraries of the maps to the static folder under fingerprinted names and writes the manifest of
+    their original URLs. Stylesheets that load images or fonts by relative paths are left on their CDN. A library
+    that cannot be downloaded keeps its earlier copy, if any.
+
+    Returns:
+        manifest: the file names of the copies by their original URL
+    """
+    path = STATIC_FOLDER / LIBRARY_FOLDER / MANIFEST_FILE
+    previous = json.loads(path.read_text()) if path.exists() else {}
+    manifest = {}
+    for url in sample_map_urls():
+        try:
+            with urllib.request.urlopen(url, timeout=30) as response:
+                content = response.read()
+        except OSError as error:
+            logger.warning('%s was not fetched: %s', url, error)
+            if url in previous:
+                manifest[url] = previous[url]
+            continue
+        suffix = Path(url.split('?')[0]).suffix
+        if suffix == '.css' and re.search(rb'url\((?![\'"]?data:)', content):
+            continue
+        name = fingerprint(content) + suffix
+        write_file(STATIC_FOLDER / LIBRARY_FOLDER / name, content)
+        manifest[url] = name
+        print(f'Fetched {url} -> {LIBRARY_FOLDER}/{name} ({len(content) / 1024:.0f} kB)')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(f'.{MANIFEST_FILE}.tmp')
+    temporary.write_text(json.dumps(manifest, indent=2))
+    os.replace(temporary, path)
+    return manifest
+
+
+def prune(days):
+    """
+    Removes the layer and map files and the links of the selections that have not been used for the given number of days
+
+    Returns:
+        removed: number of removed files, counting the compressed copies
+    """
+    cutoff = time.time() - days * 86400
+    removed = 0
+    paths = [*(STATIC_FOLDER / LAYER_FOLDER).glob('*.json'), *(STATIC_FOLDER / MAP_FOLDER).glob('*.html'),
+             *(STATIC_FOLDER / MAP_FOLDER / SELECTION_FOLDER).glob('*.html')]
+    for path in paths:
+        if path.stat().st_mtime < cutoff:
+            for variant in (path, path.with_name(path.name + '.gz'), path.with_name(path.name + '.br')):
+                if variant.exists():
+                    variant.unlink()
+                    removed += 1
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manages the static files of the maps served by Nginx.')
+    parser.add_argument('--fetch', action='store_true', help='download the map libraries to the static folder')
+    parser.add_argument('--prune', type=float, metavar='DAYS', help='remove layer and map files not written for DAYS days')
+    args = parser.parse_args()
+    if not args.fetch and args.prune is None:
+        parser.error('nothing to do, give --fetch and/or --prune')
+    if args.fetch:
+        fetch_libraries()
+    if args.prune is not None:
+        print(f'Removed {prune(args.prune)} layer and map files')
+
+
+if __name__ == "__main__":
+    main()
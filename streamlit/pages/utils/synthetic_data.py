@@ -0,0 +1,243 @@
+import argparse
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely import box, points
+from pages.utils import DATA_FOLDER, GRID_ID_COLUMN, OPPORTUNITY_ID_COLUMN, POPULATION_COLUMN
+
+# Extent of mainland Finland in ETRS-TM35FIN (EPSG:3067), the coordinate system of the original datasets
+EXTENT = (80000, 6620000, 740000, 7770000)
+CELL_SIZE = 1000
+
+MODES = ['JL', 'PP']
+TRAVEL_TIMES = [30, 45, 60]
+ACCESS_TYPES = ['aptk', 'ruok', 'kirja', 'lahi', 'koul', 'sair', 'tyo']
+
+AGE_COLUMNS = ['he_0_2', 'he_3_6', 'he_7_12', 'he_13_15', 'he_16_17', 'he_18_19', 'he_20_24', 'he_25_29', 'he_30_34',
+               'he_35_39', 'he_40_44', 'he_45_49', 'he_50_54', 'he_55_59', 'he_60_64', 'he_65_69', 'he_70_74',
+               'he_75_79', 'he_80_84', 'he_85_']
+
+# Opportunity types with their colors and share of all opportunities
+OPPORTUNITY_COLORS = {
+    'Pharmacy': ('#2E8B57', 0.06),
+    'Grocery store': ('#F28E2B', 0.20),
+    'Library': ('#4E79A7', 0.07),
+    'Public sports facility': ('#59A14F', 0.40),
+    'School': ('#B07AA1', 0.17),
+    'Healthcare': ('#E15759', 0.10)
+}
+
+
+def municipality_names(n_municipalities):
+    """
+    Creates unique municipality names
+    """
+    return [f'Kunta {i:03d}' for i in range(1, n_municipalities + 1)]
+
+
+def municipality_polygons(n_municipalities):
+    """
+    Splits the extent into a regular grid of rectangular municipalities
+
+    Returns:
+        municipalities: GeoDataFrame with kunta, vuosi, nimi, namn, name and geometry columns in EPSG:3067
+    """
+    n_columns = int(np.ceil(np.sqrt(n_municipalities * (EXTENT[2] - EXTENT[0]) / (EXTENT[3] - EXTENT[1]))))
+    n_rows = int(np.ceil(n_municipalities / n_columns))
+    width = (EXTENT[2] - EXTENT[0]) / n_columns
+    height = (EXTENT[3] - EXTENT[1]) / n_rows
+
+    i = np.arange(n_municipalities)
+    x0 = EXTENT[0] + (i % n_columns) * width
+    y0 = EXTENT[1] + (i // n_columns) * height
+    names = municipality_names(n_municipalities)
+    return gpd.GeoDataFrame({
+        'kunta': [f'{code:03d}' for code in i + 1],
+        'vuosi': 2023,
+        'nimi': names,
+        'namn': names,
+        'name': names,
+        'geometry': box(x0, y0, x0 + width, y0 + height)
+    }, crs='EPSG:3067')
+
+
+def population_grid(n_cells, municipalities, rng):
+    """
+    Creates a 1 km x 1 km population grid with clustered population and access values
+
+    Returns:
+        grid: GeoDataFrame with identifiers, municipality names, population, income, access fields and geometry in EPSG:3067
+    """
+    n_x = (EXTENT[2] - EXTENT[0]) // CELL_SIZE
+    n_y = (EXTENT[3] - EXTENT[1]) // CELL_SIZE
+    # Sample extra cells, as the cells outside the municipalities of an incomplete last row are dropped
+    cells = rng.choice(n_x * n_y, size=min(int(n_cells * 1.2), n_x * n_y), replace=False)
+    x = EXTENT[0] + (cells % n_x) * CELL_SIZE
+    y = EXTENT[1] + (cells // n_x) * CELL_SIZE
+
+    # Municipality of each cell from the rectangle its centre falls into
+    joined = gpd.sjoin(gpd.GeoDataFrame(geometry=points(x + CELL_SIZE / 2, y + CELL_SIZE / 2), crs='EPSG:3067'),
+                       municipalities[['nimi', 'geometry']], how='inner', predicate='within')
+    joined = joined[~joined.index.duplicated()].sort_index().iloc[:n_cells]
+    x, y = x[joined.index], y[joined.index]
+
+    # Urban centres around which population and access are concentrated
+    centres = rng.uniform(EXTENT[:2], EXTENT[2:], size=(max(len(municipalities) // 3, 1), 2))
+    distance = np.min(np.hypot(x[:, None] - centres[:, 0], y[:, None] - centres[:, 1]), axis=1)
+    urbanity = np.exp(-distance / 15000)
+
+    grid = pd.DataFrame({
+        GRID_ID_COLUMN: [f'1kmN{int(yi // 1000)}E{int(xi // 1000)}' for xi, yi in zip(x, y)],
+        'mncplty': joined['nimi'].to_numpy()
+    })
+    population = rng.poisson(5 + 1500 * urbanity)
+    shares = rng.dirichlet(np.ones(len(AGE_COLUMNS)) * 5, size=len(grid))
+    for i, column in enumerate(AGE_COLUMNS):
+        grid[column] = np.floor(population * shares[:, i]).astype('int64')
+    grid[POPULATION_COLUMN] = grid[AGE_COLUMNS].sum(axis=1)
+    grid['hr_mtu'] = np.round(rng.lognormal(np.log(24000) + 0.3 * urbanity, 0.25))
+
+    for mode in MODES:
+        for access_type in ACCESS_TYPES:
+            scale = 50000 if access_type == 'tyo' else 60
+            for travel_time in TRAVEL_TIMES:
+                reach = urbanity ** (60 / travel_time) * (0.6 if mode == 'PP' else 1)
+                grid[f'{mode}_{access_type}{travel_time}'] = np.floor(scale * reach * rng.uniform(0.8, 1.2, len(grid)))
+
+    return gpd.GeoDataFrame(grid, geometry=box(x, y, x + CELL_SIZE, y + CELL_SIZE), crs='EPSG:3067')
+
+
+def opportunities(n_opportunities, grid, rng):
+    """
+    Creates opportunity points located in populated cells
+
+    Returns:
+        opportunities: GeoDataFrame with id, opprtnt, color, mncplty, name and geometry columns in EPSG:3067
+    """
+    weights = grid[POPULATION_COLUMN].to_numpy() + 1.0
+    cells = rng.choice(len(grid), size=n_opportunities, p=weights / weights.sum())
+    bounds = grid.geometry.bounds.to_numpy()[cells]
+    types = rng.choice(list(OPPORTUNITY_COLORS), size=n_opportunities, p=[share for _, share in OPPORTUNITY_COLORS.values()])
+
+    return gpd.GeoDataFrame({
+        OPPORTUNITY_ID_COLUMN: np.arange(n_opportunities),
+        'opprtnt': types,
+        'color': [OPPORTUNITY_COLORS[opportunity_type][0] for opportunity_type in types],
+        'mncplty': grid['mncplty'].to_numpy()[cells],
+        'name': [f'{opportunity_type} {i}' for i, opportunity_type in enumerate(types)]
+    }, geometry=points(rng.uniform(bounds[:, 0], bounds[:, 2]), rng.uniform(bounds[:, 1], bounds[:, 3])), crs='EPSG:3067')
+
+
+def travel_time_matrix(grid, destinations, speed, rng, max_travel_time=60):
+    """
+    Creates a travel time matrix from straight-line distances between grid cell centres and destination points
+
+    Args:
+        speed: travel speed (km/h) along the straight line
+
+    Returns:
+        ttm: DataFrame with from_id, to_id and travel_time_p50 columns, limited to max_travel_time
+    """
+    from scipy.spatial import cKDTree
+
+    origins = grid.geometry.centroid
+    origins = np.column_stack([origins.x, origins.y])
+    targets = np.column_stack([destinations.geometry.centroid.x, destinations.geometry.centroid.y])
+    radius = speed * 1000 / 60 * max_travel_time
+    pairs = cKDTree(origins).sparse_distance_matrix(cKDTree(targets), radius, output_type='coo_matrix')
+    detour = rng.uniform(1.1, 1.6, len(pairs.data))
+    travel_time = np.ceil(pairs.data * detour / (speed * 1000 / 60))
+    keep = travel_time <= max_travel_time
+
+    return pd.DataFrame({
+        'from_id': grid[GRID_ID_COLUMN].to_numpy()[pairs.row[keep]],
+        'to_id': destinations[OPPORTUNITY_ID_COLUMN].to_numpy()[pairs.col[keep]] if OPPORTUNITY_ID_COLUMN in destinations else destinations[GRID_ID_COLUMN].to_numpy()[pairs.col[keep]],
+        'travel_time_p50': travel_time[keep].astype('int16')
+    })
+
+
+def nearest_school_table(grid, ttm, schools):
+    """
+    Creates the nearest educational facility table of page 2 from the travel time matrix
+
+    Returns:
+        nearest: DataFrame with nimi, trv__50 and the school age population columns of each grid cell
+    """
+    ttm = ttm[ttm['to_id'].isin(schools[OPPORTUNITY_ID_COLUMN])]
+    nearest = ttm.groupby('from_id')['travel_time_p50'].min().rename('trv__50')
+    nearest = grid[[GRID_ID_COLUMN, 'mncplty', 'he_7_12', 'he_13_15', 'he_16_17']].merge(nearest, left_on=GRID_ID_COLUMN, right_index=True)
+    # Field names are truncated like in the original shapefile based export
+    return nearest.rename(columns={'mncplty': 'nimi', 'he_13_15': 'h_13_15', 'he_16_17': 'h_16_17'})
+
+
+def palma_table(grid, municipalities, rng):
+    """
+    Creates the municipal Palma ratio dataset of page 4
+
+    Returns:
+        palma: GeoDataFrame with kunta, vuosi, nimi, namn, name, palma ratio fields and geometry in EPSG:3067
+    """
+    palma = municipalities.copy()
+    for mode in MODES:
+        for access_type in ACCESS_TYPES:
+            for travel_time in TRAVEL_TIMES:
+                values = rng.lognormal(0, 0.4, len(palma))
+                # Some municipalities lack data or access for lower or higher income residents
+                values[rng.random(len(palma)) < 0.05] = np.nan
+                values[rng.random(len(palma)) < 0.02] = np.inf
+                values[rng.random(len(palma)) < 0.02] = 0
+                palma[f'{mode.lower()}_{access_type}_{travel_time}'] = values
+    return palma
+
+
+def generate(folder, n_cells=157784, n_municipalities=310, n_opportunities=20000, seed=0):
+    """
+    Writes a synthetic stand-in of every dataset read by the app to the given folder
+
+    Args:
+        folder: output folder, usually DATA_FOLDER
+        n_cells: number of populated 1 km x 1 km grid cells
+        n_municipalities: number of municipalities
+        n_opportunities: number of opportunity points
+        seed: seed of the random number generator
+    """
+    rng = np.random.default_rng(seed)
+    folder.mkdir(parents=True, exist_ok=True)
+
+    municipalities = municipality_polygons(n_municipalities)
+    grid = population_grid(n_cells, municipalities, rng)
+    # Municipalities without any populated cells are dropped like in the original data
+    municipalities = municipalities[municipalities['nimi'].isin(grid['mncplty'])]
+    points_data = opportunities(n_opportunities, grid, rng)
+
+    grid.to_parquet(folder / 'grid.parquet')
+    points_data.to_parquet(folder / 'opportunities.parquet')
+    municipalities.to_parquet(folder / 'kunnat2023.parquet')
+    gpd.GeoDataFrame({'nimi': ['Suomi']}, geometry=[municipalities.unary_union.envelope], crs='EPSG:3067').to_file(folder / 'suomi.gpkg', driver='GPKG')
+    palma_table(grid, municipalities, rng).to_file(folder / 'palma_null.gpkg', driver='GPKG')
+
+    grid[[GRID_ID_COLUMN, 'mncplty', 'he_7_12', 'he_13_15', 'he_16_17']].rename(columns={'mncplty': 'nimi'}).to_csv(folder / 'grid.csv', index=False)
+    pd.DataFrame({'mncplty': sorted(grid['mncplty'].unique())}).to_csv(folder / 'unique_mncplty.csv', index=False)
+
+    schools = points_data[points_data['opprtnt'] == 'School']
+    for mode, file_mode, speed in [('JL', 'pt', 25), ('PP', 'cycling', 15)]:
+        ttm = travel_time_matrix(grid, points_data, speed, rng)
+        ttm.to_parquet(folder / f'ttm_{file_mode}.parquet', index=False)
+        nearest_school_table(grid, ttm, schools).to_csv(folder / f'access_ttm_{file_mode}.csv', index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Writes synthetic, schema-identical stand-ins of the datasets used by the app.')
+    parser.add_argument('--folder', default=str(DATA_FOLDER), help='output folder (default: the data folder of the app)')
+    parser.add_argument('--cells', type=int, default=157784, help='number of populated grid cells')
+    parser.add_argument('--municipalities', type=int, default=310, help='number of municipalities')
+    parser.add_argument('--opportunities', type=int, default=20000, help='number of opportunity points')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random number generator')
+    args = parser.parse_args()
+
+    from pathlib import Path
+    generate(Path(args.folder), args.cells, args.municipalities, args.opportunities, args.seed)
+
+
+if __name__ == "__main__":
+    main()